@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Time taken to take all events out of the buffer (as done on each push)
+and to put back the ones that could not be sent, for growing numbers of
+buffered events. Both should take about the same time regardless of the
+number of events. For comparison, the time to copy the events into a
+list, which is what draining used to cost.
+
+Usage: python benchmarks/bench_buffer.py
+"""
+
+import os
+import sys
+import time
+
+path = os.path.join(os.path.dirname(__file__), os.pardir, "loggerds")
+sys.path.insert(0, os.path.abspath(path))
+
+from buffer import EventBuffer
+from document import Document
+
+
+def make_doc(n):
+    doc = Document("log", "tango-logs-2016.04.05", "id%d" % n,
+                   {"message": "Something happened: %d" % n}, rank=n % 5)
+    doc.encode()
+    return doc
+
+
+def timed(func, *args):
+    t0 = time.time()
+    result = func(*args)
+    return time.time() - t0, result
+
+
+def main():
+    print "%8s %14s %14s %14s" % ("events", "drain", "requeue", "copy (old)")
+    for n in (1000, 10000, 100000):
+        docs = [make_doc(i) for i in xrange(n)]
+        buf = EventBuffer(n * 2, 0)
+        buf.put_many(docs)
+        drain, batch = timed(buf.drain)
+        copy, _ = timed(list, batch)
+        requeue, _ = timed(buf.requeue, batch)  # e.g. when ES is down
+        print "%8d %11.1f us %11.1f us %11.1f us" % (
+            n, drain * 1e6, requeue * 1e6, copy * 1e6)
+
+
+if __name__ == "__main__":
+    main()
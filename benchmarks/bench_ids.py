@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Compare the ways of picking document IDs (see loggerds/ids.py): the
+per event cost of making the ID and encoding the event, and the size
+of the bulk action line. The ES side of it (auto generated and time
+ordered IDs index faster than random ones) needs a real ES to measure,
+e.g. with load_test.py --property DocumentIdStrategy=...
+
+Usage: python benchmarks/bench_ids.py [number of events]
+"""
+
+import os
+import sys
+import timeit
+from uuid import uuid4
+
+path = os.path.join(os.path.dirname(__file__), os.pardir, "loggerds")
+sys.path.insert(0, os.path.abspath(path))
+
+from document import Document
+from events import log_source
+from ids import TimeOrderedIds, auto_id, content_id
+
+
+SOURCE = log_source(["1459900800000", "INFO", "sys/test/1",
+                     "Something happened", "0", "1234"])
+
+
+def make_document(make_id):
+    doc = Document("log", "tango-logs-2016.04.05", None, dict(SOURCE))
+    doc.id = make_id(doc)
+    return doc.encode()
+
+
+def main(n=100000):
+    strategies = [
+        ("uuid4 (default)", lambda doc: str(uuid4())),
+        ("auto", auto_id),
+        ("timeorder", TimeOrderedIds()),
+        ("hash", content_id),
+    ]
+    for name, make_id in strategies:
+        t = min(timeit.repeat(lambda: make_document(make_id),
+                              number=n, repeat=3))
+        action, _ = make_document(make_id)
+        print "%-16s %8.3f us/event  action line: %3d bytes" % (
+            name, t / n * 1e6, len(action))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for the per event cost of picking an index name; the old
+way (strftime on the current time for each event) versus the cached
+daily names.
+
+Usage: python benchmarks/bench_index.py [number of events]
+"""
+
+from datetime import datetime
+import os
+import sys
+import time
+import timeit
+
+path = os.path.join(os.path.dirname(__file__), os.pardir, "loggerds")
+sys.path.insert(0, os.path.abspath(path))
+
+from indices import DailyIndex
+
+
+def old_get_index(group):
+    date = time.strftime('%Y.%m.%d', datetime.utcnow().utctimetuple())
+    return "tango-{0}-{1}".format(group, date)
+
+
+def main(n=100000):
+    index = DailyIndex("tango", "logs")
+    now_ms = str(int(time.time() * 1000))
+    now_dt = datetime.utcnow()
+    cases = [
+        ("strftime per event (old)", lambda: old_get_index("logs")),
+        ("cached, today", index.today),
+        ("cached, ms timestamp", lambda: index.get(now_ms)),
+        ("cached, datetime", lambda: index.get(now_dt)),
+        ("plain dict lookup", lambda: index._names.get(0)),
+    ]
+    for name, func in cases:
+        t = min(timeit.repeat(func, number=n, repeat=3))
+        print "%-28s %8.3f us/event" % (name, t / n * 1e6)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Compare queued events kept as dicts (encoded by the ES client on every
+flush) with events encoded once at ingest into their bulk lines: CPU
+time spent building the bulk bodies on flush, and memory per queued
+event.
+
+Usage: python benchmarks/bench_queue.py [number of events]
+"""
+
+import gc
+import os
+import sys
+import time
+from uuid import uuid4
+
+path = os.path.join(os.path.dirname(__file__), os.pardir, "loggerds")
+sys.path.insert(0, os.path.abspath(path))
+
+from elasticsearch import Elasticsearch, helpers
+
+from document import Document
+from events import alarm_source, log_source
+
+
+def rss():
+    "Resident memory of this process, in bytes"
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def make_log(n):
+    return log_source([str(1459900800000 + n), "INFO",
+                       "sys/test/%d" % (n % 50),
+                       "Something happened: %d" % n, "0", "1234"])
+
+
+def make_alarm(n):
+    return alarm_source({
+        "timestamp": 1459900800000 + n, "device": "sys/alarms/1",
+        "alarm_tag": "TEST_%d" % (n % 100), "severity": "WARNING",
+        "message": "ALARM", "description": "Something is wrong",
+        "formula": "sys/test/1/pressure > 1e-6 and sys/test/2/state == 3",
+        "host": "host-1", "instance": "fisk",
+        "values": [{"attribute": "sys/test/1/pressure", "value": 2.3e-6},
+                   {"attribute": "sys/test/2/state", "value": 3}]})
+
+
+def as_dict(n, source, doc_type):
+    return {"_id": str(uuid4()), "_type": doc_type,
+            "_index": "tango-logs-2016.04.05", "_source": source}
+
+
+def as_document(n, source, doc_type):
+    doc = Document(doc_type, "tango-logs-2016.04.05", str(uuid4()), source)
+    doc.encode()
+    return doc
+
+
+def flush_cost(events, **kwargs):
+    "Time spent turning the queued events into bulk request bodies"
+    serializer = Elasticsearch().transport.serializer
+    expand = kwargs.get("expand_action_callback", helpers.expand_action)
+    t0 = time.clock()
+    for chunk in helpers._chunk_actions(map(expand, events), 500,
+                                        10 * 1024 * 1024, serializer):
+        "\n".join(chunk)
+    return time.clock() - t0
+
+
+def run(name, make_source, doc_type, n):
+    for wrap, kwargs in [(as_dict, {}),
+                         (as_document,
+                          {"expand_action_callback": Document.encode})]:
+        gc.collect()
+        before = rss()
+        events = [wrap(i, make_source(i), doc_type) for i in xrange(n)]
+        gc.collect()
+        memory = float(rss() - before) / n
+        cpu = flush_cost(events, **kwargs)
+        print ("%-6s %-10s flush: %6.2f us/event  memory: %5.0f bytes/event"
+               % (name, wrap.__name__[3:], cpu / n * 1e6, memory))
+        del events
+
+
+def main(n=100000):
+    run("log", make_log, "log", n)
+    run("alarm", make_alarm, "alarm", n)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
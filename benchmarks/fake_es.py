@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+"""
+A small stand-in for an Elasticsearch node, good enough for the Logger
+device: it answers pings, index exists/create and bulk requests, and
+keeps count of the documents it gets. Latency, failing requests and
+back-pressure (status 429 for some of the documents) can be configured,
+to see how the device copes.
+
+It can be used from other benchmarks (see load_test.py) or run on its
+own, e.g. to point a real Logger device at:
+
+Usage: python benchmarks/fake_es.py [--port 9200] [--latency 0.01] ...
+"""
+
+from array import array
+import argparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime
+import json
+import random
+from SocketServer import ThreadingMixIn
+import threading
+import time
+import urlparse
+import zlib
+
+
+def event_time(source):
+    "The timestamp of an event as it arrives in ES, in epoch seconds"
+    timestamp = source.get("@timestamp")
+    try:
+        return float(timestamp) / 1000  # log events: ms epoch
+    except (TypeError, ValueError):
+        pass
+    try:
+        # alarm events: ISO format, UTC
+        t = datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S")
+        fraction = float("0" + timestamp[19:]) if timestamp[19:] else 0
+        return (t - datetime(1970, 1, 1)).total_seconds() + fraction
+    except (TypeError, ValueError):
+        return None
+
+
+class Stats(object):
+
+    "What the fake ES has seen"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.ids = set()
+            self.documents = 0
+            self.duplicates = 0
+            self.bulk_requests = 0
+            self.bulk_bytes = 0
+            self.rejected = 0  # documents refused with 429
+            self.failed_requests = 0
+            self.indices = set()
+            self.templates = {}
+            self.last_stored = None  # epoch seconds
+            self.delays = array("d")  # seconds from event to storage
+
+    def to_dict(self):
+        with self.lock:
+            return {"documents": self.documents,
+                    "duplicates": self.duplicates,
+                    "bulk_requests": self.bulk_requests,
+                    "bulk_bytes": self.bulk_bytes,
+                    "rejected": self.rejected,
+                    "failed_requests": self.failed_requests,
+                    "indices": sorted(self.indices),
+                    "templates": sorted(self.templates)}
+
+
+def filter_fields(obj, paths):
+    """Keep only the given fields of a response, like ES does with the
+    filter_path parameter; *paths* are lists of names, or "*" for any"""
+    if not paths:
+        return obj
+    if isinstance(obj, list):
+        return [filter_fields(item, paths) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    kept = {}
+    for key, value in obj.items():
+        rest = [path[1:] for path in paths if path[0] in ("*", key)]
+        if any(not path for path in rest):
+            kept[key] = value  # the whole field
+        elif rest:
+            kept[key] = filter_fields(value, rest)
+    return kept
+
+
+class FakeESHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real thing
+
+    def log_message(self, *args):
+        pass  # way too much output otherwise
+
+    @property
+    def config(self):
+        return self.server.config
+
+    @property
+    def stats(self):
+        return self.server.stats
+
+    def _respond(self, status, body=None):
+        data = json.dumps(body) if body is not None else ""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def _index_name(self):
+        return self.path.split("?")[0].strip("/").split("/")[0]
+
+    def do_HEAD(self):
+        index = self._index_name()
+        if not index:
+            return self._respond(200)  # ping
+        with self.stats.lock:
+            exists = index in self.stats.indices
+        self._respond(200 if exists else 404)
+
+    def _template_name(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts[0] == "_template" and len(parts) > 1:
+            return parts[1]
+        return None
+
+    def do_GET(self):
+        if not self._index_name():
+            return self._respond(200, {"version": {"number": "2.4.0"},
+                                       "tagline": "You Know, for Search"})
+        name = self._template_name()
+        if name is not None:
+            with self.stats.lock:
+                template = self.stats.templates.get(name)
+            if template is None:
+                return self._respond(404, {})
+            return self._respond(200, {name: template})
+        self._respond(200, {})
+
+    def do_PUT(self):
+        body = self._read_body()
+        name = self._template_name()
+        with self.stats.lock:
+            if name is not None:
+                self.stats.templates[name] = json.loads(body)
+            else:
+                self.stats.indices.add(self._index_name())
+        self._respond(200, {"acknowledged": True})
+
+    def do_POST(self):
+        body = self._read_body()
+        if not self.path.split("?")[0].endswith("/_bulk"):
+            return self._respond(404, {"error": "not supported"})
+        time.sleep(self.config.latency)
+        if random.random() < self.config.error_rate:
+            with self.stats.lock:
+                self.stats.failed_requests += 1
+            error = {"type": "unavailable_shards_exception",
+                     "reason": "injected failure"}
+            return self._respond(503, {"error": dict(error,
+                                                     root_cause=[error]),
+                                       "status": 503})
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        paths = [path.split(".") for path in
+                 ",".join(query.get("filter_path", [])).split(",") if path]
+        self._respond(200, filter_fields(self._bulk(body), paths))
+
+    def _bulk(self, body):
+        lines = body.splitlines()
+        items = []
+        now = time.time()
+        with self.stats.lock:
+            self.stats.bulk_requests += 1
+            self.stats.bulk_bytes += len(body)
+            for action_line, source_line in zip(lines[::2], lines[1::2]):
+                action, meta = json.loads(action_line).items()[0]
+                self.stats.indices.add(meta.get("_index"))
+                item = {"_index": meta.get("_index"),
+                        "_type": meta.get("_type"),
+                        "_id": meta.get("_id")}
+                if random.random() < self.config.reject_rate:
+                    self.stats.rejected += 1
+                    item["status"] = 429
+                    item["error"] = {
+                        "type": "es_rejected_execution_exception",
+                        "reason": "injected back-pressure"}
+                else:
+                    item["status"] = 201
+                    self._store(item["_id"], json.loads(source_line), now)
+                items.append({action: item})
+        return {"took": 1, "items": items,
+                "errors": any(i.values()[0]["status"] != 201 for i in items)}
+
+    def _store(self, doc_id, source, now):
+        stats = self.stats
+        if doc_id is not None and doc_id in stats.ids:
+            stats.duplicates += 1
+            return
+        if doc_id is not None:
+            stats.ids.add(doc_id)
+        stats.documents += 1
+        stats.last_stored = now
+        t = event_time(source)
+        if t is not None:
+            stats.delays.append(now - t)
+
+
+class FakeES(ThreadingMixIn, HTTPServer):
+
+    """
+    The server. *latency* is added to each bulk request, a fraction
+    *error_rate* of the bulk requests fail entirely, and a fraction
+    *reject_rate* of the documents is refused with status 429.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, reject_rate=0.0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), FakeESHandler)
+        self.config = argparse.Namespace(latency=latency,
+                                         error_rate=error_rate,
+                                         reject_rate=reject_rate)
+        self.stats = Stats()
+        self._thread = None
+
+    @property
+    def address(self):
+        return "%s:%d" % self.server_address
+
+    def start(self):
+        "Serve from a background thread"
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name="FakeES")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to each bulk request")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of bulk requests that fail")
+    parser.add_argument("--reject-rate", type=float, default=0.0,
+                        help="fraction of documents refused with 429")
+    args = parser.parse_args()
+    server = FakeES(args.port, args.latency, args.error_rate,
+                    args.reject_rate)
+    print "Fake ES listening on %s" % server.address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print json.dumps(server.stats.to_dict(), indent=2)
+
+
+if __name__ == "__main__":
+    main()
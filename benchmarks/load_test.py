@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+Load test of the Logger device. The device is started on its own (no
+Tango database needed), pointed at a fake ES (see fake_es.py) and fed
+log and alarm events from a number of client threads, at a given rate.
+When all events are sent, it waits for the device to push everything
+and reports:
+
+- throughput; offered (sent by the clients) and sustained (stored)
+- latency of the Log/Alarm commands, as seen by the clients
+- end-to-end delay, from event timestamp to storage in the fake ES
+- peak resident memory of the device process
+- events lost, dropped by the device, retried and stored twice
+
+Everything runs locally, so it can be used to compare releases. Use
+--json to also write the report to a file.
+
+Usage: python benchmarks/load_test.py [--rate 10000] [--duration 30]
+           [--clients 4] [--batch 100] [--latency 0.05]
+           [--reject-rate 0.01] [--property PushPeriod=1] ...
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+import PyTango
+from PyTango.test_context import DeviceTestContext
+
+from fake_es import FakeES
+from loggerds.device import Logger
+
+
+def percentiles(values, *percents):
+    values = sorted(values)
+    if not values:
+        return [None] * len(percents)
+    last = len(values) - 1
+    return [values[int(round(last * p / 100.))] for p in percents]
+
+
+def peak_rss(pid):
+    "The peak resident memory of a process, in bytes"
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        return None
+
+
+def log_event(n):
+    return [str(int(time.time() * 1000)), "INFO", "sys/load/%d" % (n % 50),
+            "Load test event number %d" % n, "0", "1234"]
+
+
+def alarm_event(n):
+    return json.dumps({
+        "timestamp": int(time.time() * 1000), "device": "sys/alarms/1",
+        "alarm_tag": "LOAD_%d" % (n % 100), "severity": "WARNING",
+        "message": "ALARM", "description": "Load test alarm",
+        "formula": "sys/load/1/pressure > 1e-6", "host": "load-host",
+        "instance": "load-test", "priority": 2,
+        "values": [{"attribute": "sys/load/1/pressure", "value": 2.3e-6}]})
+
+
+class Client(threading.Thread):
+
+    """
+    Sends *n_events* events to the device at *rate* events/s; one alarm
+    in every *alarm_every* events, the rest log events. If *batch* is
+    above 1, log events are sent *batch* at a time with LogBatch.
+    """
+
+    def __init__(self, access, n_events, rate, batch=1, alarm_every=0,
+                 offset=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.proxy = PyTango.DeviceProxy(access)
+        self.n_events = n_events
+        self.rate = rate
+        self.batch = max(batch, 1)
+        self.alarm_every = alarm_every
+        self.offset = offset  # so that events from clients differ
+        self.sent = 0
+        self.failed = 0
+        self.latencies = []
+
+    def _send(self, first, count):
+        "Send *count* events, numbered from *first*"
+        numbers = xrange(first, first + count)
+        alarms = [n for n in numbers
+                  if self.alarm_every and n % self.alarm_every == 0]
+        for n in alarms:
+            self.proxy.Alarm(alarm_event(n))
+        logs = [log_event(n) for n in numbers if n not in alarms]
+        if len(logs) == 1:
+            self.proxy.Log(logs[0])
+        elif logs:
+            self.proxy.LogBatch([field for event in logs for field in event])
+
+    def run(self):
+        start = time.time()
+        n = 0
+        while n < self.n_events:
+            delay = start + float(n) / self.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            count = min(self.batch, self.n_events - n)
+            t0 = time.time()
+            try:
+                self._send(self.offset + n, count)
+                self.sent += count
+            except PyTango.DevFailed:
+                self.failed += count
+            self.latencies.append(time.time() - t0)
+            n += count
+
+
+def wait_for_storage(device, es, n_events, quiet_period, timeout):
+    """Wait until the fake ES has all events, or nothing more has arrived
+    for *quiet_period* seconds"""
+    deadline = time.time() + timeout
+    last_count, last_change = -1, time.time()
+    while time.time() < deadline:
+        count = es.stats.documents
+        if count >= n_events:
+            return
+        if count != last_count:
+            last_count, last_change = count, time.time()
+        elif time.time() - last_change > quiet_period:
+            device.PushQueuedEventsToES()
+            if es.stats.documents == count:
+                return
+        time.sleep(0.1)
+
+
+def run(args):
+    es = FakeES(latency=args.latency, error_rate=args.error_rate,
+                reject_rate=args.reject_rate)
+    es.start()
+    properties = {"ElasticsearchHost": es.address, "PushPeriod": 1}
+    for prop in args.property:
+        name, value = prop.split("=", 1)
+        properties[name] = value
+
+    context = DeviceTestContext(Logger, properties=properties, process=True)
+    with context:
+        device = context.device
+        process = getattr(context, "thread", None)  # runs the device
+        pid = getattr(process, "pid", None) or os.getpid()
+
+        n_events = int(args.rate * args.duration)
+        per_client = n_events // args.clients
+        clients = [Client(context.get_device_access(), per_client,
+                          float(args.rate) / args.clients, args.batch,
+                          args.alarm_every, offset=i * per_client)
+                   for i in range(args.clients)]
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        send_time = time.time() - start
+        sent = sum(client.sent for client in clients)
+
+        wait_for_storage(device, es, sent, quiet_period=args.quiet_period,
+                         timeout=args.timeout)
+        stats = es.stats
+        store_time = (stats.last_stored or time.time()) - start
+        latencies = [t for client in clients for t in client.latencies]
+        report = {
+            "properties": properties,
+            "fake_es": {"latency": args.latency,
+                        "error_rate": args.error_rate,
+                        "reject_rate": args.reject_rate},
+            "events_sent": sent,
+            "events_stored": stats.documents,
+            "events_lost": sent - stats.documents,
+            "events_dropped": device.DroppedEvents,
+            "events_retried": device.RetriedEvents,
+            "events_stored_twice": stats.duplicates,
+            "events_refused": sum(client.failed for client in clients),
+            "offered_rate": sent / send_time,
+            "sustained_rate": stats.documents / store_time,
+            "command_latency": dict(zip(
+                ("p50", "p99", "max"), percentiles(latencies, 50, 99, 100))),
+            "end_to_end_delay": dict(zip(
+                ("p50", "p99", "max"),
+                percentiles(stats.delays, 50, 99, 100))),
+            "bulk_requests": stats.bulk_requests,
+            "bulk_bytes": stats.bulk_bytes,
+            "peak_rss": peak_rss(pid),
+        }
+    es.stop()
+    return report
+
+
+def print_report(report):
+    print "Events sent:            %d" % report["events_sent"]
+    print "Offered rate:           %.0f events/s" % report["offered_rate"]
+    print "Sustained rate:         %.0f events/s" % report["sustained_rate"]
+    for name, key in (("Command latency:", "command_latency"),
+                      ("End-to-end delay:", "end_to_end_delay")):
+        values = report[key]
+        if values["p50"] is None:
+            continue
+        print ("%-23s p50 %.1f ms, p99 %.1f ms, max %.1f ms"
+               % (name, values["p50"] * 1000, values["p99"] * 1000,
+                  values["max"] * 1000))
+    if report["peak_rss"]:
+        print "Peak RSS:               %.1f MB" % (report["peak_rss"] / 1e6)
+    print "Bulk requests:          %d (%.1f MB)" % (
+        report["bulk_requests"], report["bulk_bytes"] / 1e6)
+    print "Lost:                   %d" % report["events_lost"]
+    print "Dropped by the device:  %d" % report["events_dropped"]
+    print "Retried:                %d" % report["events_retried"]
+    print "Stored twice:           %d" % report["events_stored_twice"]
+    print "Events not accepted:    %d" % report["events_refused"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rate", type=float, default=1000,
+                        help="events per second, in total")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to send events for")
+    parser.add_argument("--clients", type=int, default=4,
+                        help="number of client threads")
+    parser.add_argument("--batch", type=int, default=1,
+                        help="send log events this many at a time")
+    parser.add_argument("--alarm-every", type=int, default=100,
+                        help="send an alarm every N events (0: no alarms)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to each bulk request")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of bulk requests that fail")
+    parser.add_argument("--reject-rate", type=float, default=0.0,
+                        help="fraction of events refused with 429")
+    parser.add_argument("--property", action="append", default=[],
+                        metavar="NAME=VALUE", help="device property")
+    parser.add_argument("--quiet-period", type=float, default=5,
+                        help="give up waiting for events after this long "
+                        "without progress")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--json", help="also write the report here")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+"""
+Import of events that never made it to ES through the device, e.g.
+because the device or ES was down at the time. Three kinds of files
+are understood:
+
+- "tango": Tango file logging targets (log4j XML events)
+- "alarms": PyAlarm histories; JSON encoded events, one per line, as
+  taken by the AlarmBatch command
+- "spool": spool segments written by the device (see spool)
+
+Files are read in blocks, which are parsed by a pool of processes into
+documents, built just like the device does it (see builder), and sent
+to ES in bulk, in file order. Only a few blocks are kept in flight at
+a time, so memory use stays the same however large the files are.
+Once ES has taken all events in a block, the position in the file is
+saved in a checkpoint file, so that an interrupted import continues
+where it left off. By default the document IDs are made from the
+event contents, so that events sent twice are still only stored once.
+
+Usage: loggerds-backfill [--es localhost] [--prefix tango]
+           [--checkpoint backfill.json] [--processes 4] FILE...
+"""
+
+import argparse
+from collections import deque
+import json
+from multiprocessing import Pool, cpu_count
+import os
+import re
+import sys
+import time
+from xml.sax.saxutils import unescape
+
+from elasticsearch import Elasticsearch, TransportError
+
+from builder import DocumentBuilder
+from document import Document
+from events import alarm_source, log_source, split_alarm_batch
+from ids import ID_STRATEGIES, id_maker
+from indices import DailyIndex, RolloverIndex
+from lifecycle import IndexLifecycle
+from mapping import INDEX_GROUPS, index_template
+from retry import Backoff, is_retryable
+from shipper import BulkShipper, ChunkSizeController
+from spool import SEGMENT_SUFFIX
+
+
+FORMATS = ("tango", "alarms", "spool")
+
+TANGO_EVENT_END = "</log4j:event>"
+TANGO_EVENT = re.compile(r"<log4j:event\s([^>]*)>(.*?)" + TANGO_EVENT_END,
+                         re.S)
+TANGO_ATTRIBUTE = re.compile(r'(\w+)="([^"]*)"')
+TANGO_MESSAGE = re.compile(r"<log4j:message>(.*?)</log4j:message>", re.S)
+TANGO_NDC = re.compile(r"<log4j:NDC>(.*?)</log4j:NDC>", re.S)
+CDATA = re.compile(r"^<!\[CDATA\[(.*)\]\]>$", re.S)
+
+
+def detect_format(path):
+    "Guess the format of a file from its name and first bytes"
+    if path.endswith(SEGMENT_SUFFIX):
+        return "spool"
+    with open(path, "rb") as f:
+        start = f.read(256).lstrip()
+    if start.startswith("<"):
+        return "tango"
+    if start.startswith('{"index"'):
+        return "spool"
+    return "alarms"
+
+
+def _block_end(data, fmt):
+    "Where the last complete event in a piece of a file ends"
+    if fmt == "tango":
+        end = data.rfind(TANGO_EVENT_END)
+        return end + len(TANGO_EVENT_END) if end >= 0 else 0
+    end = data.rfind("\n") + 1
+    if fmt == "spool" and data.count("\n", 0, end) % 2:
+        # events take two lines; the action and the source
+        end = data.rfind("\n", 0, end - 1) + 1
+    return end
+
+
+def read_blocks(f, fmt, block_size=1024 * 1024):
+    """Read a file from its current position, in blocks of about
+    *block_size* bytes, each ending with a complete event. Yields the
+    blocks, and the file position just after each of them. Whatever is
+    left at the end of the file also makes a block."""
+    offset = f.tell()
+    rest = ""
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+        data = rest + data
+        end = _block_end(data, fmt)
+        if not end:
+            rest = data  # an unusually large event
+            continue
+        block, rest = data[:end], data[end:]
+        offset += len(block)
+        yield block, offset
+    if rest:
+        yield rest, offset + len(rest)
+
+
+def _text(element):
+    "The text of an XML element, CDATA or not"
+    match = CDATA.match(element.strip())
+    return match.group(1) if match else unescape(element, {"&quot;": '"'})
+
+
+def parse_tango(block):
+    """Parse log events from a Tango file logging target. Returns the
+    events in the form taken by the Log command, and the number of
+    events that could not be parsed."""
+    events = []
+    n_bad = 0
+    for attributes, body in TANGO_EVENT.findall(block):
+        attributes = dict((name, unescape(value, {"&quot;": '"'}))
+                          for name, value in
+                          TANGO_ATTRIBUTE.findall(attributes))
+        message = TANGO_MESSAGE.search(body)
+        ndc = TANGO_NDC.search(body)
+        try:
+            events.append([attributes["timestamp"], attributes["level"],
+                           attributes["logger"],
+                           _text(message.group(1)) if message else "",
+                           _text(ndc.group(1)) if ndc else "",
+                           attributes.get("thread", "")])
+        except KeyError:
+            n_bad += 1
+    return events, n_bad
+
+
+# the builder used by each worker process; see _start_worker
+_builder = None
+
+
+def _start_worker(prefix, id_strategy, rollover):
+    global _builder
+    index_class = RolloverIndex if rollover else DailyIndex
+    _builder = DocumentBuilder(
+        dict((group, index_class(prefix, group)) for group in INDEX_GROUPS),
+        id_maker(id_strategy))
+
+
+def build_documents(fmt, block):
+    """Turn a block of a file into encoded documents. Runs in the worker
+    processes. Returns the documents as (type, index, id, action, data)
+    tuples, since those are quick to pass between processes, and the
+    number of events that could not be used."""
+    docs = []
+    if fmt == "tango":
+        events, n_bad = parse_tango(block)
+        for event in events:
+            docs.append(_builder.log(log_source(event)))
+    elif fmt == "alarms":
+        n_bad = 0
+        for source in split_alarm_batch(block):
+            try:
+                docs.append(_builder.alarm(alarm_source(source)))
+            except (TypeError, KeyError, AttributeError):
+                n_bad += 1  # including lines that are not JSON
+    else:
+        n_bad = 0
+        lines = block.splitlines()
+        for action, data in zip(lines[::2], lines[1::2]):
+            try:
+                docs.append(Document.from_lines(action, data))
+            except (ValueError, KeyError):
+                n_bad += 1
+    return [(doc.type, doc.index, doc.id, doc.action, doc.data)
+            for doc in docs], n_bad
+
+
+class Checkpoints(object):
+
+    """
+    How far into each file the import has got, kept in a JSON file.
+    It's written to a new file which then replaces the old one, so that
+    it's never left half written.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.offsets = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.offsets = json.load(f)
+
+    def get(self, filename):
+        "Where to start reading a file"
+        filename = os.path.abspath(filename)
+        offset = self.offsets.get(filename, 0)
+        if offset > os.path.getsize(filename):
+            return 0  # not the same file anymore
+        return offset
+
+    def set(self, filename, offset):
+        self.offsets[os.path.abspath(filename)] = offset
+        if self.path:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self.offsets, f, indent=1)
+            os.rename(self.path + ".tmp", self.path)
+
+
+class Importer(object):
+
+    """
+    Imports files into ES. Events that ES refuses because it's busy are
+    sent again, after a while, up to *max_retries* times; if they still
+    can't be sent, the import stops (and can be continued later). Events
+    that ES will never take are counted and reported, but not retried.
+    """
+
+    def __init__(self, es, prefix="tango", id_strategy="hash",
+                 rollover=False, checkpoints=None, processes=None,
+                 block_size=1024 * 1024, chunk_size=1000, bulk_workers=1,
+                 max_retries=5, report=None):
+        self.es = es
+        self.prefix = prefix
+        self.rollover = rollover
+        self.checkpoints = checkpoints or Checkpoints()
+        self.block_size = block_size
+        self.shipper = BulkShipper(es, ChunkSizeController(chunk_size),
+                                   max_chunk_bytes=10 * 1024 * 1024,
+                                   workers=bulk_workers)
+        self.max_retries = max_retries
+        self.report = report or (lambda message: None)
+        self.n_events = 0
+        self.n_bad = 0
+        self.n_refused = 0
+        self.processes = processes or cpu_count()
+        worker_args = (prefix, id_strategy, rollover)
+        self._pool = None
+        if self.processes > 1:
+            self._pool = Pool(self.processes, _start_worker, worker_args)
+        else:
+            _start_worker(*worker_args)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+        self.shipper.close()
+
+    def prepare(self):
+        """Make sure ES has our index templates (and write aliases), like
+        the device does before sending anything. Templates already in ES
+        are left alone."""
+        for group in INDEX_GROUPS:
+            name = "%s-%s" % (self.prefix, group)
+            if not self.es.indices.exists_template(name):
+                self.es.indices.put_template(
+                    name, index_template(self.prefix, group))
+            if self.rollover:
+                IndexLifecycle(self.es,
+                               RolloverIndex(self.prefix, group)).bootstrap()
+
+    def _blocks(self, path, fmt):
+        "Parse the blocks of a file, a few at a time; yield the results"
+        with open(path, "rb") as f:
+            f.seek(self.checkpoints.get(path))
+            if self._pool is None:
+                for block, offset in read_blocks(f, fmt, self.block_size):
+                    yield build_documents(fmt, block), offset
+                return
+            pending = deque()
+            for block, offset in read_blocks(f, fmt, self.block_size):
+                pending.append((self._pool.apply_async(
+                    build_documents, (fmt, block)), offset))
+                # enough to keep all processes busy, but no more
+                if len(pending) > 2 * self.processes:
+                    result, offset = pending.popleft()
+                    yield result.get(), offset
+            for result, offset in pending:
+                yield result.get(), offset
+
+    def import_file(self, path, fmt=None):
+        "Send all the (remaining) events in a file to ES"
+        fmt = fmt or detect_format(path)
+        for (encoded, n_bad), offset in self._blocks(path, fmt):
+            docs = []
+            for doc_type, index, doc_id, action, data in encoded:
+                doc = Document(doc_type, index, doc_id, None)
+                doc.action, doc.data = action, data
+                docs.append(doc)
+            self._send(docs)
+            self.n_events += len(docs)
+            self.n_bad += n_bad
+            self.checkpoints.set(path, offset)
+
+    def _send(self, docs):
+        "Send documents, retrying the ones ES is too busy to take"
+        backoff = Backoff()
+        while docs:
+            unsent = []
+            for doc, ok, item in self.shipper.ship(docs):
+                if ok:
+                    continue
+                info = item.values()[0]
+                if is_retryable(info):
+                    unsent.append(doc)
+                else:
+                    self.n_refused += 1
+                    self.report("ES refused event %s: %s"
+                                % (doc.id, info.get("error")))
+            if unsent and backoff.failures >= self.max_retries:
+                raise TransportError(
+                    "N/A", "Gave up on %d events after %d tries"
+                    % (len(unsent), backoff.failures + 1))
+            if unsent:
+                time.sleep(backoff.failed())
+            docs = unsent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("files", nargs="+", metavar="FILE")
+    parser.add_argument("--es", action="append",
+                        help="ES node address (default localhost); may "
+                        "be given several times")
+    parser.add_argument("--prefix", default="tango",
+                        help="prefix for the ES index names")
+    parser.add_argument("--format", choices=FORMATS,
+                        help="kind of files (default: guess)")
+    parser.add_argument("--ids", choices=ID_STRATEGIES, default="hash",
+                        help="how to pick document IDs (see the "
+                        "DocumentIdStrategy property)")
+    parser.add_argument("--rollover", action="store_true",
+                        help="send events to the write aliases, for a "
+                        "device using rollover indices")
+    parser.add_argument("--checkpoint",
+                        help="file keeping track of how far the import "
+                        "has got, to continue from")
+    parser.add_argument("--processes", type=int, default=cpu_count(),
+                        help="number of processes parsing events")
+    parser.add_argument("--block-size", type=int, default=1024 * 1024,
+                        help="bytes of a file to parse at a time")
+    parser.add_argument("--chunk-size", type=int, default=1000,
+                        help="events per bulk request")
+    parser.add_argument("--bulk-workers", type=int, default=1,
+                        help="bulk requests to send in parallel")
+    args = parser.parse_args()
+
+    def report(message):
+        sys.stderr.write(message + "\n")
+
+    es = Elasticsearch(args.es or ["localhost"],
+                       maxsize=args.bulk_workers, retry_on_timeout=True)
+    importer = Importer(es, args.prefix, args.ids, args.rollover,
+                        Checkpoints(args.checkpoint), args.processes,
+                        args.block_size, args.chunk_size,
+                        args.bulk_workers, report=report)
+    t0 = time.time()
+    try:
+        importer.prepare()
+        for path in args.files:
+            n_before = importer.n_events
+            importer.import_file(path, args.format)
+            report("%s: %d events" % (path, importer.n_events - n_before))
+    except (TransportError, IOError, KeyboardInterrupt) as e:
+        report("Import stopped: %r" % e)
+        sys.exit(1)
+    finally:
+        elapsed = time.time() - t0
+        report("Imported %d events in %.1f s (%.0f events/s); %d could not "
+               "be parsed, %d were refused by ES"
+               % (importer.n_events, elapsed,
+                  importer.n_events / max(elapsed, 1e-3),
+                  importer.n_bad, importer.n_refused))
+        importer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+The in-memory buffer of events waiting to be pushed to ES. It is
+bounded both by number of events and by their total (encoded) size, so
+that the memory used stays predictable even if some events are huge.
+
+When the buffer fills up, the least important events go first: each
+level can be given a watermark (a fill ratio) above which events of that
+level are dropped, or only sampled. And when the buffer is full, a new
+event pushes out an older one of a lower level, if there is any.
+
+Pushing takes out everything buffered in one go, and puts back what
+could not be sent; both without going through the events one by one,
+so that the buffer is locked only briefly however many events it holds.
+"""
+
+from collections import deque
+from itertools import chain
+import threading
+
+from events import LEVELS
+
+
+class Batch(object):
+
+    """
+    Events taken out of the buffer; a sequence of segments (lists or
+    deques of events) that are iterated over in order, without copying.
+    """
+
+    def __init__(self, segments, nbytes):
+        self.segments = [segment for segment in segments if segment]
+        self.nbytes = nbytes  # total encoded size
+        self._len = sum(len(segment) for segment in self.segments)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return chain.from_iterable(self.segments)
+
+
+class EventBuffer(object):
+
+    """
+    A thread safe buffer of encoded Documents, holding at most
+    *max_events* events and, unless *max_bytes* is 0, at most *max_bytes*
+    bytes of encoded events. Putting events never blocks.
+
+    *watermarks* maps level ranks (see events.LEVELS) to fill ratios
+    (0-1); while the buffer is filled beyond the ratio, events of that
+    level are shed. If *sample_every* is N > 0, one in N of the shed
+    events is still kept.
+
+    Events are stored in one FIFO per level, so that finding something
+    to shed or push out is cheap regardless of the buffer size. They come
+    out most important level first, after any events that were put back.
+    """
+
+    def __init__(self, max_events, max_bytes=0, watermarks=None,
+                 sample_every=0):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.watermarks = watermarks or {}
+        self.sample_every = sample_every
+        self.dropped = [0] * len(LEVELS)  # per level
+        self._shed_seen = [0] * len(LEVELS)
+        self._levels = [deque() for _ in LEVELS]
+        self._requeued = deque()  # segments of events that were put back
+        self._len = 0
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def nbytes(self):
+        "Total encoded size of the buffered events"
+        return self._nbytes
+
+    def empty(self):
+        return not self._len
+
+    def fill(self):
+        "How full the buffer is, as a ratio (0-1)"
+        fill = float(self._len) / self.max_events if self.max_events else 0
+        if self.max_bytes:
+            fill = max(fill, float(self._nbytes) / self.max_bytes)
+        return fill
+
+    def _fits(self, size):
+        return (self._len < self.max_events and
+                (not self.max_bytes or self._nbytes + size <= self.max_bytes))
+
+    def _shed(self, rank):
+        "Decide whether to shed an event of the given level"
+        watermark = self.watermarks.get(rank)
+        if watermark is None or self.fill() < watermark:
+            return False
+        seen = self._shed_seen[rank]
+        self._shed_seen[rank] = seen + 1
+        return not self.sample_every or seen % self.sample_every != 0
+
+    def _evict_below(self, rank):
+        "Remove the oldest event of the lowest level below *rank*, if any"
+        for level in self._levels[:rank]:
+            if level:
+                doc = level.popleft()
+                self._len -= 1
+                self._nbytes -= doc.nbytes
+                return doc
+        return None
+
+    def put_many(self, docs):
+        """Add events. Returns (kept, shed, overflow); the number of the
+        given events that were kept, the number that were dropped because
+        of the watermarks, and a list of events that there was no room
+        for (given ones as well as older ones that were pushed out)."""
+        kept = shed = 0
+        overflow = []
+        with self._lock:
+            for doc in docs:
+                rank = doc.rank
+                if self._shed(rank):
+                    self.dropped[rank] += 1
+                    shed += 1
+                    continue
+                size = doc.nbytes
+                if self.max_bytes and size > self.max_bytes:
+                    # would never fit; don't push anything out for it
+                    overflow.append(doc)
+                    continue
+                while not self._fits(size):
+                    evicted = self._evict_below(rank)
+                    if evicted is None:
+                        break
+                    overflow.append(evicted)
+                if self._fits(size):
+                    self._levels[rank].append(doc)
+                    self._len += 1
+                    self._nbytes += size
+                    kept += 1
+                else:
+                    overflow.append(doc)
+        return kept, shed, overflow
+
+    def requeue(self, docs):
+        """Put a list (or Batch) of events back at the front, e.g. because
+        they could not be sent. They are kept as they are, in one piece,
+        and can't be pushed out by other events. Return a list of those
+        that didn't fit; the first ones, if not all do."""
+        if not docs:
+            return []
+        if isinstance(docs, Batch):
+            nbytes = docs.nbytes
+        else:
+            nbytes = sum(doc.nbytes for doc in docs)
+        with self._lock:
+            if not self._fits_all(len(docs), nbytes):
+                # keep as many of the latest ones as there is room for
+                docs = list(docs)
+                sizes = [doc.nbytes for doc in docs]
+                n = 0
+                room = self.max_bytes - self._nbytes
+                while (n < len(docs) and self._len + n < self.max_events and
+                       (not self.max_bytes or sizes[-1 - n] <= room)):
+                    room -= sizes[-1 - n]
+                    n += 1
+                rejected = docs[:len(docs) - n]
+                docs = docs[len(docs) - n:]
+                nbytes = sum(sizes[len(sizes) - n:])
+            else:
+                rejected = []
+            if docs:
+                self._requeued.appendleft(docs)
+                self._len += len(docs)
+                self._nbytes += nbytes
+        return rejected
+
+    def _fits_all(self, n, nbytes):
+        if self._len + n > self.max_events:
+            return False
+        return not self.max_bytes or self._nbytes + nbytes <= self.max_bytes
+
+    def count_dropped(self, docs):
+        "Keep track of events that were dropped by someone else"
+        with self._lock:
+            for doc in docs:
+                self.dropped[doc.rank] += 1
+
+    def drain(self):
+        "Remove and return all buffered events, as a Batch"
+        with self._lock:
+            levels, requeued = self._levels, self._requeued
+            nbytes = self._nbytes
+            self._levels = [deque() for _ in LEVELS]
+            self._requeued = deque()
+            self._len = self._nbytes = 0
+        return Batch(chain(requeued, reversed(levels)), nbytes)
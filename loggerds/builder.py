@@ -0,0 +1,51 @@
+"""
+Making Documents, ready to be sent to ES, out of event sources (see
+events). This is shared by the device and the backfill importer, so
+that events end up the same way in ES whichever way they came.
+"""
+
+from document import Document
+from events import level_rank, priority_rank
+from profiling import span
+
+
+class DocumentBuilder(object):
+
+    """
+    Wraps event sources in the metadata ES needs; the index, from
+    *indices* (a DailyIndex or RolloverIndex per group), and the ID,
+    picked by *make_id* (see ids). The documents are encoded right away.
+    """
+
+    def __init__(self, indices, make_id):
+        self.indices = indices
+        self.make_id = make_id
+
+    def _get_index(self, group, timestamp=None):
+        """
+        Generate a date based index name for elasticsearch, on the form
+        '<prefix>-<group>-YYYY.MM.DD'. This is used by Kibana and should
+        also make it easy to prune old data. The date is taken from the
+        event timestamp if given, otherwise it's today's date. With
+        rollover, it's the write alias '<prefix>-<group>' instead.
+        """
+        with span("_get_index"):
+            return self.indices[group].get(timestamp)
+
+    def log(self, source):
+        "Make a document out of a log event source"
+        doc = Document("log", self._get_index("logs", source["@timestamp"]),
+                       None, source, rank=level_rank(source["level"]))
+        doc.id = self.make_id(doc)
+        doc.encode()
+        return doc
+
+    def alarm(self, source):
+        "Make a document out of an alarm event source"
+        timestamp = source["@timestamp"]
+        doc = Document("alarm", self._get_index("alarms", timestamp),
+                       None, source, timestamp=timestamp,
+                       rank=priority_rank(source["priority"]))
+        doc.id = self.make_id(doc)
+        doc.encode()
+        return doc
@@ -0,0 +1,159 @@
+"""
+Client side helper for sending events to a Logger device in batches,
+using the LogBatch and AlarmBatch commands. This saves one round trip
+per event, which matters a lot for chatty clients.
+
+Example:
+
+    batcher = LogBatcher("sys/logger/1")
+    batcher.log(timestamp, "INFO", "my/device/1", "Hello")
+    ...
+    batcher.close()  # sends anything still pending
+"""
+
+import json
+import threading
+import time
+
+import PyTango
+
+
+class LogBatcher(object):
+
+    """
+    Collects log and alarm events and sends them to the Logger device
+    whenever *max_events* have accumulated, or at the latest *max_delay*
+    seconds after the first pending event arrived.
+
+    Events that could not be sent are put back, to be sent again along
+    with the next batch. At most *max_pending* events are kept; beyond
+    that the oldest are dropped, and counted in *dropped*.
+    """
+
+    def __init__(self, logger, max_events=500, max_delay=1.0,
+                 max_pending=10000):
+        if isinstance(logger, basestring):
+            logger = PyTango.DeviceProxy(logger)
+        self.proxy = logger
+        self.max_events = max_events
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.last_error = None
+        self.dropped = 0
+        self._logs = []  # flattened log event fields
+        self._alarms = []  # JSON encoded alarm events
+        self._deadline = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="LogBatcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def log(self, timestamp, level, device, message, ndc="", thread=""):
+        "Queue a log event; same arguments as the Log command"
+        fields = [str(timestamp), level, device, message, str(ndc),
+                  str(thread)]
+        with self._lock:
+            self._logs.extend(fields)
+            self._added()
+
+    def alarm(self, event):
+        "Queue an alarm event, given as a dict or as a JSON string"
+        if not isinstance(event, basestring):
+            event = json.dumps(event)
+        with self._lock:
+            self._alarms.append(event)
+            self._added()
+
+    def _added(self):
+        # must be called with the lock held
+        if self._deadline is None:
+            # the thread may be waiting without a deadline
+            self._deadline = time.time() + self.max_delay
+            self._wakeup.notify()
+        if self._pending() >= self.max_events:
+            self._deadline = 0
+            self._wakeup.notify()
+
+    def _pending(self):
+        return len(self._logs) // 6 + len(self._alarms)
+
+    def _take(self):
+        # must be called with the lock held
+        logs, self._logs = self._logs, []
+        alarms, self._alarms = self._alarms, []
+        self._deadline = None
+        return logs, alarms
+
+    def _put_back(self, logs, alarms):
+        "Return events that could not be sent to the front of the queue"
+        with self._lock:
+            self._logs[:0] = logs
+            self._alarms[:0] = alarms
+            excess = self._pending() - self.max_pending
+            if excess > 0:
+                # oldest first; logs, then alarms
+                n_logs = min(excess, len(self._logs) // 6)
+                del self._logs[:n_logs * 6]
+                del self._alarms[:excess - n_logs]
+                self.dropped += excess
+            if self._pending() and self._deadline is None:
+                self._deadline = time.time() + self.max_delay
+                self._wakeup.notify()
+
+    def _send(self, logs, alarms):
+        """Send events; any that could not be sent are put back before
+        the error is raised"""
+        try:
+            if logs:
+                self.proxy.command_inout("LogBatch", logs)
+                logs = []
+            if alarms:
+                self.proxy.command_inout("AlarmBatch", "\n".join(alarms))
+        except PyTango.DevFailed:
+            self._put_back(logs, alarms)
+            raise
+
+    def flush(self):
+        """Send all pending events right away. Raises DevFailed if they
+        could not be sent; they are then kept for the next try."""
+        with self._lock:
+            logs, alarms = self._take()
+        self._send(logs, alarms)
+
+    def close(self):
+        "Stop the background thread and send anything still pending"
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._closed:
+                    if self._deadline is not None:
+                        timeout = self._deadline - time.time()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._wakeup.wait(timeout)
+                if self._closed:
+                    return
+                logs, alarms = self._take()
+            try:
+                self._send(logs, alarms)
+            except PyTango.DevFailed as e:
+                # nobody to report to from here; keep it around instead.
+                # The events are retried after max_delay.
+                self.last_error = e
@@ -0,0 +1,122 @@
+"""
+Collapsing of repeated log messages. A device stuck in a loop may log
+the same message thousands of times per second; instead of storing
+every one, the first is sent as usual and the repeats within a time
+window are summed up into a single document with a count.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+def _millis(timestamp):
+    try:
+        return int(float(timestamp))
+    except (TypeError, ValueError):
+        return timestamp
+
+
+class _Repeats(object):
+
+    "Keeps track of the repeats of one message during a window"
+
+    __slots__ = ("started", "count", "source", "first_seen", "last_seen")
+
+    def __init__(self, started):
+        self.started = started
+        self.count = 0
+        self.source = None
+        self.first_seen = self.last_seen = None
+
+    def add(self, source):
+        timestamp = _millis(source.get("@timestamp"))
+        if not self.count:
+            self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.source = source
+        self.count += 1
+
+    def summary(self):
+        "A log event source standing in for all the repeats, if any"
+        if not self.count:
+            return None
+        source = dict(self.source)
+        source["@timestamp"] = source["first_seen"] = self.first_seen
+        source["last_seen"] = self.last_seen
+        source["count"] = self.count
+        return source
+
+
+class LogDeduplicator(object):
+
+    """
+    Passes on log event sources, except for repeats of the same (device,
+    level, message) within *window* seconds of the first one. When the
+    window is over, the repeats come out as one event source with the
+    fields "count", "first_seen" and "last_seen". At most *max_keys*
+    messages are tracked; when more turn up, the least recently seen one
+    is summed up early.
+    """
+
+    def __init__(self, window, max_keys=1000, clock=time.time):
+        self.window = window
+        self.max_keys = max_keys
+        self.clock = clock
+        self.n_suppressed = 0
+        self._active = OrderedDict()  # in order of last use
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._active)
+
+    def add(self, source):
+        """Take a log event source and return a list of sources to send
+        right away; possibly the given one, and possibly summaries of
+        earlier repeats."""
+        key = (source.get("device"), source.get("level"),
+               source.get("message"))
+        now = self.clock()
+        out = []
+        with self._lock:
+            repeats = self._active.pop(key, None)
+            if repeats is not None and now - repeats.started >= self.window:
+                self._summarize(repeats, out)
+                repeats = None
+            if repeats is None:
+                repeats = _Repeats(now)
+                source["count"] = 1
+                out.append(source)
+                if len(self._active) >= self.max_keys:
+                    _, oldest = self._active.popitem(last=False)
+                    self._summarize(oldest, out)
+            else:
+                repeats.add(source)
+                self.n_suppressed += 1
+            self._active[key] = repeats  # (re)insert as most recent
+        return out
+
+    def _summarize(self, repeats, out):
+        summary = repeats.summary()
+        if summary is not None:
+            out.append(summary)
+
+    def expire(self):
+        "Return summaries for all windows that are over"
+        now = self.clock()
+        out = []
+        with self._lock:
+            for key, repeats in self._active.items():
+                if now - repeats.started >= self.window:
+                    del self._active[key]
+                    self._summarize(repeats, out)
+        return out
+
+    def flush(self):
+        "Return summaries for everything, e.g. when shutting down"
+        out = []
+        with self._lock:
+            for repeats in self._active.values():
+                self._summarize(repeats, out)
+            self._active.clear()
+        return out
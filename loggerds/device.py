@@ -1,34 +1,43 @@
 import calendar
 from datetime import datetime
+from functools import partial
 import json
+import threading
 import time
 from uuid import uuid4
-from Queue import Queue, Full
 
-from elasticsearch import Elasticsearch, helpers
-from elasticsearch import ConnectionError
+from elasticsearch import Elasticsearch
+from elasticsearch import ConnectionError, ConnectionTimeout
+from elasticsearch import NotFoundError, TransportError
 from PyTango.server import run, Device, DeviceMeta, command, device_property
+from PyTango.server import attribute
 from PyTango import DevState
 import PyTango
 
-from mapping import es_mappings
+from buffer import EventBuffer
+from builder import DocumentBuilder
+from dedup import LogDeduplicator
+from flusher import Flusher
+from ids import ID_STRATEGIES, id_maker
+from indices import DailyIndex, RolloverIndex
+from lanes import Lane
+from lifecycle import IndexLifecycle
+from mapping import (INDEX_GROUPS, TEMPLATE_VERSION, index_template,
+                     template_version)
+from metrics import RateMeter, RollingPercentiles
+from profiling import PROFILER, span, summary
+from recent import RecentEvents
+from retry import Backoff, DeadLetters, is_retryable
+from shipper import BulkShipper, ChunkSizeController
+from spool import Spool, SpoolFull
+from transport import CompressedHttpConnection
+from events import (LEVELS, LEVEL_RANKS, level_rank,
+                    log_source, alarm_source, timestamp_millis,
+                    split_log_batch, split_alarm_batch)
 
-
-EVENT_MEMBERS = ["@timestamp", "level", "device", "message", "ndc", "thread"]
-ALARM_PRIORITIES = {"ALARM": 400, "ERROR": 400, "WARNING": 300,
-                    "INFO": 200, "DEBUG": 100}
-
-
-def stringify_values(values):
-    """In order to fit well in ES, fields should have a consistent type.
-    Therefore we'll convert attribute values strings before sending
-    them, regardless of type. This is a bit crude, but in principle no
-    data should be lost (except possibly some precision)."""
-    # TODO: try to find a way to not have to do this...
-    return [{"attribute": value["attribute"],
-             "value": str(value["value"]),
-             "type": type(value["value"]).__name__}
-            for value in values]
+# how long to wait for the health and maintenance threads to stop; they
+# are daemons, so one stuck in a slow ES request is left to finish alone
+BACKGROUND_STOP_TIMEOUT = 10  # s
 
 
 def get_utc_now():
@@ -36,6 +45,12 @@ def get_utc_now():
     return calendar.timegm(datetime.utcnow().utctimetuple())
 
 
+def _unreachable(error):
+    "Whether a failed bulk request never got to ES (timeouts may have)"
+    return (isinstance(error, ConnectionError) and
+            not isinstance(error, ConnectionTimeout))
+
+
 class Logger(Device):
 
     """
@@ -50,45 +65,382 @@ class Logger(Device):
     __metaclass__ = DeviceMeta
 
     ElasticsearchHost = device_property(
-        dtype=str, default_value="localhost",
-        doc="Address of the Elasticsearch host")
+        dtype=[str], default_value=["localhost"],
+        doc=("Addresses of Elasticsearch nodes (host or host:port), one "
+             "per line or comma separated. Requests are spread over them."))
+    ElasticsearchSniffPeriod = device_property(
+        dtype=float, default_value=0.0,
+        doc=("Seconds between asking ES about the nodes in the cluster, "
+             "to use them too. Also done when a node fails. 0 means no "
+             "sniffing; only the configured nodes are used."))
+    ElasticsearchDeadTimeout = device_property(
+        dtype=float, default_value=10.0,
+        doc=("Seconds to wait before trying a failed node again. Doubles "
+             "for each consecutive failure."))
+    HealthCheckPeriod = device_property(
+        dtype=float, default_value=5.0,
+        doc=("Seconds between checks that ES is reachable, done in the "
+             "background. 0 means checking before every push instead."))
     ElasticsearchIndexPrefix = device_property(
         dtype=str, default_value="tango",
         doc="Prefix for the ES index names")
+    IndexShards = device_property(
+        dtype=int, default_value=1,
+        doc="Number of primary shards for new indices.")
+    IndexReplicas = device_property(
+        dtype=int, default_value=1,
+        doc="Number of replicas for new indices.")
+    IndexRefreshInterval = device_property(
+        dtype=str, default_value="5s",
+        doc=("How often ES makes new events searchable, e.g. '5s'. Longer "
+             "means more efficient indexing."))
+    RolloverMaxDocs = device_property(
+        dtype=int, default_value=0,
+        doc=("Start a new index when the current one has this many "
+             "events. 0 means no limit. With a limit here or in "
+             "RolloverMaxBytes, events go to a write alias instead of "
+             "daily indices."))
+    RolloverMaxBytes = device_property(
+        dtype=int, default_value=0,
+        doc=("Start a new index when the current one is this large, in "
+             "bytes (primary shards only). 0 means no limit."))
+    LogRetentionDays = device_property(
+        dtype=float, default_value=0,
+        doc=("Delete log indices this many days after they were last "
+             "written to. 0 means keeping them forever."))
+    AlarmRetentionDays = device_property(
+        dtype=float, default_value=0,
+        doc=("Delete alarm indices this many days after they were last "
+             "written to. 0 means keeping them forever."))
+    IndexForceMerge = device_property(
+        dtype=bool, default_value=False,
+        doc=("Merge indices that are no longer written to down to one "
+             "segment per shard."))
+    IndexMaintenancePeriod = device_property(
+        dtype=float, default_value=300.0,
+        doc=("Seconds between checks for rollover, retention and "
+             "merging, done in the background. 0 turns them off."))
     QueueSize = device_property(
         dtype=int, default_value=10000,
-        doc="The maximum number of events to buffer.")
+        doc="The maximum number of log events to buffer.")
+    QueueMaxBytes = device_property(
+        dtype=int, default_value=64 * 1024 * 1024,
+        doc=("The maximum total size in bytes of buffered events (JSON "
+             "encoded), for logs and alarms each. 0 means no limit."))
+    AlarmQueueSize = device_property(
+        dtype=int, default_value=10000,
+        doc="The maximum number of alarm events to buffer.")
+    ShedWatermarks = device_property(
+        dtype=[str], default_value=[],
+        doc=("Lines on the form LEVEL:ratio, e.g. DEBUG:0.5. When the "
+             "queue is fuller than the ratio, new events of that level "
+             "are dropped. Alarms are ranked by priority."))
+    ShedSampleEvery = device_property(
+        dtype=int, default_value=0,
+        doc=("Keep one in this many of the events that would be dropped "
+             "by ShedWatermarks. 0 means drop them all."))
+    DedupWindow = device_property(
+        dtype=float, default_value=0.0,
+        doc=("Collapse repeats of the same log message from the same "
+             "device within this many seconds into one event with a "
+             "count. 0 means no collapsing."))
+    DedupMaxKeys = device_property(
+        dtype=int, default_value=1000,
+        doc="Max number of different log messages to collapse at a time.")
+    DocumentIdStrategy = device_property(
+        dtype=str, default_value="uuid4",
+        doc=("How to pick the ES ID of each event; 'uuid4' (random), "
+             "'auto' (made up by ES), 'timeorder' (starting with the "
+             "time) or 'hash' (of the event contents)."))
+    RecentEventsSize = device_property(
+        dtype=int, default_value=10000,
+        doc=("Number of recent events to keep in memory for the "
+             "GetRecent command. 0 turns this off."))
+    RecentEventsMaxBytes = device_property(
+        dtype=int, default_value=16 * 1024 * 1024,
+        doc=("The maximum total size in bytes of the recent events kept "
+             "(JSON encoded). 0 means no limit."))
     PushPeriod = device_property(
         dtype=int, default_value=10,
-        doc="Number of seconds of sleep between emptying the queue into ES.")
+        doc=("Max number of seconds between emptying the log queue into "
+             "ES. Set to 0 to only push (logs and alarms) on the "
+             "PushQueuedEventsToES command."))
+    PushBatchSize = device_property(
+        dtype=int, default_value=1000,
+        doc="Push to ES as soon as this many log events have been queued.")
+    AlarmPushPeriod = device_property(
+        dtype=float, default_value=1.0,
+        doc="Max number of seconds between emptying the alarm queue into ES.")
+    AlarmPushBatchSize = device_property(
+        dtype=int, default_value=1,
+        doc=("Push to ES as soon as this many alarm events have been "
+             "queued. The default, 1, means right away."))
+    BulkWorkers = device_property(
+        dtype=int, default_value=1,
+        doc="Number of bulk requests to ES that may run in parallel.")
+    BulkChunkSize = device_property(
+        dtype=int, default_value=500,
+        doc=("Number of events to send to ES in one bulk request. If "
+             "BulkTargetLatency is set, this is only the starting point."))
+    BulkMaxChunkSize = device_property(
+        dtype=int, default_value=5000,
+        doc="Max number of events to send to ES in one bulk request.")
+    BulkTargetLatency = device_property(
+        dtype=float, default_value=1.0,
+        doc=("Adjust the number of events per bulk request, aiming for "
+             "requests to take this many seconds. 0 means no adjustment."))
+    BulkCompression = device_property(
+        dtype=bool, default_value=False,
+        doc="Send gzip compressed requests to ES.")
+    BulkChunkBytes = device_property(
+        dtype=int, default_value=10 * 1024 * 1024,
+        doc="Max size in bytes of one bulk request to ES.")
+    BulkMaxRetries = device_property(
+        dtype=int, default_value=5,
+        doc=("How many times to retry sending an event that ES refused "
+             "because it was overloaded, or that was part of a failed "
+             "bulk request, before giving up on it."))
+    RetryBackoff = device_property(
+        dtype=float, default_value=1.0,
+        doc=("Seconds to wait before pushing again after ES refused "
+             "events. Doubles after each consecutive failure."))
+    RetryBackoffMax = device_property(
+        dtype=float, default_value=60.0,
+        doc="Max number of seconds to wait before pushing again.")
+    DeadLetterSize = device_property(
+        dtype=int, default_value=1000,
+        doc="Number of permanently refused events to keep for inspection.")
+    SpoolDirectory = device_property(
+        dtype=str, default_value="",
+        doc=("Directory where events are stored while ES can't take them. "
+             "If empty, no spooling is done."))
+    SpoolSegmentSize = device_property(
+        dtype=int, default_value=16 * 1024 * 1024,
+        doc="Size in bytes of each spool file.")
+    SpoolFsync = device_property(
+        dtype=str, default_value="segment",
+        doc=("When to force spooled data to disk; 'always' (after every "
+             "write), 'segment' (when a spool file is full) or 'never'."))
+    SpoolMaxBytes = device_property(
+        dtype=int, default_value=0,
+        doc="Max total size of the spool in bytes, 0 means no limit.")
 
     def init_device(self):
 
+        self._stop_flusher()
         self.set_state(DevState.INIT)
 
         self._status = {}  # keep status info for various things
+        self._status_lock = threading.Lock()  # see _count
         self._status["n_total_events"] = 0
         self._status["n_logged_events"] = 0
         self._status["thread_restarts"] = 0
         self._status["n_errors"] = 0
         self._status["bad_events"] = 0
+        self._status["n_retries"] = 0
+        self._status["n_bytes_shipped"] = 0
+
+        # measurements exposed as attributes
+        self._ingest_rates = dict((doc_type, RateMeter())
+                                  for doc_type in ("log", "alarm"))
+        self._flush_times = RollingPercentiles()
+        self._last_push = time.time()  # counting from the start
 
         self.get_device_properties()
 
         # ES setup
-        self.es = Elasticsearch(self.ElasticsearchHost)
+        hosts = self._parse_hosts(self.ElasticsearchHost)
+        es_options = {
+            "maxsize": max(1, self.BulkWorkers) + 1,  # keep-alive pool
+            # a request to a node that fails is tried on the others, and
+            # the node is left alone for a while
+            "max_retries": max(3, len(hosts)),
+            "dead_timeout": self.ElasticsearchDeadTimeout}
+        if self.BulkCompression:
+            es_options["connection_class"] = CompressedHttpConnection
+        if self.ElasticsearchSniffPeriod > 0:
+            es_options["sniffer_timeout"] = self.ElasticsearchSniffPeriod
+            es_options["sniff_on_connection_fail"] = True
+        self.es = Elasticsearch(hosts, **es_options)
         self._status["es"] = "Not initialised."
         self._status["es_error"] = None
 
-        # internal queue
-        self.queue = Queue(maxsize=self.QueueSize)
-        self._status["queue"] = None
+        # internal queues; one lane per event type, so that alarms are
+        # sent right away, while logs are sent in large batches
+        watermarks = self._parse_watermarks(self.ShedWatermarks)
+        self._bulk_latencies = RollingPercentiles()  # of all the lanes
+        self.lanes = {}
+        for doc_type, size, batch_size, workers in [
+                ("log", self.QueueSize, self.PushBatchSize,
+                 self.BulkWorkers),
+                ("alarm", self.AlarmQueueSize, self.AlarmPushBatchSize, 1)]:
+            self.lanes[doc_type] = Lane(
+                doc_type,
+                EventBuffer(size, self.QueueMaxBytes, watermarks,
+                            self.ShedSampleEvery),
+                BulkShipper(self.es,
+                            ChunkSizeController(
+                                self.BulkChunkSize, self.BulkTargetLatency,
+                                maximum=self.BulkMaxChunkSize),
+                            max_chunk_bytes=self.BulkChunkBytes,
+                            workers=workers,
+                            latencies=self._bulk_latencies),
+                Backoff(self.RetryBackoff, self.RetryBackoffMax),
+                batch_size)
+
+        # collapsing of log storms
+        self._dedup = None
+        if self.DedupWindow > 0:
+            self._dedup = LogDeduplicator(self.DedupWindow,
+                                          self.DedupMaxKeys)
+
+        # short memory of events, for GetRecent
+        self.recent = None
+        if self.RecentEventsSize > 0:
+            self.recent = RecentEvents(self.RecentEventsSize,
+                                       self.RecentEventsMaxBytes)
+
+        # optional disk spool
+        self.spool = None
+        self._status["spool"] = None
+        if self.SpoolDirectory:
+            try:
+                self.spool = Spool(self.SpoolDirectory,
+                                   segment_size=self.SpoolSegmentSize,
+                                   fsync=self.SpoolFsync,
+                                   max_bytes=self.SpoolMaxBytes)
+                self._update_spool_status()
+            except (IOError, OSError, ValueError) as e:
+                self.error_stream("Could not set up spool: %s" % e)
+
+        rollover = self.RolloverMaxDocs > 0 or self.RolloverMaxBytes > 0
+        index_class = RolloverIndex if rollover else DailyIndex
+        self._indices = dict(
+            (group, index_class(self.ElasticsearchIndexPrefix, group))
+            for group in INDEX_GROUPS)
+        self._builder = DocumentBuilder(
+            self._indices, self._id_maker(self.DocumentIdStrategy))
+        retention = {"logs": self.LogRetentionDays,
+                     "alarms": self.AlarmRetentionDays}
+        self._lifecycles = dict(
+            (group, IndexLifecycle(self.es, index,
+                                   max_docs=max(self.RolloverMaxDocs, 0),
+                                   max_bytes=max(self.RolloverMaxBytes, 0),
+                                   retention_days=max(retention[group], 0),
+                                   force_merge=self.IndexForceMerge))
+            for group, index in self._indices.items())
+        self._templates_installed = False
+        # handling of events ES refuses
+        self.dead_letters = DeadLetters(self.DeadLetterSize)
 
-        self.existing_indices = set()
-        # start periodic push to ES
+        # keep an eye on ES in the background
+        self._es_healthy = None  # not known yet
+        self._health = None
+        if self.HealthCheckPeriod > 0:
+            self._health = Flusher(self._check_health, self.HealthCheckPeriod,
+                                   on_error=self._flusher_error,
+                                   name="Health-%s" % self.get_name())
+            self._health.start()
+
+        # look after the indices in the background
+        self._maintenance = None
+        if self.IndexMaintenancePeriod > 0 and (
+                rollover or any(retention.values()) or self.IndexForceMerge):
+            self._maintenance = Flusher(
+                self._maintain_indices, self.IndexMaintenancePeriod,
+                on_error=self._flusher_error,
+                name="Maintenance-%s" % self.get_name())
+            self._maintenance.start()
+
+        # start pushing to ES in the background, a thread per lane
         if self.PushPeriod > 0:
-            self.poll_command("PushQueuedEventsToES",
-                              int(self.PushPeriod * 1000))
+            for lane, period in [(self.lanes["log"], self.PushPeriod),
+                                 (self.lanes["alarm"], self.AlarmPushPeriod)]:
+                lane.flusher = Flusher(
+                    partial(self._push_lane, lane), period,
+                    on_error=self._flusher_error,
+                    name="Flusher-%s-%s" % (lane.name, self.get_name()))
+                lane.flusher.start()
+
+    def _parse_hosts(self, lines):
+        "Get the ES node addresses from the ElasticsearchHost lines"
+        hosts = [host for line in lines
+                 for host in line.replace(",", " ").split()]
+        return hosts or ["localhost"]
+
+    def _parse_watermarks(self, watermarks):
+        "Parse shedding watermarks on the form LEVEL:ratio"
+        parsed = {}
+        for watermark in watermarks:
+            try:
+                level, ratio = watermark.split(":")
+                parsed[LEVEL_RANKS[level.strip().upper()]] = float(ratio)
+            except (ValueError, KeyError):
+                self.error_stream("Bad ShedWatermarks line %r; should be "
+                                  "LEVEL:ratio, e.g. DEBUG:0.5" % watermark)
+        return parsed
+
+    def _id_maker(self, strategy):
+        "Get a function that picks the ES ID for a document"
+        try:
+            return id_maker(strategy)
+        except ValueError:
+            self.error_stream("Bad DocumentIdStrategy %r; should be one of "
+                              "%s. Using uuid4." % (strategy,
+                                                    ", ".join(ID_STRATEGIES)))
+            return id_maker("uuid4")
+
+    def delete_device(self):
+        self._stop_flusher()
+
+    def _stop_flusher(self):
+        "Stop the background threads, if any, and push what's left"
+        for name in ("_health", "_maintenance"):
+            thread = getattr(self, name, None)
+            setattr(self, name, None)
+            if thread is not None:
+                thread.stop(timeout=BACKGROUND_STOP_TIMEOUT)
+        lanes = getattr(self, "lanes", {})
+        for lane in lanes.values():
+            flusher, lane.flusher = lane.flusher, None
+            if flusher is not None:
+                flusher.stop()
+        self._queue_repeats(everything=True)
+        if self._queued_events():
+            self._push_events(force=True)
+        spool = getattr(self, "spool", None)
+        if spool is not None:
+            spool.close()
+        for lane in lanes.values():
+            lane.shipper.close()
+
+    def _count(self, **counts):
+        "Add to the status counters, which several threads update at once"
+        with self._status_lock:
+            for name, n in counts.items():
+                self._status[name] += n
+
+    def _flusher_error(self, e):
+        self._count(n_errors=1)
+        self.error_stream("Unexpected error while pushing events: %r" % e)
+
+    def _check_health(self):
+        "Check on ES, from the health check thread"
+        self._es_healthy = self.check_es_communication()
+
+    def _es_available(self):
+        """Whether ES is worth sending events to, as of the latest health
+        check. Without health checks, or before the first one, ES is
+        pinged right away."""
+        if self._health is None or self._es_healthy is None:
+            self._es_healthy = self.check_es_communication()
+        return self._es_healthy
+
+    def _live_nodes(self):
+        "The number of ES nodes currently in use, and the total number"
+        pool = self.es.transport.connection_pool
+        return (len(pool.connections),
+                len(getattr(pool, "orig_connections", pool.connections)))
 
     def check_es_communication(self):
         "Check that we can still talk to ES properly and update state/status"
@@ -99,8 +451,8 @@ class Logger(Device):
                 if self.get_state() is not DevState.FAULT:
                     self.set_state(DevState.ALARM)
                     self._status["es"] = "Not responding; is it down?"
-                if not self.queue.empty():
-                    self._status["n_errors"] += 1
+                if self._queued_events():
+                    self._count(n_errors=1)
                 self.error_stream("Elasticsearch did not respond to ping")
                 return False
             else:
@@ -112,8 +464,8 @@ class Logger(Device):
             # This means we can't establish connection, perhaps not even lookup
             self.set_state(DevState.FAULT)
             self._status["es"] = "Cannot connect; is the address correct?"
-            if not self.queue.empty():
-                self._status["n_errors"] += 1
+            if self._queued_events():
+                self._count(n_errors=1)
                 self._status["es_error"] = e
             self.error_stream("Elasticsearch connection error: %r" % e)
             # self.update_status()
@@ -125,78 +477,296 @@ class Logger(Device):
             # self.update_status()
             return True
 
-    def _push_events(self):
+    def _push_events(self, force=False):
+        "Push all the lanes, alarms first"
+        for doc_type in ("alarm", "log"):
+            self._push_lane(self.lanes[doc_type], force)
+
+    def _push_lane(self, lane, force=False):
 
         "Check the queue for any arrived events and if any, push them to ES."
 
-        if not self.check_es_communication():
+        with span("flush", profile=True):
+            if lane.name == "log":
+                self._queue_repeats()
+            if lane.backoff.waiting and not force:
+                self.debug_stream("Skipping %s push; backing off after errors"
+                                  % lane.name)
+                return
+            # the flusher thread and the push command may both end up here
+            with lane.lock:
+                self._push_queued_events(lane)
+
+    def _push_queued_events(self, lane):
+        if not self._es_available():
             self.debug_stream(
                 "Skipping push; could not talk to ES (~%d events queued)",
-                self.queue.qsize())
-            return  # no point in trying to send anything
+                len(lane.queue))
+            # no point in trying to send anything, but we can at least
+            # make room in the queue by moving everything to disk
+            if self.spool is not None:
+                self._spool_events(lane.queue.drain())
+            return
 
-        # Check if there's anything on the queue
-        events = []
-        while not self.queue.empty():
-            events.append(self.queue.get(True))
+        # indices are created by ES as needed, from our templates
+        if not self._templates_installed and not self._install_templates():
+            self.debug_stream("Skipping push; no index templates in ES")
+            return
 
+        # anything in the spool is older than what's in the queue. The
+        # log lane takes care of it, so that alarms don't wait for it.
+        if (lane.name == "log" and self.spool is not None and
+                not self._replay_spool(lane)):
+            self._spool_events(lane.queue.drain())
+            return
+
+        events = lane.queue.drain()
         if events:
-            self._status["n_total_events"] += len(events)
-            self._status["queue"] = None
-            # check if the indices exist; otherwise we create them
-            # with the correct mapping. Is there a better way to do
-            # this? Anyway, this should only happen once a day.
-            for event in events:
-                index = event["_index"]
-                if index not in self.existing_indices:
-                    self.existing_indices.add(index)
-                    if not self.es.indices.exists(index):
-                        self.es.indices.create(
-                            index, {"mappings": es_mappings[event["_type"]]})
-                        self.info_stream("Created new index %s" % index)
+            t0 = time.time()
+            self._count(n_total_events=len(events))
+            unsent = self._send_events(events, lane)
+            if unsent:
+                # There was a problem. Let's keep the events for later.
+                if self.spool is not None:
+                    self._spool_events(unsent)
+                else:
+                    self._requeue(unsent, lane)
+            self._flush_times.add(time.time() - t0)
+
+    def _install_templates(self):
+        """Make sure ES has index templates for our indices, so that they
+        get the right mappings and settings when ES creates them. Newer
+        versions of the templates, e.g. from another device, are left
+        alone. With rollover, the write aliases are also set up. Return
+        whether it worked."""
+        prefix = self.ElasticsearchIndexPrefix
+        try:
+            for group in INDEX_GROUPS:
+                name = "%s-%s" % (prefix, group)
+                try:
+                    installed = self.es.indices.get_template(name).get(name)
+                except NotFoundError:
+                    installed = None
+                version = template_version(installed) if installed else 0
+                if version > TEMPLATE_VERSION:
+                    self.warn_stream("Index template %s in ES is newer (v%d) "
+                                     "than ours; leaving it" % (name, version))
+                    continue
+                self.es.indices.put_template(name, index_template(
+                    prefix, group, shards=self.IndexShards,
+                    replicas=self.IndexReplicas,
+                    refresh_interval=self.IndexRefreshInterval))
+                self.info_stream("Installed index template %s (v%d)"
+                                 % (name, TEMPLATE_VERSION))
+            for lifecycle in self._lifecycles.values():
+                if lifecycle.rolls_over:
+                    created = lifecycle.bootstrap()
+                    if created:
+                        self.info_stream("Created index %s" % created)
+        except TransportError as e:
+            self._count(n_errors=1)
+            self._status["es_error"] = e
+            self.error_stream("Could not install index templates: %r" % e)
+            return False
+        self._templates_installed = True
+        return True
+
+    def _maintain_indices(self):
+        "Roll over, delete and merge indices as configured"
+        if not self._templates_installed:
+            return  # nothing to look after yet
+        for group, lifecycle in sorted(self._lifecycles.items()):
             try:
-                # send all the events to ES
-                inserted, errors = helpers.bulk(self.es, events)
-                if errors:
-                    self._status["n_errors"] += len(errors)
-                    self.error_stream(errors)
+                if lifecycle.rolls_over:
+                    created = lifecycle.rollover()
+                    if created:
+                        self.info_stream("Rolled %s over to %s"
+                                         % (group, created))
+                deleted, merged = lifecycle.clean_up()
+            except TransportError as e:
+                self._count(n_errors=1)
+                self.error_stream("Could not look after %s indices: %r"
+                                  % (group, e))
+                continue
+            if deleted:
+                self.info_stream("Deleted expired indices %s"
+                                 % ", ".join(deleted))
+            if merged:
+                self.info_stream("Merged indices %s" % ", ".join(merged))
+
+    def _queued_events(self):
+        "The number of events in all the queues"
+        return sum(len(lane.queue) for lane in getattr(self, "lanes",
+                                                        {}).values())
+
+    def _send_events(self, events, lane):
+        """Send a list of events to ES, through the given lane. Return the
+        events that could not be sent, and should be tried again later."""
+
+        # send all the events to ES, in chunks. Results come back
+        # per chunk, in the same order, as each chunk is done.
+        unsent = []
+        n_retryable = 0
+        n_broken = 0
+        for results in lane.shipper.ship_chunks(events):
+            stored = []
+            n_retries = 0
+            for event, ok, item in results:
+                if ok:
+                    stored.append(event)
+                    continue
+                _, info = item.popitem()
+                if "exception" in info:
+                    # the whole chunk failed. If ES could not be reached
+                    # at all, that's an outage, and doesn't count as a
+                    # try; otherwise (e.g. 413 or 400) it may never work.
+                    n_broken += 1
+                    self._status["es_error"] = info["error"]
+                    if not _unreachable(info["exception"]):
+                        event.attempts += 1
+                        n_retries += 1
+                elif is_retryable(info):
+                    # ES is overloaded; try this one again later
+                    event.attempts += 1
+                    n_retries += 1
                 else:
-                    self.debug_stream("Pushed %d events to ES" % inserted)
-                self._status["n_logged_events"] += inserted
-                if self.get_state() is not DevState.ON:
-                    self.set_state(DevState.ON)
-                    self._status["es_error"] = None
-            except Exception as e:
-                # There was a problem. Let's put the items back in the queue.
-                for event in events:
-                    self._queue_item(event)
-                self._status["es_error"] = str(e)
-                if self.get_state() != DevState.FAULT:
-                    self.set_state(DevState.ALARM)
-                self.error_stream("Exception while sending data to ES: %s" % e)
-
-    def _get_index(self, group):
-        """
-        Generate a date based index name for elasticsearch, on the form
-        '<prefix>-<group>-YYYY.MM.DD'. This is used by Kibana and should
-        also make it easy to prune old data.
-        """
-        date = time.strftime('%Y.%m.%d', datetime.utcnow().utctimetuple())
-        index = "tango-{0}-{1}".format(group, date)
-        return index
-
-    def _queue_item(self, item):
-        "Try to put an item on the queue"
+                    # ES will never accept this particular event
+                    self._dead_letter(event, info)
+                    continue
+                if event.attempts > self.BulkMaxRetries:
+                    self._dead_letter(event, info)
+                else:
+                    unsent.append(event)
+                    n_retryable += 1
+            # keep the counters up to date as each chunk is done
+            self._count(n_logged_events=len(stored),
+                        n_bytes_shipped=sum(event.nbytes for event in stored),
+                        n_retries=n_retries)
+            lane.stored(stored)
+
+        if n_retryable:
+            if n_broken and self._health is not None:
+                # maybe the whole cluster is gone; find out now
+                self._health.wake()
+            # don't make things worse for ES by pushing again right away
+            delay = lane.backoff.failed()
+            self.warn_stream("ES could not take %d of %d events; backing off "
+                             "for %.1f s" % (len(unsent), len(events), delay))
+            if self.get_state() != DevState.FAULT:
+                self.set_state(DevState.ALARM)
+        else:
+            lane.backoff.succeeded()
+            self._last_push = time.time()
+            self.debug_stream("Pushed %d events to ES" % len(events))
+            if self.get_state() is not DevState.ON:
+                self.set_state(DevState.ON)
+                self._status["es_error"] = None
+        return unsent
+
+    def _dead_letter(self, event, info):
+        self._count(n_errors=1)
+        self.dead_letters.add(event, info)
+        self.error_stream("ES refused event %s: %r"
+                          % (event.id, info.get("error")))
+
+    def _replay_spool(self, lane):
+        """Send spooled segments to ES, oldest first, deleting each one
+        once it's been sent. Return whether the whole spool was sent."""
+        for seq in self.spool.segments():
+            events = self.spool.read(seq)
+            unsent = self._send_events(events, lane) if events else []
+            if unsent:
+                # put back only what wasn't sent, so that nothing
+                # gets sent twice
+                self._spool_events(unsent)
+            self.spool.ack(seq)
+            self.info_stream("Replayed %d spooled events"
+                             % (len(events) - len(unsent)))
+            if unsent:
+                return False
+        self._update_spool_status()
+        return True
+
+    def _spool_events(self, events):
+        "Write events to the spool; if that fails, try the queue instead"
+        if not events:
+            return
         try:
-            self.queue.put(item, False)
-        except Full:
-            self._push_events()
-            self.warn_stream("Queue full; pushing events")
+            self.spool.append(events)
+        except (SpoolFull, IOError, OSError) as e:
+            self.error_stream("Could not spool %d events: %s"
+                              % (len(events), e))
+            self._requeue(events)
+        self._update_spool_status()
 
-            self.set_state(DevState.ALARM)
+    def _update_spool_status(self):
+        if self.spool.nbytes:
+            self._status["spool"] = (
+                "There are {0} bytes of events spooled on disk, in {1} "
+                "segments.".format(self.spool.nbytes, len(self.spool)))
         else:
-            self._status["queue"] = ("There are around {0} queued events."
-                                     .format(self.queue.qsize()))
+            self._status["spool"] = None
+
+    def _queue_items(self, docs):
+        """Try to put events on the queue, and return how many were taken
+        care of. This must never block or talk to ES, since it runs inside
+        the ingest commands. The events must all be of the same type."""
+        if not docs:
+            return 0
+        lane = self.lanes[docs[0].type]
+        kept, shed, overflow = lane.queue.put_many(docs)
+        if len(lane.queue) >= lane.batch_size:
+            lane.wake()
+        if not overflow:
+            return kept
+        # no room, even after pushing out less important events
+        lane.wake()
+        if self.spool is not None:
+            self._spool_events(overflow)
+            return len(docs) - shed
+        lane.queue.count_dropped(overflow)
+        self.warn_stream("Queue full; dropping %d events" % len(overflow))
+        self.set_state(DevState.ALARM)
+        return kept
+
+    def _collapse_repeats(self, sources):
+        "Let log event sources through the log storm collapsing, if any"
+        if self._dedup is None:
+            return sources
+        collapsed = []
+        for source in sources:
+            collapsed.extend(self._dedup.add(source))
+        return collapsed
+
+    def _queue_repeats(self, everything=False):
+        """Queue the summaries of repeated log messages whose window is
+        over, or of all of them."""
+        dedup = getattr(self, "_dedup", None)
+        if dedup is None:
+            return
+        sources = dedup.flush() if everything else dedup.expire()
+        if sources:
+            self._queue_items([self._log_document(source)
+                               for source in sources])
+
+    def _queue_item(self, doc):
+        "Try to put one event on the queue; return whether it was taken"
+        return self._queue_items([doc]) == 1
+
+    def _requeue(self, events, lane=None):
+        """Put events that could not be sent back on the queue, if possible.
+        Unless they all came from the given lane, they are sorted out."""
+        if lane is None:
+            for lane in self.lanes.values():
+                self._requeue([event for event in events
+                               if event.type == lane.name], lane)
+        elif events:
+            lane.queue.count_dropped(lane.queue.requeue(events))
+
+    def _dropped(self):
+        "The number of events dropped per level, in all lanes together"
+        return [sum(counts) for counts in
+                zip(*(lane.queue.dropped for lane in self.lanes.values()))]
 
     def dev_status(self):
         self.set_status(self._make_status())
@@ -214,73 +784,133 @@ class Logger(Device):
                       .format(**self._status))
         status.append("Number of failures to write to database: {n_errors}"
                       .format(**self._status))
-        if self._status["queue"]:
-            status.append(self._status["queue"])
+        if self._status["n_retries"]:
+            status.append("Number of events retried: {n_retries}"
+                          .format(**self._status))
+        if len(self.dead_letters):
+            status.append("Number of events refused by ES: {0} (see "
+                          "GetDeadLetters)".format(self.dead_letters.total))
+        if self._dedup is not None and self._dedup.n_suppressed:
+            status.append("Number of repeated log messages collapsed: {0}"
+                          .format(self._dedup.n_suppressed))
+        dropped = self._dropped()
+        if any(dropped):
+            status.append("Number of events dropped: {0}".format(", ".join(
+                "{0} {1}".format(n, level)
+                for level, n in zip(LEVELS, dropped) if n)))
+        for lane in sorted(self.lanes.values(), key=lambda lane: lane.name):
+            if not lane.queue.empty():
+                status.append("There are {0} queued {1} events ({2} bytes)."
+                              .format(len(lane.queue), lane.name,
+                                      lane.queue.nbytes))
+        if self._status["spool"]:
+            status.append(self._status["spool"])
         if self._status["es"]:
             status.append("Elasticsearch status: {es}".format(**self._status))
+        live, total = self._live_nodes()
+        if total > 1:
+            status.append("Elasticsearch nodes in use: {0} of {1}"
+                          .format(live, total))
         if self._status["es_error"]:
             status.append("Elasticsearch error: {es_error}"
                           .format(**self._status))
+        for lane in sorted(self.lanes.values(), key=lambda lane: lane.name):
+            if lane.shipper.last_latency is not None:
+                status.append("Last bulk request for {0} events took {1:.3f}"
+                              " s; now sending up to {2} per request."
+                              .format(lane.name, lane.shipper.last_latency,
+                                      lane.shipper.controller.size))
         if self._status["bad_events"]:
-            status.append("Events that could not be decoded: {0}"
+            status.append("Events that could not be decoded: {bad_events}"
                           .format(**self._status))
         return "\n".join(status)
 
+    def _log_document(self, source):
+        "Wrap a log event source in the metadata ES needs"
+        doc = self._builder.log(source)
+        self._remember(source.get("device"), source["@timestamp"], doc)
+        return doc
+
+    def _alarm_document(self, source):
+        "Wrap an alarm event source in the metadata ES needs"
+        doc = self._builder.alarm(source)
+        self._remember(source.get("device"), source["@timestamp"], doc)
+        return doc
+
+    def _remember(self, device, timestamp, doc):
+        "Keep an (encoded) document among the recent events"
+        if self.recent is not None:
+            millis = timestamp_millis(timestamp)
+            if millis is None:
+                millis = time.time() * 1000
+            self.recent.add(str(device or ""), millis, doc)
+
     @command(dtype_in=[str],
              doc_in="Format: timestamp, level, device, message, ndc, thread")
     def Log(self, event):
         "Send a Tango log event to Elasticsearch"
-        self.debug_stream("Log(%r)" % event)
-        source = dict(zip(EVENT_MEMBERS, event))
-        if not self.queue.full():
-            data = {
-                "_id": str(uuid4()),  # create a unique document ID
-                "_type": "log",
-                "_index": self._get_index("logs"),
-                "_source": source
-            }
-            self._queue_item(data)
+        with span("Log", profile=True):
+            self.debug_stream("Log(%r)" % event)
+            self._ingest_rates["log"].add()
+            self._queue_items([self._log_document(source) for source in
+                               self._collapse_repeats([log_source(event)])])
+
+    @command(dtype_in=[str], dtype_out=int,
+             doc_in=("Any number of log events, flattened. Format: "
+                     "timestamp, level, device, message, ndc, thread, "
+                     "timestamp, level, ..."),
+             doc_out="The number of events queued")
+    def LogBatch(self, fields):
+        "Send several Tango log events to Elasticsearch in one go"
+        with span("LogBatch", profile=True):
+            self.debug_stream("LogBatch(<%d fields>)" % len(fields))
+            sources = [log_source(event) for event in split_log_batch(fields)]
+            self._ingest_rates["log"].add(len(sources))
+            docs = [self._log_document(source)
+                    for source in self._collapse_repeats(sources)]
+            # collapsed repeats are as good as queued
+            n_lost = len(docs) - self._queue_items(docs)
+            return max(len(sources) - n_lost, 0)
 
     @command(dtype_in=str, doc_in="JSON encoded PyAlarm event")
     def Alarm(self, event):
         "Send a PyAlarm event to Elasticsearch"
-        self.debug_stream("Alarm(%r)" % event)
-        try:
-            source = json.loads(event)
-        except ValueError as e:
-            self.error_stream("Error decoding alarm event: %s", e)
-            self.debug_stream(event)
-            self._status["bad_events"] += 1
-            return
-
-        # we want a @timestamp field for Kibana to work...
-        if "timestamp" in source:
-            t = source.pop("timestamp")
-            source["@timestamp"] = datetime.utcfromtimestamp(t / 1000)
-
-        # translate other timestamps
-        if "active_since" in source:
-            source["@timestamp"] = datetime.utcfromtimestamp(source["active_since"] / 1000)
-
-        if "recovered_at" in source:
-            source["@timestamp"] = datetime.utcfromtimestamp(source["recovered_at"] / 1000)
-
-        # make sure there is a priority
-        if "priority" not in source:
-            sev = str(source["severity"])
-            source["priority"] = ALARM_PRIORITIES.get(sev.upper(), 0)
-
-        # slightly hacky way of making things fit the mapping
-        source["values"] = stringify_values(source["values"])
+        with span("Alarm", profile=True):
+            self.debug_stream("Alarm(%r)" % event)
+            try:
+                source = json.loads(event)
+            except ValueError as e:
+                self.error_stream("Error decoding alarm event: %s", e)
+                self.debug_stream(event)
+                self._count(bad_events=1)
+                return
+            self._ingest_rates["alarm"].add()
+            self._queue_item(self._alarm_document(alarm_source(source)))
 
-        data = {
-            "_id": str(uuid4()),  # create a unique document ID
-            "_type": "alarm",
-            "_index": self._get_index("alarms"),
-            "_source": source,
-            "_timestamp": source["@timestamp"]
-        }
-        self._queue_item(data)
+    @command(dtype_in=str, dtype_out=int,
+             doc_in=("PyAlarm events, either as a JSON encoded list or as "
+                     "one JSON encoded event per line"),
+             doc_out="The number of events queued")
+    def AlarmBatch(self, events):
+        "Send several PyAlarm events to Elasticsearch in one go"
+        with span("AlarmBatch", profile=True):
+            self.debug_stream("AlarmBatch(<%d bytes>)" % len(events))
+            try:
+                sources = split_alarm_batch(events)
+            except ValueError as e:
+                self.error_stream("Error decoding alarm batch: %s", e)
+                self._count(bad_events=1)
+                return 0
+            self._ingest_rates["alarm"].add(len(sources))
+            docs = []
+            for source in sources:
+                try:
+                    docs.append(self._alarm_document(alarm_source(source)))
+                except (TypeError, KeyError, AttributeError) as e:
+                    # a broken event shouldn't take the rest of the batch down
+                    self.error_stream("Bad event in alarm batch: %r", e)
+                    self._count(bad_events=1)
+            return self._queue_items(docs)
 
     @command(dtype_in=str, doc_in="A message for the fake alarm event")
     def TestAlarm(self, message):
@@ -307,9 +937,155 @@ class Logger(Device):
                  message, "0", "0"]
         self.Log(event)
 
+    @attribute(dtype=float, unit="events/s",
+               doc="Log events received per second, over the last minute")
+    def LogRate(self):
+        return self._ingest_rates["log"].rate()
+
+    @attribute(dtype=float, unit="events/s",
+               doc="Alarm events received per second, over the last minute")
+    def AlarmRate(self):
+        return self._ingest_rates["alarm"].rate()
+
+    @attribute(dtype=int, doc="Number of events buffered in memory")
+    def QueueEvents(self):
+        return self._queued_events()
+
+    @attribute(dtype=int, doc="Number of alarm events buffered in memory")
+    def AlarmQueueEvents(self):
+        return len(self.lanes["alarm"].queue)
+
+    @attribute(dtype=int, unit="B",
+               doc="Total size of the events buffered in memory")
+    def QueueBytes(self):
+        return sum(lane.queue.nbytes for lane in self.lanes.values())
+
+    @attribute(dtype=int, doc="Total number of events dropped")
+    def DroppedEvents(self):
+        return sum(self._dropped())
+
+    @attribute(dtype=(int,), max_dim_x=len(LEVELS),
+               doc=("Number of events dropped per level: %s"
+                    % ", ".join(LEVELS)))
+    def DroppedPerLevel(self):
+        return self._dropped()
+
+    @attribute(dtype=int, doc="Total number of events stored in ES")
+    def ShippedEvents(self):
+        return self._status["n_logged_events"]
+
+    @attribute(dtype=int, unit="B",
+               doc="Total size of the events stored in ES (JSON encoded)")
+    def ShippedBytes(self):
+        return self._status["n_bytes_shipped"]
+
+    @attribute(dtype=int,
+               doc="Total number of times ES refused an event for now")
+    def RetriedEvents(self):
+        return self._status["n_retries"]
+
+    @attribute(dtype=float, unit="s",
+               doc=("Time since events were last pushed to ES without "
+                    "problems (or since the device started)"))
+    def TimeSinceLastPush(self):
+        return time.time() - self._last_push
+
+    @attribute(dtype=float, unit="s",
+               doc="Median time taken by recent pushes to ES")
+    def FlushTimeP50(self):
+        return self._flush_times.percentile(50)
+
+    @attribute(dtype=float, unit="s",
+               doc="99th percentile of the time taken by recent pushes")
+    def FlushTimeP99(self):
+        return self._flush_times.percentile(99)
+
+    @attribute(dtype=float, unit="s",
+               doc=("Median time from receiving recent log events until "
+                    "ES had stored them"))
+    def LogDelayP50(self):
+        return self.lanes["log"].delays.percentile(50)
+
+    @attribute(dtype=float, unit="s",
+               doc=("99th percentile of the time from receiving recent log "
+                    "events until ES had stored them"))
+    def LogDelayP99(self):
+        return self.lanes["log"].delays.percentile(99)
+
+    @attribute(dtype=float, unit="s",
+               doc=("Median time from receiving recent alarm events until "
+                    "ES had stored them"))
+    def AlarmDelayP50(self):
+        return self.lanes["alarm"].delays.percentile(50)
+
+    @attribute(dtype=float, unit="s",
+               doc=("99th percentile of the time from receiving recent "
+                    "alarm events until ES had stored them"))
+    def AlarmDelayP99(self):
+        return self.lanes["alarm"].delays.percentile(99)
+
+    @attribute(dtype=float, unit="s",
+               doc=("Median time taken by recent bulk requests to ES, for "
+                    "log and alarm events alike"))
+    def BulkLatencyP50(self):
+        return self._bulk_latencies.percentile(50)
+
+    @attribute(dtype=float, unit="s",
+               doc=("99th percentile of the time taken by recent bulk "
+                    "requests, for log and alarm events alike"))
+    def BulkLatencyP99(self):
+        return self._bulk_latencies.percentile(99)
+
     @command
     def PushQueuedEventsToES(self):
-        self._push_events()
+        self._push_events(force=True)
+
+    @command(dtype_in=[str], dtype_out=str,
+             doc_in=("Device name (empty for all), lowest level, since "
+                     "(ms epoch, or negative for ms ago) and max number "
+                     "of events. All are optional."),
+             doc_out=("JSON encoded list of events, oldest first, as "
+                      "{\"type\": ..., \"event\": ...}"))
+    def GetRecent(self, args):
+        "Get the latest events received, without asking ES"
+        if self.recent is None:
+            return "[]"
+        device, level, since, limit = (list(args) + [""] * 4)[:4]
+        since = float(since or 0)
+        if since < 0:
+            since += time.time() * 1000
+        return self.recent.to_json(device, level_rank(level) if level else 0,
+                                   since, int(limit or 100))
+
+    @command
+    def StartProfiling(self):
+        "Start timing and profiling the ingest commands and the flush"
+        PROFILER.start()
+
+    @command(dtype_in=str, dtype_out=str,
+             doc_in=("File to dump the cProfile stats to, for use with "
+                     "pstats or e.g. snakeviz (optional)"),
+             doc_out="Summary of spans and top functions by cumulative time")
+    def StopProfiling(self, path):
+        "Stop profiling, and report where the time went"
+        if not PROFILER.active:
+            return "Not profiling."
+        duration = time.time() - PROFILER.started
+        stats, spans = PROFILER.stop()
+        if path and stats is not None:
+            stats.dump_stats(path)
+        return summary(stats, spans, duration)
+
+    @command(dtype_out=str,
+             doc_out="JSON encoded list of events, with ES error info")
+    def GetDeadLetters(self):
+        "Get the latest events that ES refused to store"
+        return self.dead_letters.to_json()
+
+    @command
+    def ClearDeadLetters(self):
+        "Forget about the events that ES refused to store"
+        self.dead_letters.clear()
 
 
 def main():
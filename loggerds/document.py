@@ -0,0 +1,111 @@
+"""
+The representation of an event on its way to ES. Each event is turned
+into the two lines it takes up in a bulk request (the action and the
+source) exactly once, after which only these strings are kept around.
+Sending, retrying and spooling then just pass the strings along.
+"""
+
+import json
+import time
+
+from events import DEFAULT_RANK, json_default
+
+
+# kept in the spooled action lines only, since ES doesn't accept it
+ATTEMPTS_FIELD = "_attempts"
+
+
+def dumps(obj):
+    return json.dumps(obj, separators=(",", ":"), default=json_default)
+
+
+class Document(object):
+
+    "An event to be indexed in ES"
+
+    __slots__ = ("type", "index", "id", "timestamp", "source",
+                 "action", "data", "attempts", "rank", "received")
+
+    def __init__(self, doc_type, index, doc_id, source, timestamp=None,
+                 rank=DEFAULT_RANK):
+        self.type = doc_type
+        self.index = index
+        self.id = doc_id
+        self.timestamp = timestamp  # for the _timestamp field, if any
+        self.rank = rank  # importance; see events.LEVELS
+        self.source = source  # dropped once encoded
+        self.action = None
+        self.data = None
+        self.attempts = 0
+        self.received = time.time()  # or read back from the spool
+
+    @classmethod
+    def from_lines(cls, action, data):
+        """Recreate a document from its (already encoded) bulk lines, as
+        given by encode() or to_lines()"""
+        meta = json.loads(action)["index"]
+        doc = cls(meta["_type"], meta["_index"], meta.get("_id"), None)
+        if ATTEMPTS_FIELD in meta:
+            doc.attempts = meta.pop(ATTEMPTS_FIELD)
+            action = dumps({"index": meta})
+        doc.action = action
+        doc.data = data
+        return doc
+
+    def to_lines(self):
+        """The bulk lines, with the number of attempts to send the document
+        so far added to the action; for storing it somewhere else than ES
+        (see spool)"""
+        action, data = self.encode()
+        if self.attempts:
+            meta = json.loads(action)
+            meta["index"][ATTEMPTS_FIELD] = self.attempts
+            action = dumps(meta)
+        return action, data
+
+    def encode_source(self, canonical=False):
+        """Serialize the source into its bulk line, unless already done.
+        If *canonical*, the keys are sorted, so that equal sources always
+        give the same line."""
+        if self.data is None:
+            if canonical:
+                self.data = json.dumps(self.source, separators=(",", ":"),
+                                       sort_keys=True, default=json_default)
+            else:
+                self.data = dumps(self.source)
+            self.source = None
+        return self.data
+
+    def encode(self):
+        "Serialize the document into its bulk lines, unless already done"
+        if self.action is None:
+            meta = {"_index": self.index, "_type": self.type}
+            if self.id is not None:
+                meta["_id"] = self.id
+            if self.timestamp is not None:
+                meta["_timestamp"] = self.timestamp
+            self.action = dumps({"index": meta})
+            self.timestamp = None
+        return self.action, self.encode_source()
+
+    @property
+    def nbytes(self):
+        "Size of the encoded document, in bytes"
+        action, data = self.encode()
+        return len(action) + len(data) + 2
+
+    def to_dict(self):
+        "The document in the form taken by the elasticsearch bulk helpers"
+        if self.action is not None:
+            doc = json.loads(self.action)["index"]
+            doc["_source"] = json.loads(self.data)
+            return doc
+        source = self.source
+        if self.data is not None:
+            source = json.loads(self.data)
+        doc = {"_index": self.index, "_type": self.type, "_source": source}
+        if self.id is not None:
+            doc["_id"] = self.id
+        if self.timestamp is not None:
+            doc["_timestamp"] = self.timestamp
+        return doc
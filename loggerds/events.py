@@ -0,0 +1,167 @@
+"""
+Conversion of incoming Tango log and PyAlarm events into the document
+sources that get stored in Elasticsearch. These are kept separate from
+the device so that they can be reused wherever events are built.
+"""
+
+from datetime import datetime
+import json
+
+from profiling import span
+
+
+EVENT_MEMBERS = ["@timestamp", "level", "device", "message", "ndc", "thread"]
+ALARM_PRIORITIES = {"ALARM": 400, "ERROR": 400, "WARNING": 300,
+                    "INFO": 200, "DEBUG": 100}
+
+# Levels in order of importance, used e.g. when deciding which events
+# to drop first. An event's "rank" is its index in this list.
+LEVELS = ["DEBUG", "INFO", "WARN", "ERROR", "FATAL"]
+LEVEL_RANKS = {"DEBUG": 0, "INFO": 1, "WARN": 2, "WARNING": 2,
+               "ERROR": 3, "ALARM": 3, "FATAL": 4}
+DEFAULT_RANK = LEVEL_RANKS["INFO"]
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def level_rank(level):
+    "The rank of a log level name; unknown levels count as INFO"
+    return LEVEL_RANKS.get(str(level).upper(), DEFAULT_RANK)
+
+
+def priority_rank(priority):
+    "The rank of an alarm priority (see ALARM_PRIORITIES)"
+    try:
+        return min(max(int(priority) // 100 - 1, 0), LEVEL_RANKS["ERROR"])
+    except (TypeError, ValueError):
+        return DEFAULT_RANK
+
+
+def _is_number(value):
+    "Whether a value is a finite number (JSON has no NaN or infinity)"
+    return (isinstance(value, (int, long, float)) and
+            not isinstance(value, bool) and value - value == 0)
+
+
+def typed_values(values):
+    """In order to fit well in ES, fields should have a consistent type.
+    Therefore attribute values are always stored as strings, along with
+    the name of their original type. To make it possible to search on
+    the actual values, they are also stored in a field for their type;
+    "number" or "boolean". For arrays, the "length" is stored, and if
+    there are numbers in them, their "min", "max" and "mean"."""
+    typed = []
+    for value in values:
+        v = value["value"]
+        kind = type(v)  # values come from JSON, so no subclasses
+        entry = {"attribute": value["attribute"],
+                 "value": v if kind is unicode or kind is str else str(v),
+                 "type": kind.__name__}
+        if kind is bool:
+            entry["boolean"] = v
+        elif kind is float or kind is int or kind is long:
+            if v - v == 0:  # not NaN or infinite
+                entry["number"] = v
+        elif kind is list or kind is tuple:
+            entry["length"] = len(v)
+            _summarize(v, entry)
+        typed.append(entry)
+    return typed
+
+
+def _summarize(items, entry):
+    "Add min, max and mean of the numbers in an array, if any"
+    # booleans would pass for numbers with the builtins, and ES would
+    # then refuse the whole event; the fields are mapped as doubles
+    numbers = [item for item in items if _is_number(item)]
+    if numbers:
+        entry["min"] = min(numbers)
+        entry["max"] = max(numbers)
+        entry["mean"] = float(sum(numbers)) / len(numbers)
+
+
+def timestamp_millis(timestamp):
+    """Convert an event timestamp, ms epoch (as a number or string) or
+    a UTC datetime, to ms epoch. Returns None if it can't be done."""
+    if isinstance(timestamp, datetime):
+        delta = timestamp - EPOCH
+        return (delta.days * 86400 + delta.seconds) * 1000. + \
+            delta.microseconds / 1000.
+    try:
+        return float(timestamp)
+    except (TypeError, ValueError):
+        return None
+
+
+def json_default(obj):
+    "Make JSON encoding handle the datetimes in our events"
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+def log_source(event):
+    "Make a document source out of a Tango log event (a list of strings)"
+    if len(event) != len(EVENT_MEMBERS):
+        raise ValueError("Log event should have %d members, got %d"
+                         % (len(EVENT_MEMBERS), len(event)))
+    return dict(zip(EVENT_MEMBERS, event))
+
+
+def alarm_source(source):
+    "Make a document source out of a decoded PyAlarm event (a dict)"
+
+    # we want a @timestamp field for Kibana to work...
+    if "timestamp" in source:
+        t = source.pop("timestamp")
+        source["@timestamp"] = datetime.utcfromtimestamp(t / 1000)
+
+    # translate other timestamps
+    if "active_since" in source:
+        source["@timestamp"] = datetime.utcfromtimestamp(
+            source["active_since"] / 1000)
+
+    if "recovered_at" in source:
+        source["@timestamp"] = datetime.utcfromtimestamp(
+            source["recovered_at"] / 1000)
+
+    # make sure there is a priority
+    if "priority" not in source:
+        sev = str(source["severity"])
+        source["priority"] = ALARM_PRIORITIES.get(sev.upper(), 0)
+
+    # make the values fit the mapping
+    with span("typed_values"):
+        source["values"] = typed_values(source["values"])
+
+    return source
+
+
+def split_log_batch(fields):
+    """Split a flat list of N * 6 strings into N log events. Raises
+    ValueError if the length doesn't add up."""
+    n = len(EVENT_MEMBERS)
+    if len(fields) % n:
+        raise ValueError("Log batch should contain a multiple of %d strings,"
+                         " got %d" % (n, len(fields)))
+    return [fields[i:i + n] for i in xrange(0, len(fields), n)]
+
+
+def split_alarm_batch(data):
+    """Decode a batch of JSON encoded alarm events, given either as a
+    JSON array or as newline delimited JSON (one event per line).
+    Returns a list of decoded events, with None in place of any lines
+    that could not be decoded. A broken JSON array raises ValueError."""
+    data = data.strip()
+    if data.startswith("["):
+        return json.loads(data)
+    events = []
+    for line in data.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            events.append(None)
+    return events
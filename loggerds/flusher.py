@@ -0,0 +1,60 @@
+"""
+A background thread that periodically empties the event queue into ES,
+so that this never has to happen inside a Tango command or the polling
+thread.
+"""
+
+import threading
+import time
+
+
+class Flusher(object):
+
+    """
+    Calls *flush* from a dedicated thread, at the latest *period*
+    seconds after the previous flush, or earlier whenever wake() is
+    called (e.g. because enough events have piled up). Exceptions from
+    *flush* are passed to *on_error* so that the thread keeps going.
+    """
+
+    def __init__(self, flush, period, on_error=None, name="Flusher"):
+        self.flush = flush
+        self.period = period
+        self.on_error = on_error
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def wake(self):
+        "Ask for a flush as soon as possible"
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        """Stop the thread, waiting for any ongoing flush to finish. Any
+        remaining events must be flushed by the caller afterwards."""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def _run(self):
+        deadline = time.time() + self.period
+        while not self._stopping.is_set():
+            self._wakeup.wait(max(0, deadline - time.time()))
+            self._wakeup.clear()
+            if self._stopping.is_set():
+                break
+            deadline = time.time() + self.period
+            try:
+                self.flush()
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(e)
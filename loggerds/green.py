@@ -0,0 +1,27 @@
+"""
+Running the Logger device in gevent green mode. All the work of the
+device then happens in greenlets on a single gevent loop: the commands,
+the flushes, health checks and index maintenance (the Flusher threads)
+and the bulk requests, several of which are in flight at once when
+BulkWorkers > 1. Talking to ES never blocks the loop, so commands are
+served while flushes wait for ES to answer.
+
+For this to work, the standard library must be monkey patched before
+anything else is imported, so that threads, locks and sockets (those of
+the ES client included) become cooperative. The loggerds-green script
+takes care of that.
+"""
+
+from gevent import monkey
+from PyTango import GreenMode
+from PyTango.server import run
+
+from device import Logger
+
+
+def main():
+    if not (monkey.is_module_patched("socket") and
+            monkey.is_module_patched("threading")):
+        raise RuntimeError("gevent must monkey patch the standard library "
+                           "before the device is imported")
+    run((Logger,), green_mode=GreenMode.Gevent)
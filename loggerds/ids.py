@@ -0,0 +1,78 @@
+"""
+Ways of picking the ES document ID (_id) of events:
+
+- "uuid4": a random UUID; the original way.
+- "auto": no ID, ES makes one up. This is the cheapest for ES, since it
+  then knows the document is new, but if a bulk request fails halfway
+  and is sent again, some events may be stored twice.
+- "timeorder": a compact ID starting with the current time, so that
+  IDs made close in time are also close in the index.
+- "hash": a hash of the event contents, so that sending the same event
+  again (e.g. a client retrying, or an import being rerun) overwrites
+  it instead of storing a copy. Note that identical events, down to the
+  timestamp, are then also stored only once.
+"""
+
+import base64
+import hashlib
+import itertools
+import os
+import struct
+import time
+from uuid import uuid4
+
+
+ID_STRATEGIES = ("uuid4", "auto", "timeorder", "hash")
+
+
+def random_id(doc):
+    "A random UUID"
+    return str(uuid4())
+
+
+def auto_id(doc):
+    "Let ES make up an ID"
+    return None
+
+
+class TimeOrderedIds(object):
+
+    """
+    Makes IDs that sort in the order they were made: 48 bits of epoch
+    milliseconds, 24 random bits identifying this generator (so that
+    several devices don't collide) and a 24 bit counter, as 24 hex
+    digits. Thread safe, and needs no lock.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        node, start = struct.unpack(">2xI2xI", os.urandom(12))
+        self._node = node & 0xffffff
+        self._counter = itertools.count(start & 0xffffff)
+
+    def __call__(self, doc=None):
+        millis = int(self.clock() * 1000) & 0xffffffffffff
+        return "%012x%06x%06x" % (millis, self._node,
+                                  next(self._counter) & 0xffffff)
+
+
+def content_id(doc):
+    """An ID made from the type and source of a document. The source is
+    encoded in a canonical way to make sure equal events get equal IDs."""
+    digest = hashlib.sha1(doc.type + "\n" + doc.encode_source(canonical=True))
+    return base64.urlsafe_b64encode(digest.digest()).rstrip("=")
+
+
+def id_maker(strategy):
+    """Get a function that picks the ID for a document, according to one
+    of the ID_STRATEGIES. Raises ValueError for any other strategy."""
+    if strategy == "uuid4":
+        return random_id
+    if strategy == "auto":
+        return auto_id
+    if strategy == "timeorder":
+        return TimeOrderedIds()
+    if strategy == "hash":
+        return content_id
+    raise ValueError("ID strategy should be one of %s, not %r"
+                     % (", ".join(ID_STRATEGIES), strategy))
@@ -0,0 +1,96 @@
+"""
+Naming of the daily indices that events are stored in. Since index
+names only change once a day, they are computed once per day and then
+looked up by day number.
+"""
+
+from datetime import datetime
+import time
+
+
+DAY_S = 24 * 3600
+DAY_MS = DAY_S * 1000
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+
+class DailyIndex(object):
+
+    """
+    Keeps track of the index names on the form '<prefix>-<group>-YYYY.MM.DD'
+    for one group of events. The day (UTC) is taken from the timestamp of
+    each event, so that an event always ends up in the index for the day
+    it happened, even if it's sent to ES much later.
+
+    At most *max_days* names are kept around; that should be plenty
+    unless a large backlog covering many days is sent.
+    """
+
+    def __init__(self, prefix, group, max_days=64):
+        self.prefix = prefix
+        self.group = group
+        self.max_days = max_days
+        self._names = {}  # days since epoch -> index name
+        self._today = None
+        self._tomorrow_starts = 0  # epoch seconds
+
+    def _name(self, day):
+        try:
+            return self._names[day]
+        except KeyError:
+            if len(self._names) >= self.max_days:
+                self._names.clear()
+            date = time.strftime("%Y.%m.%d", time.gmtime(day * DAY_S))
+            name = self._names[day] = "{0}-{1}-{2}".format(
+                self.prefix, self.group, date)
+            return name
+
+    def today(self):
+        "The index name for the current day"
+        now = time.time()
+        if now >= self._tomorrow_starts:
+            day = int(now // DAY_S)
+            self._today = self._name(day)
+            self._tomorrow_starts = (day + 1) * DAY_S
+        return self._today
+
+    def get(self, timestamp=None):
+        """The index name for an event with the given timestamp; either a
+        datetime (UTC) or milliseconds since epoch, as a number or a
+        string. Without a usable timestamp, today's index is used."""
+        if timestamp is None:
+            return self.today()
+        if isinstance(timestamp, datetime):
+            return self._name(timestamp.toordinal() - EPOCH_ORDINAL)
+        try:
+            return self._name(int(float(timestamp) // DAY_MS))
+        except (TypeError, ValueError, OverflowError):
+            return self.today()
+
+
+class RolloverIndex(object):
+
+    """
+    Events for one group all go to a write alias, '<prefix>-<group>',
+    pointing at the latest of a series of indices on the form
+    '<prefix>-<group>-000001'. When that gets too large, a new index is
+    created and the alias moved to it (see lifecycle), so that indices
+    have roughly the same size whatever the event rate.
+    """
+
+    def __init__(self, prefix, group):
+        self.prefix = prefix
+        self.group = group
+        self.alias = "{0}-{1}".format(prefix, group)
+
+    def first(self):
+        "The name of the first index in the series"
+        return "{0}-{1:06d}".format(self.alias, 1)
+
+    def next(self, name):
+        "The name of the index following the given one"
+        number = int(name.rsplit("-", 1)[1])
+        return "{0}-{1:06d}".format(self.alias, number + 1)
+
+    def get(self, timestamp=None):
+        "Where to send an event; always the write alias"
+        return self.alias
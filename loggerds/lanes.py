@@ -0,0 +1,44 @@
+"""
+Events of different types take separate lanes to ES, so that e.g. an
+alarm never has to wait behind thousands of queued log events.
+"""
+
+import threading
+import time
+
+from metrics import RollingPercentiles
+
+
+class Lane(object):
+
+    """
+    The way to ES for one type of events: its own buffer (*queue*),
+    bulk requests (*shipper*) and backoff after errors, and the number
+    of queued events (*batch_size*) that makes it push right away. Each
+    lane is pushed under its own lock, by its own flusher thread if it
+    has one, so that lanes never hold each other up.
+
+    Also keeps track of the end-to-end delay of recent events, i.e. the
+    time from receiving them until ES has stored them.
+    """
+
+    def __init__(self, name, queue, shipper, backoff, batch_size):
+        self.name = name
+        self.queue = queue
+        self.shipper = shipper
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self.flusher = None
+        self.lock = threading.Lock()
+        self.delays = RollingPercentiles()
+
+    def wake(self):
+        "Ask the flusher, if any, to push as soon as possible"
+        flusher = self.flusher
+        if flusher is not None:
+            flusher.wake()
+
+    def stored(self, docs, now=None):
+        "Note that the documents have been stored in ES"
+        now = time.time() if now is None else now
+        self.delays.extend(now - doc.received for doc in docs)
@@ -0,0 +1,201 @@
+"""
+Upkeep of the indices of one group of events, meant to be run now and
+then from a thread of its own, off the ingest path:
+
+- rollover: when the index behind the write alias (see RolloverIndex)
+  holds more than a given number of documents or bytes, a new one is
+  created and the alias moved to it.
+- retention: indices that have not been written to for a given number
+  of days are deleted.
+- force merge: indices that are no longer written to are merged down
+  to one segment per shard, which makes them smaller and faster to
+  search. Merging can take ES a long while; it is asked for, but not
+  waited for.
+
+Both daily indices ('<prefix>-<group>-YYYY.MM.DD') and rollover indices
+('<prefix>-<group>-000001') are handled. A daily index is written to
+until the end of its day; a rollover index until the next one in the
+series is created.
+"""
+
+import calendar
+import re
+import time
+
+from elasticsearch import ConnectionTimeout, TransportError
+
+from indices import DAY_MS
+
+
+DAILY_NAME = re.compile(r"-(\d{4})\.(\d{2})\.(\d{2})$")
+ROLLOVER_NAME = re.compile(r"-(\d{6})$")
+
+# late events may still arrive for a while after a day is over
+MERGE_DELAY_MS = 3600 * 1000
+# ES goes on merging after the request times out, so there is no need
+# to wait that long for it, nor to ask again any time soon
+MERGE_REQUEST_TIMEOUT = 60  # s
+MERGE_AGAIN_MS = 6 * 3600 * 1000
+# indices deleted per request; the names go in the URL, which ES limits
+# to 4 kB by default (http.max_initial_line_length)
+DELETE_BATCH_SIZE = 20
+
+
+def written_until(indices):
+    """Given index names and their creation dates (ms epoch), find out
+    when each index stopped being written to. Returns a dict of index
+    name to ms epoch; None for the indices still in use. Indices that
+    are neither daily nor rollover ones are left out."""
+    until = {}
+    rollover = []
+    for name, created in indices.items():
+        match = DAILY_NAME.search(name)
+        if match:
+            day = calendar.timegm(
+                tuple(int(part) for part in match.groups()) + (0, 0, 0))
+            until[name] = day * 1000 + DAY_MS
+        elif ROLLOVER_NAME.search(name):
+            rollover.append((int(name[-6:]), created, name))
+    rollover.sort()
+    # each index was written to until the next one was created
+    for (_, _, name), (_, created, _) in zip(rollover, rollover[1:]):
+        until[name] = created
+    if rollover:
+        until[rollover[-1][2]] = None
+    return until
+
+
+class IndexLifecycle(object):
+
+    """
+    Rollover, retention and force merging for the indices of one group.
+    *index* is the DailyIndex or RolloverIndex events are sent through.
+    A limit of 0 means no limit. Any TransportError is passed on.
+    """
+
+    def __init__(self, es, index, max_docs=0, max_bytes=0,
+                 retention_days=0, force_merge=False):
+        self.es = es
+        self.index = index
+        self.pattern = "{0}-{1}-*".format(index.prefix, index.group)
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.retention_days = retention_days
+        self.force_merge = force_merge
+        self._merge_requested = {}  # index name -> ms epoch
+
+    @property
+    def rolls_over(self):
+        return bool(self.max_docs or self.max_bytes)
+
+    def bootstrap(self):
+        """Make sure the write alias points at an index. Returns the name
+        of the index created, if any."""
+        alias = self.index.alias
+        if self.es.indices.exists_alias(name=alias):
+            return None
+        first = self.index.first()
+        try:
+            self.es.indices.create(first, body={"aliases": {alias: {}}})
+        except TransportError as e:
+            # someone else (e.g. another device) may have been quicker
+            if e.status_code != 400 or not self.es.indices.exists_alias(
+                    name=alias):
+                raise
+            return None
+        return first
+
+    def rollover(self):
+        """Move the write alias to a new index, if the current one is full.
+        Returns the name of the new index, if any."""
+        alias = self.index.alias
+        (current,) = self.es.indices.get_alias(name=alias).keys()
+        stats = self.es.indices.stats(current, metric="docs,store")
+        primaries = stats["indices"][current]["primaries"]
+        if not ((self.max_docs and
+                 primaries["docs"]["count"] >= self.max_docs) or
+                (self.max_bytes and
+                 primaries["store"]["size_in_bytes"] >= self.max_bytes)):
+            return None
+        new = self.index.next(current)
+        try:
+            self.es.indices.create(new)  # the template takes care of it
+        except TransportError as e:
+            # someone else may have been quicker, or an earlier rollover
+            # created the index but never got to move the alias
+            if e.status_code != 400 or not self.es.indices.exists(new):
+                raise
+            if self.es.indices.exists_alias(name=alias, index=new):
+                return None  # already done by someone else
+        self.es.indices.update_aliases(body={"actions": [
+            {"remove": {"index": current, "alias": alias}},
+            {"add": {"index": new, "alias": alias}}]})
+        return new
+
+    def _indices(self):
+        "Creation date, number of shards and segments of our indices"
+        settings = self.es.indices.get_settings(
+            self.pattern, "index.creation_date,index.number_of_shards",
+            flat_settings=True)
+        stats = self.es.indices.stats(self.pattern, metric="segments")
+        info = {}
+        for name, index in settings.items():
+            try:
+                segments = stats["indices"][name]["primaries"]["segments"]
+            except KeyError:
+                continue  # e.g. just deleted
+            info[name] = (int(index["settings"]["index.creation_date"]),
+                          int(index["settings"]["index.number_of_shards"]),
+                          segments["count"])
+        return info
+
+    def clean_up(self, now=None):
+        """Delete expired indices and force merge the ones no longer
+        written to, according to the settings. Returns the names of the
+        deleted and the merged indices. If some indices could not be
+        deleted, the rest are still looked after, and the error is
+        passed on at the end."""
+        if not self.retention_days and not self.force_merge:
+            return [], []
+        now = time.time() * 1000 if now is None else now
+        info = self._indices()
+        until = written_until(dict((name, created) for name, (created, _, _)
+                                   in info.items()))
+        expired = []
+        if self.retention_days:
+            expiry = now - self.retention_days * DAY_MS
+            expired = sorted(name for name, end in until.items()
+                             if end is not None and end < expiry)
+        deleted = []
+        error = None
+        for i in range(0, len(expired), DELETE_BATCH_SIZE):
+            batch = expired[i:i + DELETE_BATCH_SIZE]
+            try:
+                self.es.indices.delete(",".join(batch))
+            except TransportError as e:
+                error = e
+                continue
+            deleted.extend(batch)
+        merged = []
+        if self.force_merge:
+            for name in list(self._merge_requested):
+                if name not in until or name in expired:
+                    del self._merge_requested[name]
+            for name, end in sorted(until.items()):
+                _, shards, segments = info[name]
+                requested = self._merge_requested.get(name)
+                if (name in expired or end is None or
+                        end > now - MERGE_DELAY_MS or segments <= shards or
+                        (requested and requested > now - MERGE_AGAIN_MS)):
+                    continue
+                try:
+                    self.es.indices.forcemerge(
+                        name, max_num_segments=1,
+                        request_timeout=MERGE_REQUEST_TIMEOUT)
+                except ConnectionTimeout:
+                    pass  # still merging, but we don't have to wait for it
+                self._merge_requested[name] = now
+                merged.append(name)
+        if error is not None:
+            raise error
+        return deleted, merged
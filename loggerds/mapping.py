@@ -1,6 +1,21 @@
 # Mappings for ElasticSearch. Not strictly necessary, but makes it easier to work with
 # timestamps. Also searches should be more efficient.
 
+import copy
+
+# Bump this whenever the mappings or settings below change, so that
+# the index templates in ES get updated.
+TEMPLATE_VERSION = 3
+
+# index groups (as in <prefix>-<group>-YYYY.MM.DD) and their doc types
+INDEX_GROUPS = {"logs": "log", "alarms": "alarm"}
+
+# where searches that don't name a field go, per group. Log events are
+# many, and only their message is worth searching, so they do without
+# the "_all" field. Alarms are few, and their description, formula etc.
+# all matter, so they keep it.
+DEFAULT_FIELDS = {"logs": "message", "alarms": "_all"}
+
 es_mappings = {
     "log": {
         "log": {
@@ -26,6 +41,16 @@ es_mappings = {
                 "thread": {
                     "type": "string",  # integer?
                     "index": "not_analyzed"
+                },
+                # for collapsed repeats of the same message
+                "count": {
+                    "type": "integer"
+                },
+                "first_seen": {
+                    "type": "date"
+                },
+                "last_seen": {
+                    "type": "date"
                 }
             }
         }
@@ -83,7 +108,13 @@ es_mappings = {
                 "user_comment": {
                     "type": "string"
                 },
+                # nested, so that a query can ask for e.g. the pressure
+                # being high without matching a high value of some other
+                # attribute. The fields are also copied to the alarm
+                # itself, for Kibana and simple queries.
                 "values": {
+                    "type": "nested",
+                    "include_in_parent": True,
                     "properties": {
                         "attribute": {
                             "type": "string",
@@ -96,6 +127,26 @@ es_mappings = {
                         "type": {
                             "index": "not_analyzed",  # a python data type
                             "type": "string"
+                        },
+                        # the value again, if it's a number or a boolean
+                        "number": {
+                            "type": "double"
+                        },
+                        "boolean": {
+                            "type": "boolean"
+                        },
+                        # summary of an array value
+                        "length": {
+                            "type": "integer"
+                        },
+                        "min": {
+                            "type": "double"
+                        },
+                        "max": {
+                            "type": "double"
+                        },
+                        "mean": {
+                            "type": "double"
                         }
                     }
                 }
@@ -103,3 +154,38 @@ es_mappings = {
         }
     }
 }
+
+
+def template_version(template):
+    "The version of an index template as stored in ES; 0 if unknown"
+    try:
+        return max(mapping.get("_meta", {}).get("template_version", 0)
+                   for mapping in template["mappings"].values())
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return 0
+
+
+def index_template(prefix, group, shards=1, replicas=1,
+                   refresh_interval="5s"):
+    """An index template for a group of indices (daily or rollover), so
+    that ES creates them with the right mappings and settings as soon as
+    events arrive. The settings favour fast indexing; refreshing (making
+    new events searchable) less often than the default 1 s, and no "_all"
+    field unless searched by default (see DEFAULT_FIELDS)."""
+    default_field = DEFAULT_FIELDS[group]
+    mappings = copy.deepcopy(es_mappings[INDEX_GROUPS[group]])
+    for mapping in mappings.values():
+        if default_field != "_all":
+            mapping["_all"] = {"enabled": False}
+        mapping["_meta"] = {"template_version": TEMPLATE_VERSION}
+    return {
+        "template": "%s-%s-*" % (prefix, group),
+        "order": 0,
+        "settings": {
+            "number_of_shards": shards,
+            "number_of_replicas": replicas,
+            "refresh_interval": refresh_interval,
+            "query": {"default_field": default_field}
+        },
+        "mappings": mappings
+    }
@@ -0,0 +1,79 @@
+"""
+Cheap, thread safe measurements of what the device is doing, for
+exposing as attributes. Updating them is meant to be fast enough to do
+for every event; the heavier work is done when they are read.
+"""
+
+from collections import deque
+import threading
+import time
+
+
+class RateMeter(object):
+
+    """
+    Counts events in one second buckets, and gives the average rate over
+    the last *window* seconds.
+    """
+
+    def __init__(self, window=60, clock=time.time):
+        self.window = window
+        self.clock = clock
+        self.total = 0
+        self._started = int(clock())
+        self._counts = [0] * window
+        self._seconds = [0] * window  # which second each bucket counts
+        self._lock = threading.Lock()
+
+    def add(self, n=1):
+        now = int(self.clock())
+        i = now % self.window
+        with self._lock:
+            if self._seconds[i] != now:
+                self._seconds[i] = now
+                self._counts[i] = 0
+            self._counts[i] += n
+            self.total += n
+
+    def rate(self):
+        "Events per second"
+        now = int(self.clock())
+        with self._lock:
+            count = sum(n for n, second in zip(self._counts, self._seconds)
+                        if now - second < self.window)
+        # don't count time from before we started
+        span = min(self.window, now - self._started + 1)
+        return float(count) / span
+
+
+class RollingPercentiles(object):
+
+    "Keeps the latest *size* measurements, and gives percentiles of them"
+
+    def __init__(self, size=1000):
+        self._values = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, value):
+        with self._lock:
+            self._values.append(value)
+
+    def extend(self, values):
+        "Add several measurements at once"
+        with self._lock:
+            self._values.extend(values)
+
+    def percentiles(self, *percents):
+        "Return the given percentiles (0-100), or NaN if there's no data"
+        with self._lock:
+            values = sorted(self._values)
+        if not values:
+            return [float("nan")] * len(percents)
+        last = len(values) - 1
+        return [values[int(round(last * p / 100.))] for p in percents]
+
+    def percentile(self, percent):
+        return self.percentiles(percent)[0]
@@ -0,0 +1,144 @@
+"""
+Profiling of a running device, to find out where the time goes when
+it can't keep up. While a session is on, the code inside spans is
+timed, and "profiled" spans (the ingest commands and the flush) are
+also run under cProfile, with one profiler per thread. When profiling
+is off, a span costs about as much as a function call.
+"""
+
+import cProfile
+import pstats
+from StringIO import StringIO
+import threading
+import time
+
+
+class _NoSpan(object):
+
+    "Stands in for a span when not profiling"
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span(object):
+
+    def __init__(self, profiler, name, profile):
+        self.profiler = profiler
+        self.name = name
+        self.profile = profile
+
+    def __enter__(self):
+        self.enabled = None  # the profile turned on by this span
+        if self.profile:
+            self.enabled = self.profiler._enter_profile()
+        self.t0 = time.time()
+
+    def __exit__(self, *exc):
+        self.profiler._record(self.name, time.time() - self.t0)
+        if self.enabled is not None:
+            self.profiler._exit_profile(self.enabled)
+
+
+class Profiler(object):
+
+    "Collects timings and cProfile data between start() and stop()"
+
+    def __init__(self):
+        self.active = False
+        self.started = None
+        self._session = 0
+        self._spans = {}  # name: [count, total time, max time]
+        self._profiles = []  # one per thread
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def span(self, name, profile=False):
+        """A context manager timing the code inside it; if *profile*, the
+        code is also profiled with cProfile"""
+        if not self.active:
+            return _NO_SPAN
+        return _Span(self, name, profile)
+
+    def start(self):
+        "Start a new session, forgetting any earlier one"
+        with self._lock:
+            self._session += 1
+            self._spans = {}
+            self._profiles = []
+            self.started = time.time()
+            self.active = True
+
+    def stop(self):
+        "End the session. Return the results as (pstats.Stats, spans)"
+        self.active = False
+        with self._lock:
+            profiles, self._profiles = self._profiles, []
+            spans, self._spans = self._spans, {}
+        stats = None
+        for profile in profiles:
+            # note that this also stops the profile, should it still be on
+            if stats is None:
+                stats = pstats.Stats(profile, stream=StringIO())
+            else:
+                stats.add(profile)
+        return stats, spans
+
+    def _record(self, name, duration):
+        with self._lock:
+            span = self._spans.get(name)
+            if span is None:
+                self._spans[name] = [1, duration, duration]
+            else:
+                span[0] += 1
+                span[1] += duration
+                span[2] = max(span[2], duration)
+
+    def _enter_profile(self):
+        """Turn on the profile of this thread, unless an outer span already
+        did (maybe in an earlier session). Return it if turned on here."""
+        local = self._local
+        if getattr(local, "enabled", None) is not None:
+            return None
+        if getattr(local, "session", None) != self._session:
+            # first time in this thread, this session
+            local.session = self._session
+            local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(local.profile)
+        local.enabled = local.profile
+        local.profile.enable()
+        return local.profile
+
+    def _exit_profile(self, profile):
+        "Turn off a profile turned on by _enter_profile"
+        profile.disable()
+        self._local.enabled = None
+
+
+def summary(stats, spans, duration, limit=30):
+    "A human readable report of a profiling session"
+    lines = ["Profiled for %.1f s." % duration, "",
+             "%-24s %10s %12s %12s %12s" % ("Span", "count", "total (s)",
+                                            "mean (ms)", "max (ms)")]
+    for name, (count, total, longest) in sorted(
+            spans.items(), key=lambda item: -item[1][1]):
+        lines.append("%-24s %10d %12.3f %12.3f %12.3f" % (
+            name, count, total, total / count * 1000, longest * 1000))
+    if stats is not None:
+        lines.extend(["", "Top %d functions by cumulative time:" % limit])
+        stats.stream = StringIO()
+        stats.sort_stats("cumulative").print_stats(limit)
+        lines.append(stats.stream.getvalue())
+    return "\n".join(lines)
+
+
+# one for the whole process, since cProfile works per process anyway
+PROFILER = Profiler()
+span = PROFILER.span
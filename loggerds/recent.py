@@ -0,0 +1,98 @@
+"""
+A short memory of the latest events received, so that questions like
+"what did device X log lately?" can be answered without asking ES;
+which is useful in particular when ES is slow or down.
+"""
+
+from collections import deque
+from itertools import count
+import threading
+
+
+class RecentEvents(object):
+
+    """
+    Keeps the latest encoded events, at most *size* of them, and if
+    *max_bytes* is nonzero, at most that many bytes of encoded events.
+    They are indexed by level (rank), and by device and level, so that
+    looking for e.g. the latest errors doesn't mean going through all
+    the rest. Adding an event, and forgetting the oldest one, take
+    constant time.
+    """
+
+    def __init__(self, size, max_bytes=0):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._all = deque()  # (seq, timestamp, rank, type, data, device)
+        self._levels = {}  # the same entries, per rank
+        self._devices = {}  # and per device, then rank
+        self._seq = count()  # to tell the order of entries from anywhere
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._all)
+
+    def add(self, device, timestamp, doc):
+        """Remember an (encoded) Document, from the given device and with
+        the given timestamp (ms epoch)"""
+        device = device.lower()  # Tango names are case insensitive
+        rank = doc.rank
+        entry = (next(self._seq), timestamp, rank, doc.type, doc.data,
+                 device)
+        with self._lock:
+            self._all.append(entry)
+            self.nbytes += len(doc.data)
+            self._levels.setdefault(rank, deque()).append(entry)
+            self._devices.setdefault(device, {}).setdefault(
+                rank, deque()).append(entry)
+            while len(self._all) > self.size or (
+                    self.max_bytes and self.nbytes > self.max_bytes and
+                    len(self._all) > 1):
+                self._forget_oldest()
+
+    def _forget_oldest(self):
+        # the oldest event is also the oldest of its level, and of its
+        # level from its device
+        _, _, rank, _, data, device = self._all.popleft()
+        self.nbytes -= len(data)
+        self._levels[rank].popleft()
+        levels = self._devices[device]
+        levels[rank].popleft()
+        if not levels[rank]:
+            del levels[rank]
+            if not levels:
+                del self._devices[device]
+
+    def get(self, device=None, min_rank=0, since=0, limit=100):
+        """Return the latest *limit* events from the given device (or all
+        devices) of at least the given rank, with timestamps from *since*
+        on, oldest first, as (timestamp, type, data) tuples."""
+        found = []
+        with self._lock:
+            if device:
+                levels = self._devices.get(device.lower(), {})
+            else:
+                levels = self._levels
+            for rank, events in levels.items():
+                if rank < min_rank:
+                    continue
+                # the latest matching ones of each level; the latest of
+                # them all are among those
+                n_found = 0
+                for entry in reversed(events):
+                    if entry[1] >= since:
+                        found.append(entry)
+                        n_found += 1
+                        if n_found >= limit:
+                            break
+        found.sort()
+        del found[:max(len(found) - limit, 0)]
+        return [entry[1:2] + entry[3:5] for entry in found]
+
+    def to_json(self, *args, **kwargs):
+        "The result of get(), as a JSON encoded list"
+        # the events are already encoded; just put them together
+        return "[%s]" % ",".join(
+            '{"type":"%s","event":%s}' % (doc_type, data)
+            for _, doc_type, data in self.get(*args, **kwargs))
@@ -0,0 +1,87 @@
+"""
+Handling of events that ES did not accept; either they are worth trying
+again later (ES is overloaded, the connection broke...) or they will
+never be accepted (e.g. they don't fit the mapping) and are kept aside
+for inspection.
+"""
+
+from collections import deque
+import json
+import random
+import threading
+import time
+
+from events import json_default
+
+
+# statuses that mean "not right now", as opposed to "never"
+RETRYABLE_STATUSES = frozenset([408, 429, 502, 503, 504])
+
+
+def is_retryable(info):
+    "Decide from a bulk result item whether it's worth sending again"
+    status = info.get("status")
+    # a failed request (e.g. timeout) gives no proper status code
+    return not isinstance(status, int) or status in RETRYABLE_STATUSES
+
+
+class Backoff(object):
+
+    """
+    Exponential backoff with jitter. Each call to failed() returns the
+    time to wait, which doubles on each consecutive failure (up to
+    *maximum*) and is randomized so that several loggers don't all come
+    back at the same moment.
+    """
+
+    def __init__(self, base=1.0, maximum=60.0):
+        self.base = base
+        self.maximum = maximum
+        self.failures = 0
+        self.until = 0  # epoch seconds
+
+    def failed(self):
+        delay = min(self.maximum, self.base * 2 ** self.failures)
+        delay *= random.uniform(0.5, 1.0)
+        self.failures += 1
+        self.until = time.time() + delay
+        return delay
+
+    def succeeded(self):
+        self.failures = 0
+        self.until = 0
+
+    @property
+    def waiting(self):
+        return time.time() < self.until
+
+
+class DeadLetters(object):
+
+    "Keeps the latest *size* events that were permanently refused by ES"
+
+    def __init__(self, size=1000):
+        self._letters = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.total = 0
+
+    def __len__(self):
+        return len(self._letters)
+
+    def add(self, doc, info):
+        with self._lock:
+            self._letters.append((time.time(), info.get("status"),
+                                  info.get("error"), doc))
+            self.total += 1
+
+    def to_json(self):
+        with self._lock:
+            letters = list(self._letters)
+        return json.dumps([{"time": t, "status": status, "error": error,
+                            "event": doc.to_dict()}
+                           for t, status, error, doc in letters],
+                          default=json_default)
+
+    def clear(self):
+        with self._lock:
+            self._letters.clear()
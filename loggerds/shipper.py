@@ -0,0 +1,168 @@
+"""
+Sending of events to ES in bulk requests. The events are split into
+chunks whose size is tuned on the fly from how long the bulk requests
+take and how often ES refuses events, so that pushes stay efficient
+both when there is little traffic and during event storms.
+"""
+
+from itertools import islice, izip
+from multiprocessing.dummy import Pool
+import threading
+import time
+
+from metrics import RollingPercentiles
+from profiling import span
+from retry import is_retryable
+
+
+# all we look at in bulk results; decoding the rest takes several times
+# longer, and blocks everything else in the meantime (see green)
+BULK_RESPONSE_FIELDS = "items.*.status,items.*.error"
+
+
+def _failure(doc, error):
+    "A bulk result for a document that may or may not have been sent"
+    return False, {"index": {"_id": doc.id,
+                             "status": getattr(error, "status_code", "N/A"),
+                             "error": str(error), "exception": error}}
+
+
+def _result(item):
+    "The (ok, item) bulk result from an item of a bulk response"
+    (info,) = item.values()
+    status = info.get("status")
+    return isinstance(status, int) and 200 <= status < 300, item
+
+
+class ChunkSizeController(object):
+
+    """
+    Adjusts the number of events per bulk request, aiming for requests
+    taking about *target_latency* seconds. The size is cut when requests
+    are slow or ES refuses events for being overloaded, and grown slowly
+    when full chunks go through fast. If *target_latency* is 0, the size
+    stays at *size*.
+    """
+
+    def __init__(self, size, target_latency=0, minimum=10, maximum=5000):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.target_latency = target_latency
+        self._size = float(min(max(size, self.minimum), self.maximum))
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return int(self._size)
+
+    def update(self, n_events, latency, n_rejected):
+        "Take the result of a bulk request into account"
+        if not self.target_latency:
+            return
+        with self._lock:
+            if n_rejected:
+                # ES is telling us to slow down
+                size = self._size / 2
+            elif latency > self.target_latency:
+                size = self._size * max(0.5, self.target_latency / latency)
+            elif n_events >= self.size:
+                # only a full chunk says anything about the capacity
+                size = self._size * min(1.25, self.target_latency /
+                                        max(latency, 1e-3))
+            else:
+                return
+            self._size = min(max(size, self.minimum), self.maximum)
+
+
+class BulkShipper(object):
+
+    """
+    Sends encoded Documents to ES, with up to *workers* bulk requests in
+    parallel, each one limited to the controller's current chunk size
+    and to *max_chunk_bytes* bytes. The request *latencies* may be
+    shared with other shippers.
+    """
+
+    def __init__(self, es, controller, max_chunk_bytes, workers=1,
+                 latencies=None):
+        self.es = es
+        self.controller = controller
+        self.max_chunk_bytes = max_chunk_bytes
+        self.workers = workers
+        self.last_latency = None
+        self.latencies = (RollingPercentiles() if latencies is None
+                          else latencies)
+        self._pool = Pool(workers) if workers > 1 else None
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _chunks(self, docs):
+        "Split documents into chunks, as they are needed"
+        chunk = []
+        nbytes = 0
+        for doc in docs:
+            size = doc.nbytes
+            if chunk and (len(chunk) >= self.controller.size or
+                          nbytes + size > self.max_chunk_bytes):
+                yield chunk
+                chunk = []
+                nbytes = 0
+            chunk.append(doc)
+            nbytes += size
+        if chunk:
+            yield chunk
+
+    def _send(self, chunk):
+        "Send one chunk as one bulk request and return the results"
+        t0 = time.time()
+        try:
+            with span("bulk", profile=True):
+                # the documents are already encoded into their bulk lines,
+                # so the body is just these, one after the other
+                response = self.es.bulk(
+                    "".join("%s\n%s\n" % doc.encode() for doc in chunk),
+                    filter_path=BULK_RESPONSE_FIELDS)
+            results = [_result(item) for item in response.get("items", [])]
+        except Exception as e:
+            # the whole request failed (e.g. ES could not be reached)
+            results = [_failure(doc, e) for doc in chunk]
+        # anything we didn't hear back about must be sent again
+        results.extend(_failure(doc, "No result from ES")
+                       for doc in chunk[len(results):])
+        latency = time.time() - t0
+        rejected = sum(1 for ok, item in results
+                       if not ok and is_retryable(item.values()[0]))
+        self.controller.update(len(chunk), latency, rejected)
+        self.last_latency = latency
+        self.latencies.add(latency)
+        return results
+
+    def ship(self, docs):
+        """Send the documents (any iterable), yielding (document, ok, item)
+        for each one, in order, as soon as its chunk is done, in the form
+        of helpers.streaming_bulk. There is a result for every document."""
+        for results in self.ship_chunks(docs):
+            for result in results:
+                yield result
+
+    def ship_chunks(self, docs):
+        """Like ship, but yields a list of the results of each chunk, in
+        order, as soon as the chunk is done."""
+        chunks = self._chunks(docs)
+        while True:
+            # one chunk per worker at a time, so that the chunk size
+            # can be adjusted between rounds
+            batch = list(islice(chunks, self.workers))
+            if not batch:
+                break
+            if self._pool is not None and len(batch) > 1:
+                all_results = self._pool.map(self._send, batch)
+            else:
+                all_results = [self._send(chunk) for chunk in batch]
+            for chunk, results in izip(batch, all_results):
+                yield [(doc, ok, item)
+                       for doc, (ok, item) in izip(chunk, results)]
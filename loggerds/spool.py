@@ -0,0 +1,140 @@
+"""
+A disk backed buffer for events that can't be sent to ES right now,
+e.g. because ES is down or the in-memory queue is full. Events are
+appended to segment files in a directory, in the same form as in a
+bulk request (an action line followed by a source line); the action
+also tells how many times the event was tried already. Segments are
+replayed oldest first, and deleted once ES has acknowledged them. Since
+the files stay around, spooled events also survive a device restart.
+"""
+
+import os
+import threading
+
+from document import Document
+
+
+FSYNC_POLICIES = ("always", "segment", "never")
+SEGMENT_SUFFIX = ".spool"
+
+
+class SpoolFull(Exception):
+    pass
+
+
+class Spool(object):
+
+    """
+    Append-only segment file spool. Writes go to the newest ("active")
+    segment through a buffered file, which is closed and a new one
+    started when it grows past *segment_size* bytes. The *fsync* policy
+    decides when data is forced to disk: after every append ("always"),
+    when a segment is closed ("segment") or up to the OS ("never").
+    If *max_bytes* is nonzero, appends that would grow the spool past it
+    raise SpoolFull.
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024,
+                 fsync="segment", max_bytes=0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("fsync policy must be one of %s, not %r"
+                             % (", ".join(FSYNC_POLICIES), fsync))
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.n_corrupt = 0  # lines that could not be decoded on replay
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._active = None  # file object for the segment being written
+        self._active_size = 0
+        self._sizes = {}  # segment sequence number -> size in bytes
+        self._sealed_size = 0
+        for name in os.listdir(directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                seq = int(name[:-len(SEGMENT_SUFFIX)])
+                self._sizes[seq] = os.path.getsize(self._path(seq))
+                self._sealed_size += self._sizes[seq]
+        self._next_seq = max(self._sizes) + 1 if self._sizes else 0
+
+    def _path(self, seq):
+        return os.path.join(self.directory,
+                            "%020d%s" % (seq, SEGMENT_SUFFIX))
+
+    @property
+    def nbytes(self):
+        "Total size of all segments on disk"
+        return self._sealed_size + self._active_size
+
+    def __len__(self):
+        "The number of segments, including the one being written"
+        return len(self._sizes) + (self._active is not None)
+
+    def append(self, docs):
+        "Write some documents to the spool"
+        lines = "".join("%s\n%s\n" % doc.to_lines() for doc in docs)
+        with self._lock:
+            if self.max_bytes and self.nbytes + len(lines) > self.max_bytes:
+                raise SpoolFull("Spool would grow beyond %d bytes"
+                                % self.max_bytes)
+            if self._active is None:
+                self._active_seq = self._next_seq
+                self._next_seq += 1
+                self._active = open(self._path(self._active_seq), "ab")
+            self._active.write(lines)
+            self._active_size += len(lines)
+            if self.fsync == "always":
+                self._active.flush()
+                os.fsync(self._active.fileno())
+            if self._active_size >= self.segment_size:
+                self._seal()
+
+    def _seal(self):
+        "Close the active segment so that it can be replayed"
+        if self._active is None:
+            return
+        self._active.flush()
+        if self.fsync != "never":
+            os.fsync(self._active.fileno())
+        self._active.close()
+        self._sizes[self._active_seq] = self._active_size
+        self._sealed_size += self._active_size
+        self._active = None
+        self._active_size = 0
+
+    def segments(self):
+        """Return the sequence numbers of all segments that are ready for
+        replay, oldest first. This closes the active segment."""
+        with self._lock:
+            self._seal()
+            return sorted(self._sizes)
+
+    def read(self, seq):
+        "Return the documents stored in a segment"
+        docs = []
+        with open(self._path(seq), "rb") as f:
+            for action in f:
+                data = next(f, "")
+                if not data.endswith("\n"):
+                    # most likely a partial write from a crash
+                    self.n_corrupt += 1
+                    break
+                try:
+                    docs.append(Document.from_lines(action.rstrip("\n"),
+                                                    data.rstrip("\n")))
+                except (ValueError, KeyError):
+                    self.n_corrupt += 1
+        return docs
+
+    def ack(self, seq):
+        "The events in the segment are safely stored; forget about them"
+        with self._lock:
+            os.remove(self._path(seq))
+            self._sealed_size -= self._sizes.pop(seq)
+
+    def close(self):
+        with self._lock:
+            self._seal()
@@ -0,0 +1,75 @@
+"""
+Connection class for the ES client that gzip compresses request bodies.
+Bulk requests are mostly repetitive JSON, so they shrink a lot. The
+connections are the normal urllib3 ones, i.e. persistent (keep-alive)
+and pooled per node.
+
+In green mode (see green), compressing a large body would hold up the
+gevent loop, and with it the device, for several milliseconds, so it's
+done in a native thread instead. zlib lets go of the GIL while working.
+"""
+
+import sys
+import zlib
+
+from elasticsearch import Urllib3HttpConnection
+
+
+COMPRESS_LEVEL = 3  # higher levels cost much more CPU for little gain
+NATIVE_COMPRESS_BYTES = 64 * 1024  # smaller is quicker than a thread switch
+
+
+def gzip_compress(data):
+    if isinstance(data, unicode):
+        data = data.encode("utf-8")
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)  # gzip format
+    return compressor.compress(data) + compressor.flush()
+
+
+def is_green():
+    "Whether gevent has monkey patched the standard library"
+    monkey = sys.modules.get("gevent.monkey")
+    return monkey is not None and monkey.is_module_patched("socket")
+
+
+def gzip_compress_native(data):
+    "Compress large data in gevent's thread pool, letting the loop go on"
+    if len(data) < NATIVE_COMPRESS_BYTES:
+        return gzip_compress(data)
+    from gevent import get_hub
+    return get_hub().threadpool.apply(gzip_compress, (data,))
+
+
+class _CompressingPool(object):
+
+    "Wraps a urllib3 connection pool, compressing any request body"
+
+    def __init__(self, pool, compress=gzip_compress):
+        self._pool = pool
+        self._compress = compress
+
+    def urlopen(self, method, url, body=None, headers=None, **kwargs):
+        if body:
+            body = self._compress(body)
+            headers = dict(headers or {}, **{"content-encoding": "gzip"})
+        return self._pool.urlopen(method, url, body, headers=headers,
+                                  **kwargs)
+
+    def close(self):
+        self._pool.close()
+
+
+class CompressedHttpConnection(Urllib3HttpConnection):
+
+    """
+    Sends gzip compressed requests, and asks for compressed responses.
+    ES accepts compressed requests as long as http.compression is not
+    disabled on the nodes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CompressedHttpConnection, self).__init__(*args, **kwargs)
+        self.headers["accept-encoding"] = "gzip,deflate"
+        self.pool = _CompressingPool(
+            self.pool, gzip_compress_native if is_green() else gzip_compress)
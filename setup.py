@@ -5,5 +5,8 @@ setup(name = "tangods-logger",
       version = "1.0.2",
       description = "Logger device which logs stuff to Elasticsearch",
       packages = ['loggerds'],
-      scripts = ['scripts/loggerds']
+      # the templates and requests are written for ES 2.x
+      install_requires = ['elasticsearch >= 2.4, < 3'],
+      scripts = ['scripts/loggerds', 'scripts/loggerds-backfill',
+                 'scripts/loggerds-green']
 )
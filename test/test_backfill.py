@@ -0,0 +1,154 @@
+"""Tests for the import of historical log files."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from elasticsearch import TransportError
+from mock import MagicMock, patch
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds import backfill
+from loggerds.document import Document
+
+TANGO_EVENT = """<log4j:event logger="sys/tg_test/%d" timestamp="%d"
+ level="WARN" thread="47">
+<log4j:message><![CDATA[Fell & <broke> %d]]></log4j:message>
+<log4j:NDC><![CDATA[]]></log4j:NDC>
+</log4j:event>
+"""
+
+
+def tango_events(n, t0=1459900800000):
+    return "".join(TANGO_EVENT % (i, t0 + i, i) for i in range(n))
+
+
+def ship_all(docs):
+    for doc in docs:
+        yield doc, True, {"index": {"status": 201}}
+
+
+class BlockTestCase(unittest.TestCase):
+
+    def test_blocks_end_with_complete_events(self):
+        data = tango_events(10)
+        blocks = list(backfill.read_blocks(StringIO(data), "tango", 300))
+        assert "".join(block for block, _ in blocks) == data
+        for block, offset in blocks:
+            assert block.count("<log4j:event ") == block.count(
+                "</log4j:event>")
+            assert data[:offset].endswith(block)
+
+    def test_spool_blocks_keep_lines_together(self):
+        data = "".join('{"index": {}}\n{"n": %d}\n' % i for i in range(10))
+        for block, _ in backfill.read_blocks(StringIO(data), "spool", 20):
+            assert block.count("\n") % 2 == 0
+
+    def test_starts_at_file_position(self):
+        f = StringIO("a\nb\nc\n")
+        f.seek(2)
+        assert list(backfill.read_blocks(f, "alarms")) == [("b\nc\n", 6)]
+
+    def test_keeps_the_rest_of_the_file(self):
+        f = StringIO("a\nb")
+        assert list(backfill.read_blocks(f, "alarms", 1)) == [
+            ("a\n", 2), ("b", 3)]
+
+
+class ParseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        backfill._start_worker("tango", "hash", False)
+
+    def test_parses_tango_events(self):
+        events, n_bad = backfill.parse_tango(tango_events(2))
+        assert n_bad == 0
+        assert events[1] == ["1459900800001", "WARN", "sys/tg_test/1",
+                             "Fell & <broke> 1", "", "47"]
+
+    def test_counts_broken_tango_events(self):
+        events, n_bad = backfill.parse_tango(
+            '<log4j:event level="INFO"></log4j:event>' + tango_events(1))
+        assert len(events) == 1
+        assert n_bad == 1
+
+    def test_builds_log_documents(self):
+        docs, _ = backfill.build_documents("tango", tango_events(1))
+        doc_type, index, doc_id, action, data = docs[0]
+        assert (doc_type, index) == ("log", "tango-logs-2016.04.06")
+        assert json.loads(action)["index"]["_id"] == doc_id
+        assert json.loads(data)["message"] == "Fell & <broke> 0"
+
+    def test_builds_alarm_documents(self):
+        alarm = {"name": "A", "timestamp": 1459900800000,
+                 "severity": "ALARM", "values": []}
+        docs, n_bad = backfill.build_documents(
+            "alarms", json.dumps(alarm) + "\nnot json\n")
+        assert n_bad == 1
+        assert docs[0][:2] == ("alarm", "tango-alarms-2016.04.06")
+
+    def test_ids_only_depend_on_the_event(self):
+        first, _ = backfill.build_documents("tango", tango_events(1))
+        again, _ = backfill.build_documents("tango", tango_events(1))
+        assert first[0][2] == again[0][2]
+
+
+class ImporterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "tango.log")
+        with open(self.path, "w") as f:
+            f.write(tango_events(100))
+        self.checkpoint = os.path.join(self.directory, "checkpoint.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_importer(self):
+        importer = backfill.Importer(
+            MagicMock(), checkpoints=backfill.Checkpoints(self.checkpoint),
+            processes=1, block_size=1000)
+        importer.shipper = MagicMock()
+        importer.shipper.ship.side_effect = ship_all
+        return importer
+
+    def test_imports_file(self):
+        importer = self.make_importer()
+        importer.import_file(self.path)
+        assert importer.n_events == 100
+        sent = [doc for call in importer.shipper.ship.call_args_list
+                for doc in call[0][0]]
+        assert [json.loads(doc.data)["device"] for doc in sent] == [
+            "sys/tg_test/%d" % i for i in range(100)]
+
+    def test_continues_from_checkpoint(self):
+        importer = self.make_importer()
+        importer.shipper.ship.side_effect = [ship_all(["doc"] * 3), IOError]
+        self.assertRaises(IOError, importer.import_file, self.path)
+        offset = backfill.Checkpoints(self.checkpoint).get(self.path)
+        assert 0 < offset < os.path.getsize(self.path)
+
+        importer = self.make_importer()
+        importer.import_file(self.path)
+        assert 0 < importer.n_events < 100
+        assert backfill.Checkpoints(self.checkpoint).get(
+            self.path) == os.path.getsize(self.path)
+
+    def test_retries_busy_events(self):
+        importer = self.make_importer()
+        busy = {"index": {"status": 429}}
+        importer.shipper.ship.side_effect = lambda docs: [
+            (doc, False, busy) for doc in docs]
+        doc = Document("log", "tango-logs-2016.04.06", "x", {})
+        with patch.object(backfill.time, "sleep") as sleep:
+            self.assertRaises(TransportError, importer._send, [doc])
+        assert sleep.call_count == importer.max_retries
+        assert importer.shipper.ship.call_count == importer.max_retries + 1
@@ -0,0 +1,126 @@
+"""Tests for the in-memory event buffer."""
+
+import os
+import sys
+import unittest
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.buffer import EventBuffer
+from loggerds.document import Document
+from loggerds.events import LEVEL_RANKS
+
+DEBUG, INFO, ERROR = (LEVEL_RANKS[level] for level in ("DEBUG", "INFO",
+                                                       "ERROR"))
+
+
+def make_doc(n, size=0, rank=INFO):
+    doc = Document("log", "tango-logs-2016.04.05", "id%d" % n,
+                   {"n": n, "payload": "x" * size}, rank=rank)
+    doc.encode()
+    return doc
+
+
+class EventBufferTestCase(unittest.TestCase):
+
+    def test_keeps_order(self):
+        buf = EventBuffer(10)
+        docs = [make_doc(n) for n in range(5)]
+        assert buf.put_many(docs) == (5, 0, [])
+        assert len(buf) == 5
+        assert buf.nbytes == sum(doc.nbytes for doc in docs)
+        assert list(buf.drain()) == docs
+        assert buf.empty() and buf.nbytes == 0
+
+    def test_limits_number_of_events(self):
+        buf = EventBuffer(3)
+        docs = [make_doc(n) for n in range(5)]
+        assert buf.put_many(docs) == (3, 0, docs[3:])
+
+    def test_limits_bytes(self):
+        small = make_doc(0)
+        buf = EventBuffer(100, max_bytes=small.nbytes * 3)
+        big = make_doc(1, size=small.nbytes * 3)
+        assert buf.put_many([big]) == (0, 0, [big])
+        buf.put_many([make_doc(n) for n in range(5)])
+        assert len(buf) == 3
+        assert buf.nbytes <= buf.max_bytes
+
+    def test_requeues_at_the_front(self):
+        buf = EventBuffer(4)
+        docs = [make_doc(n) for n in range(6)]
+        buf.put_many(docs[3:5])
+        assert buf.requeue(docs[:3]) == docs[:1]
+        assert len(buf) == 4
+        assert buf.nbytes == sum(doc.nbytes for doc in docs[1:5])
+        assert list(buf.drain()) == docs[1:5]
+
+    def test_requeues_in_one_piece(self):
+        buf = EventBuffer(10)
+        docs = [make_doc(n) for n in range(6)]
+        buf.put_many(docs[4:])
+        buf.requeue(docs[2:4])
+        buf.requeue(docs[:2])
+        batch = buf.drain()
+        assert len(batch) == 6
+        assert list(batch) == docs
+        assert batch.segments[:2] == [docs[:2], docs[2:4]]
+        assert buf.empty()
+        assert buf.requeue(batch) == []  # e.g. when ES is down
+        assert buf.nbytes == batch.nbytes
+        assert list(buf.drain()) == docs
+
+    def test_requeued_events_are_not_pushed_out(self):
+        buf = EventBuffer(2)
+        debug = [make_doc(n, rank=DEBUG) for n in range(2)]
+        buf.requeue(debug)
+        error = make_doc(2, rank=ERROR)
+        assert buf.put_many([error]) == (0, 0, [error])
+
+    def test_drains_most_important_first(self):
+        buf = EventBuffer(10)
+        debug, error = make_doc(0, rank=DEBUG), make_doc(1, rank=ERROR)
+        buf.put_many([debug, error])
+        assert list(buf.drain()) == [error, debug]
+
+    def test_more_important_events_push_out_less_important(self):
+        buf = EventBuffer(2)
+        debug = [make_doc(n, rank=DEBUG) for n in range(2)]
+        buf.put_many(debug)
+        error = make_doc(2, rank=ERROR)
+        assert buf.put_many([error]) == (1, 0, debug[:1])
+        # but not the other way around
+        info = make_doc(3, rank=INFO)
+        assert buf.put_many([info]) == (1, 0, debug[1:])
+        another_info = make_doc(4, rank=INFO)
+        assert buf.put_many([another_info]) == (0, 0, [another_info])
+        assert list(buf.drain()) == [error, info]
+
+    def test_too_big_events_push_nothing_out(self):
+        debug = [make_doc(n, rank=DEBUG) for n in range(50)]
+        nbytes = sum(doc.nbytes for doc in debug)
+        buf = EventBuffer(100, max_bytes=nbytes)
+        assert buf.put_many(debug) == (50, 0, [])
+        huge = make_doc(50, size=nbytes, rank=ERROR)
+        assert buf.put_many([huge]) == (0, 0, [huge])
+        assert list(buf.drain()) == debug
+
+    def test_sheds_above_watermark(self):
+        buf = EventBuffer(10, watermarks={DEBUG: 0.2})
+        docs = [make_doc(n, rank=DEBUG) for n in range(5)]
+        assert buf.put_many(docs) == (2, 3, [])
+        assert buf.put_many([make_doc(5, rank=INFO)]) == (1, 0, [])
+        assert buf.dropped[DEBUG] == 3
+
+    def test_samples_above_watermark(self):
+        buf = EventBuffer(100, watermarks={DEBUG: 0.0}, sample_every=10)
+        kept, shed, _ = buf.put_many([make_doc(n, rank=DEBUG)
+                                      for n in range(100)])
+        assert (kept, shed) == (10, 90)
+
+    def test_counts_dropped_events(self):
+        buf = EventBuffer(10)
+        buf.count_dropped([make_doc(0, rank=ERROR), make_doc(1, rank=ERROR)])
+        assert buf.dropped[ERROR] == 2
@@ -0,0 +1,95 @@
+"""Tests for the client side batching of events."""
+
+import json
+import os
+import sys
+import time
+import unittest
+
+from mock import MagicMock
+from PyTango import DevFailed
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.client import LogBatcher
+
+LOG_FIELDS = ["1459900800000", "INFO", "sys/tg_test/1", "hello", "", ""]
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.005)
+
+
+class LogBatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = MagicMock()
+
+    def make_batcher(self, **kwargs):
+        batcher = LogBatcher(self.proxy, **kwargs)
+        self.addCleanup(batcher.close)
+        return batcher
+
+    def test_sends_when_enough_events(self):
+        batcher = self.make_batcher(max_events=2, max_delay=60)
+        batcher.log(*LOG_FIELDS)
+        time.sleep(0.05)
+        self.proxy.command_inout.assert_not_called()
+        batcher.log(*LOG_FIELDS)
+        wait_for(lambda: self.proxy.command_inout.called)
+        self.proxy.command_inout.assert_called_once_with(
+            "LogBatch", LOG_FIELDS * 2)
+
+    def test_sends_after_max_delay(self):
+        batcher = self.make_batcher(max_events=100, max_delay=0.05)
+        batcher.alarm({"name": "A"})
+        wait_for(lambda: self.proxy.command_inout.called)
+        name, data = self.proxy.command_inout.call_args[0]
+        assert name == "AlarmBatch"
+        assert json.loads(data) == {"name": "A"}
+
+    def test_sends_after_max_delay_when_idle(self):
+        batcher = self.make_batcher(max_events=100, max_delay=0.05)
+        time.sleep(0.2)  # the thread is waiting, with nothing to do
+        batcher.log(*LOG_FIELDS)
+        wait_for(lambda: self.proxy.command_inout.called, timeout=1.0)
+
+    def test_keeps_events_that_could_not_be_sent(self):
+        batcher = self.make_batcher(max_events=100, max_delay=60)
+        batcher.log(*LOG_FIELDS)
+        batcher.alarm("{}")
+        self.proxy.command_inout.side_effect = [None, DevFailed("down")]
+        self.assertRaises(DevFailed, batcher.flush)
+        # the logs got through, the alarm did not
+        self.proxy.command_inout.reset_mock()
+        self.proxy.command_inout.side_effect = None
+        batcher.flush()
+        self.proxy.command_inout.assert_called_once_with("AlarmBatch", "{}")
+
+    def test_retries_in_the_background(self):
+        batcher = self.make_batcher(max_events=1, max_delay=0.05)
+        self.proxy.command_inout.side_effect = [DevFailed("down"), None]
+        batcher.log(*LOG_FIELDS)
+        wait_for(lambda: self.proxy.command_inout.call_count == 2)
+        assert isinstance(batcher.last_error, DevFailed)
+        assert self.proxy.command_inout.call_args[0] == ("LogBatch",
+                                                         LOG_FIELDS)
+
+    def test_drops_oldest_events_beyond_max_pending(self):
+        batcher = self.make_batcher(max_events=100, max_delay=60,
+                                    max_pending=2)
+        for n in range(3):
+            batcher.log(str(n), *LOG_FIELDS[1:])
+        self.proxy.command_inout.side_effect = DevFailed("down")
+        self.assertRaises(DevFailed, batcher.flush)
+        assert batcher.dropped == 1
+        self.proxy.command_inout.side_effect = None
+        batcher.flush()
+        logs = self.proxy.command_inout.call_args[0][1]
+        assert logs[::6] == ["1", "2"]
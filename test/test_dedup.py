@@ -0,0 +1,81 @@
+"""Tests for the collapsing of repeated log messages."""
+
+import os
+import sys
+import unittest
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.dedup import LogDeduplicator
+
+
+def source(timestamp, message="oops", device="my/test/device"):
+    return {"@timestamp": str(timestamp), "level": "ERROR",
+            "device": device, "message": message, "ndc": "", "thread": ""}
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class LogDeduplicatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.dedup = LogDeduplicator(10, max_keys=2, clock=self.clock)
+
+    def test_passes_on_first_event(self):
+        first = source(1000)
+        assert self.dedup.add(first) == [first]
+        assert first["count"] == 1
+        assert self.dedup.expire() == []
+
+    def test_collapses_repeats_within_window(self):
+        self.dedup.add(source(1000))
+        for timestamp in range(1001, 1100):
+            assert self.dedup.add(source(timestamp)) == []
+        assert self.dedup.n_suppressed == 99
+        assert self.dedup.expire() == []  # window not over yet
+
+        self.clock.now = 10
+        (summary,) = self.dedup.expire()
+        assert summary["count"] == 99
+        assert summary["first_seen"] == summary["@timestamp"] == 1001
+        assert summary["last_seen"] == 1099
+        assert summary["message"] == "oops"
+        assert len(self.dedup) == 0
+
+    def test_starts_new_window_after_the_last(self):
+        self.dedup.add(source(1000))
+        self.dedup.add(source(1001))
+        self.clock.now = 11
+        summary, event = self.dedup.add(source(12000))
+        assert summary["count"] == 1
+        assert event["@timestamp"] == "12000"
+
+    def test_summarizes_least_recent_message_when_full(self):
+        self.dedup.add(source(1000, "a"))
+        self.dedup.add(source(1001, "a"))
+        self.dedup.add(source(1002, "b"))
+        self.dedup.add(source(1003, "a"))  # now "b" is the least recent
+        out = self.dedup.add(source(1004, "c"))
+        assert [s["message"] for s in out] == ["c"]  # "b" had no repeats
+        assert len(self.dedup) == 2
+        out = self.dedup.add(source(1005, "d"))
+        assert [(s["message"], s["count"]) for s in out] == [("d", 1),
+                                                              ("a", 2)]
+
+    def test_flushes_everything(self):
+        self.dedup.add(source(1000, "a"))
+        self.dedup.add(source(1001, "a"))
+        self.dedup.add(source(1002, "b"))
+        (summary,) = self.dedup.flush()
+        assert summary["message"] == "a"
+        assert len(self.dedup) == 0
@@ -3,6 +3,7 @@
 from datetime import datetime
 import json
 import sys
+import tempfile
 import os
 
 from mock import MagicMock
@@ -11,10 +12,41 @@ from mock import MagicMock
 path = os.path.join(os.path.dirname(__file__), os.pardir)
 sys.path.insert(0, os.path.abspath(path))
 
-from PyTango import DevState
+from PyTango import DevState, DevFailed
 from devicetest import DeviceTestCase
-from elasticsearch import ConnectionError
+from elasticsearch import ConnectionError, NotFoundError, TransportError
 from loggerds import device as logger
+from loggerds import ids
+from loggerds.document import Document
+from loggerds.events import EVENT_MEMBERS
+
+
+# how the timestamp of the test alarms ends up in ES
+ALARM_TIMESTAMP = datetime.utcfromtimestamp(12345. / 1000.).isoformat()
+
+
+def bulk_ok(body, **kwargs):
+    "Stand-in for the bulk API, where everything works"
+    return {"items": [{"index": {"status": 201}}] * (body.count("\n") / 2)}
+
+
+def bulk_events(body):
+    "Return the events in a bulk request body, as dicts"
+    lines = body.splitlines()
+    return [Document.from_lines(action, data).to_dict()
+            for action, data in zip(lines[::2], lines[1::2])]
+
+
+def sent_events(bulk):
+    "Return all events that were given to a mocked bulk API, as dicts"
+    return [event for (body,), _ in bulk.call_args_list
+            for event in bulk_events(body)]
+
+
+def last_sent(bulk):
+    "Return the events given in the latest call to a mocked bulk API"
+    (body,), _ = bulk.call_args
+    return bulk_events(body)
 
 
 # Device test case
@@ -24,7 +56,9 @@ class LoggerTestCase(DeviceTestCase):
     device = logger.Logger
     properties = {
         'ElasticsearchHost': 'test-es-host',
+        'HealthCheckPeriod': 0,  # ping before each push
         'QueueSize': 3,
+        'AlarmQueueSize': 3,
         'PushPeriod': 0  # turn off polling for the tests
     }
 
@@ -36,18 +70,18 @@ class LoggerTestCase(DeviceTestCase):
         cls.es = MagicMock()
         cls.Elasticsearch.return_value = cls.es
         cls.indices = cls.es.indices
-        cls.helpers = logger.helpers = MagicMock()
-        cls.uuid4 = logger.uuid4 = MagicMock()
+        cls.es.bulk.side_effect = bulk_ok
+        cls.uuid4 = ids.uuid4 = MagicMock()
         cls.uuid4.return_value = "uuid4"
-        cls.time = logger.time = MagicMock()
-        cls.time.strftime.return_value = "2016.04.05"
 
     def test_state(self):
         assert self.device.state() == DevState.INIT
 
     def test_connects_to_es(self):
         host = self.properties["ElasticsearchHost"]
-        self.Elasticsearch.assert_called_with(host)
+        (args, kwargs) = self.Elasticsearch.call_args
+        assert args == ([host],)
+        assert "connection_class" not in kwargs  # no compression
 
     def test_alarms_if_es_unpingable(self):
         self.es.ping.return_value = False
@@ -59,23 +93,98 @@ class LoggerTestCase(DeviceTestCase):
         self.device.PushQueuedEventsToES()
         assert self.device.state() == DevState.FAULT
 
-    def test_checks_if_index_exists(self):
+    def test_installs_index_templates(self):
+        self.indices.get_template.side_effect = NotFoundError
+        self.device.PushQueuedEventsToES()
+        self.device.PushQueuedEventsToES()  # only done once
+        assert self.indices.put_template.call_count == 2
+        for (name, template), _ in self.indices.put_template.call_args_list:
+            group = name.split("-")[1]
+            assert template == logger.index_template(
+                "tango", group, shards=1, replicas=1, refresh_interval="5s")
+            assert template["template"] == "tango-%s-*" % group
+        self.indices.create.assert_not_called()  # left to ES
+
+    def test_keeps_newer_index_templates(self):
+        self.indices.get_template.side_effect = lambda name: {
+            name: {"mappings": {"log": {"_meta": {
+                "template_version": logger.TEMPLATE_VERSION + 1}}}}}
+        self.device.PushQueuedEventsToES()
+        self.indices.put_template.assert_not_called()
+
+    def test_waits_for_index_templates(self):
+        self.indices.get_template.side_effect = NotFoundError
+        self.indices.put_template.side_effect = TransportError(500, "oops")
+        self.device.Log(["12345", "INFO", "my/test/device",
+                         "testing, testing", "wat", "123"])
+        self.device.PushQueuedEventsToES()
+        self.es.bulk.assert_not_called()
+        assert self.device.QueueEvents == 1
+
+    def test_reports_queue_size(self):
+        event = ["12345", "INFO", "my/test/device",
+                 "testing, testing", "wat", "123"]
+        assert self.device.QueueEvents == 0
+        assert self.device.QueueBytes == 0
+        self.device.Log(event)
+        self.device.Log(event)
+        assert self.device.QueueEvents == 2
+        assert self.device.QueueBytes > len("".join(event)) * 2
+
+    def test_reports_metrics(self):
         self.indices.exists.return_value = True
         event = ["12345", "INFO", "my/test/device",
                  "testing, testing", "wat", "123"]
         self.device.Log(event)
+        self.device.Log(event)
+        assert self.device.LogRate > 0
+        assert self.device.AlarmRate == 0
         self.device.PushQueuedEventsToES()
-        self.indices.exists.assert_called_once_with("tango-logs-2016.04.05")
-        self.indices.create.assert_not_called()  # don't create existing indices
+        assert self.device.ShippedEvents == 2
+        assert self.device.ShippedBytes > len("".join(event)) * 2
+        assert self.device.RetriedEvents == 0
+        assert self.device.TimeSinceLastPush < 1
+        assert 0 <= self.device.BulkLatencyP50 <= self.device.BulkLatencyP99
+        assert 0 <= self.device.FlushTimeP50 <= self.device.FlushTimeP99
 
-    def test_creates_missing_index(self):
-        self.indices.exists.return_value = False
-        event = ["12345", "INFO", "my/test/device", "testing, testing",
-                 "wat", "123"]
-        self.device.Log(event)
+    def test_keeps_alarms_apart(self):
+        self.indices.exists.return_value = True
+        for message in ["one", "two", "three"]:
+            self.device.Log(["12345", "INFO", "my/test/device",
+                             message, "", ""])
+        self.device.TestAlarm("alarm")  # room, even with the logs queued
+        assert self.device.QueueEvents == 4
+        assert self.device.AlarmQueueEvents == 1
+        self.device.PushQueuedEventsToES()
+        # alarms go first, in a request of their own
+        (alarms, _), (logs, _) = self.es.bulk.call_args_list
+        assert [e["_type"] for e in bulk_events(alarms[0])] == ["alarm"]
+        assert [e["_type"] for e in bulk_events(logs[0])] == ["log"] * 3
+        assert 0 <= self.device.AlarmDelayP50 <= self.device.AlarmDelayP99
+        assert 0 <= self.device.LogDelayP50 <= self.device.LogDelayP99
+
+    def test_remembers_recent_events(self):
+        for level, message in [("INFO", "one"), ("ERROR", "two"),
+                               ("DEBUG", "three")]:
+            self.device.Log(["12345", level, "my/test/device",
+                             message, "", ""])
+        self.device.Log(["12346", "INFO", "other/test/device", "four",
+                         "", ""])
+        recent = json.loads(self.device.GetRecent(["my/test/device"]))
+        assert [e["event"]["message"] for e in recent] == ["one", "two",
+                                                           "three"]
+        recent = json.loads(self.device.GetRecent(["", "INFO", "12346"]))
+        assert [e["event"]["message"] for e in recent] == ["four"]
+
+    def test_profiles(self):
+        self.device.StartProfiling()
+        self.device.Log(["12345", "INFO", "my/test/device", "hello", "", ""])
         self.device.PushQueuedEventsToES()
-        self.indices.create.assert_called_once_with(
-            "tango-logs-2016.04.05", {"mappings": logger.es_mappings["log"]})
+        report = self.device.StopProfiling("")
+        assert "Log" in report
+        assert "flush" in report
+        assert "Top 30 functions by cumulative time" in report
+        assert self.device.StopProfiling("") == "Not profiling."
 
     def test_handles_log_event(self):
         self.indices.exists.return_value = True
@@ -86,10 +195,10 @@ class LoggerTestCase(DeviceTestCase):
         expected = {
             "_id": "uuid4",
             "_type": "log",
-            "_index": "tango-logs-2016.04.05",
-            "_source": dict(zip(logger.EVENT_MEMBERS, event))
+            "_index": "tango-logs-1970.01.01",
+            "_source": dict(zip(EVENT_MEMBERS, event))
         }
-        self.helpers.bulk.assert_called_once_with(self.es, [expected])
+        assert sent_events(self.es.bulk) == [expected]
 
     def test_handles_alarm_event(self):
         self.indices.exists.return_value = True
@@ -111,11 +220,11 @@ class LoggerTestCase(DeviceTestCase):
         expected = {
             "_id": "uuid4",
             "_type": "alarm",
-            "_index": "tango-alarms-2016.04.05",
-            "_timestamp": datetime.utcfromtimestamp(12345. / 1000.),
+            "_index": "tango-alarms-1970.01.01",
+            "_timestamp": ALARM_TIMESTAMP,
             "_source": {
                 "description": "testing, testing",
-                "@timestamp": datetime.utcfromtimestamp(12345. / 1000.),
+                "@timestamp": ALARM_TIMESTAMP,
                 "host": "test-host-1",
                 "device": "just/testing/1",
                 "message": "TESTING",
@@ -124,11 +233,12 @@ class LoggerTestCase(DeviceTestCase):
                 "priority": 100,
                 "instance": "fisk",
                 "values": [{"attribute": "some/device/1/attribute",
-                            "value": "278.5", "type": "float"}],
+                            "value": "278.5", "type": "float",
+                            "number": 278.5}],
                 "formula": "This is a test"
             }
         }
-        self.helpers.bulk.assert_called_once_with(self.es, [expected])
+        assert sent_events(self.es.bulk) == [expected]
 
     def test_handles_queue_full(self):
         self.indices.exists.return_value = True
@@ -148,11 +258,11 @@ class LoggerTestCase(DeviceTestCase):
         expected = {
             "_id": "uuid4",
             "_type": "alarm",
-            "_index": "tango-alarms-2016.04.05",
-            "_timestamp": datetime.utcfromtimestamp(12345. / 1000.),
+            "_index": "tango-alarms-1970.01.01",
+            "_timestamp": ALARM_TIMESTAMP,
             "_source": {
                 "description": "testing, testing",
-                "@timestamp": datetime.utcfromtimestamp(12345. / 1000.),
+                "@timestamp": ALARM_TIMESTAMP,
                 "host": "test-host-1",
                 "device": "just/testing/1",
                 "message": "TESTING",
@@ -161,12 +271,260 @@ class LoggerTestCase(DeviceTestCase):
                 "priority": 100,
                 "instance": "fisk",
                 "values": [{"attribute": "some/device/1/attribute",
-                            "value": "278.5", "type": "float"}],
+                            "value": "278.5", "type": "float",
+                            "number": 278.5}],
                 "formula": "This is a test"
             }
         }
         self.device.Alarm(json.dumps(event))
         self.device.Alarm(json.dumps(event))
         self.device.Alarm(json.dumps(event))
-        self.device.Alarm(json.dumps(event))
-        self.helpers.bulk.assert_called_once_with(self.es, [expected] * 3)
+        self.device.Alarm(json.dumps(event))  # dropped, queue is full
+        # the ingest commands must never push by themselves
+        self.es.bulk.assert_not_called()
+        assert self.device.state() == DevState.ALARM
+        self.device.PushQueuedEventsToES()
+        assert sent_events(self.es.bulk) == [expected] * 3
+
+    def test_important_events_push_out_less_important(self):
+        self.indices.exists.return_value = True
+        debug = ["12345", "DEBUG", "my/test/device", "chatter", "wat", "123"]
+        fatal = ["12346", "FATAL", "my/test/device", "help!", "wat", "123"]
+        self.device.LogBatch(debug * 3)
+        assert self.device.LogBatch(fatal) == 1
+        assert list(self.device.DroppedPerLevel) == [1, 0, 0, 0, 0]
+        assert self.device.DroppedEvents == 1
+        self.device.PushQueuedEventsToES()
+        sent = sent_events(self.es.bulk)
+        assert [e["_source"]["level"] for e in sent] == ["FATAL", "DEBUG",
+                                                         "DEBUG"]
+
+    def test_routes_events_by_their_timestamp(self):
+        self.indices.exists.return_value = True
+        # 2016-04-05 23:59:59.999 and 2016-04-06 00:00:00 UTC
+        event1 = ["1459900799999", "INFO", "my/test/device", "late",
+                  "wat", "123"]
+        event2 = ["1459900800000", "INFO", "my/test/device", "early",
+                  "wat", "123"]
+        self.device.LogBatch(event1 + event2)
+        self.device.PushQueuedEventsToES()
+        events = sent_events(self.es.bulk)
+        assert [e["_index"] for e in events] == ["tango-logs-2016.04.05",
+                                                 "tango-logs-2016.04.06"]
+
+    def test_handles_log_batch(self):
+        self.indices.exists.return_value = True
+        event1 = ["12345", "INFO", "my/test/device",
+                  "testing, testing", "wat", "123"]
+        event2 = ["12346", "DEBUG", "my/test/device",
+                  "testing again", "wat", "123"]
+        queued = self.device.LogBatch(event1 + event2)
+        self.device.PushQueuedEventsToES()
+        assert queued == 2
+        expected = [{
+            "_id": "uuid4",
+            "_type": "log",
+            "_index": "tango-logs-1970.01.01",
+            "_source": dict(zip(EVENT_MEMBERS, event))
+        } for event in (event1, event2)]
+        assert sent_events(self.es.bulk) == expected
+
+    def test_rejects_incomplete_log_batch(self):
+        with self.assertRaises(DevFailed):
+            self.device.LogBatch(["12345", "INFO", "my/test/device"])
+
+    def test_handles_alarm_batch(self):
+        self.indices.exists.return_value = True
+        event = {
+            "description": "testing, testing",
+            "timestamp": 12345.,
+            "host": "test-host-1",
+            "device": "just/testing/1",
+            "message": "TESTING",
+            "alarm_tag": "logger_device_test",
+            "severity": "DEBUG",
+            "instance": "fisk",
+            "values": [{"attribute": "some/device/1/attribute",
+                        "value": 278.5}],
+            "formula": "This is a test"
+        }
+        # newline delimited, with one undecodable event in the middle
+        batch = "\n".join([json.dumps(event), "{not json", json.dumps(event)])
+        queued = self.device.AlarmBatch(batch)
+        self.device.PushQueuedEventsToES()
+        assert queued == 2
+        events = sent_events(self.es.bulk)
+        assert len(events) == 2
+        assert all(e["_type"] == "alarm" for e in events)
+
+    def test_keeps_events_from_failed_chunks(self):
+        self.indices.exists.return_value = True
+        # ES only got to the first event before the connection broke
+        self.es.bulk.side_effect = [{"items": [{"index": {"status": 201}}]}]
+        event1 = ["12345", "INFO", "my/test/device", "first", "wat", "123"]
+        event2 = ["12346", "INFO", "my/test/device", "second", "wat", "123"]
+        self.device.LogBatch(event1 + event2)
+        self.device.PushQueuedEventsToES()
+        self.es.bulk.side_effect = bulk_ok
+        self.device.PushQueuedEventsToES()
+        # only the event that didn't make it is sent again
+        retried = last_sent(self.es.bulk)
+        assert [e["_source"]["message"] for e in retried] == ["second"]
+
+    def test_retries_events_refused_by_busy_es(self):
+        self.indices.exists.return_value = True
+        busy = {"status": 429, "error": "rejected execution"}
+        self.es.bulk.side_effect = [{"items": [{"index": busy}]}]
+        event = ["12345", "INFO", "my/test/device", "first", "wat", "123"]
+        self.device.Log(event)
+        self.device.PushQueuedEventsToES()
+        self.es.bulk.side_effect = bulk_ok
+        self.device.PushQueuedEventsToES()
+        retried = last_sent(self.es.bulk)
+        assert [e["_source"]["message"] for e in retried] == ["first"]
+        assert json.loads(self.device.GetDeadLetters()) == []
+
+    def test_keeps_permanently_refused_events_aside(self):
+        self.indices.exists.return_value = True
+        bad = {"status": 400, "error": "mapper_parsing_exception"}
+        self.es.bulk.side_effect = [{"items": [{"index": bad}]}]
+        event = ["12345", "INFO", "my/test/device", "first", "wat", "123"]
+        self.device.Log(event)
+        self.device.PushQueuedEventsToES()
+        self.device.PushQueuedEventsToES()
+        assert self.es.bulk.call_count == 1  # not retried
+        (letter,) = json.loads(self.device.GetDeadLetters())
+        assert letter["status"] == 400
+        assert letter["event"]["_source"]["message"] == "first"
+        self.device.ClearDeadLetters()
+        assert json.loads(self.device.GetDeadLetters()) == []
+
+    def test_gives_up_on_requests_that_keep_failing(self):
+        self.indices.exists.return_value = True
+        self.es.bulk.side_effect = TransportError(413, "request too large")
+        event = ["12345", "INFO", "my/test/device", "first", "wat", "123"]
+        self.device.Log(event)
+        for _ in range(6):  # BulkMaxRetries + 1
+            self.device.PushQueuedEventsToES()
+        self.device.PushQueuedEventsToES()
+        assert self.es.bulk.call_count == 6
+        (letter,) = json.loads(self.device.GetDeadLetters())
+        assert letter["status"] == 413
+
+
+class ClusterLoggerTestCase(DeviceTestCase):
+    """Test case for the logger talking to several ES nodes."""
+
+    device = logger.Logger
+    properties = {
+        'ElasticsearchHost': ['es-1:9200, es-2:9200', 'es-3:9201'],
+        'ElasticsearchSniffPeriod': 60,
+        'PushPeriod': 0
+    }
+
+    mocking = LoggerTestCase.__dict__["mocking"]
+
+    def test_connects_to_all_nodes(self):
+        (args, kwargs) = self.Elasticsearch.call_args
+        assert args == (["es-1:9200", "es-2:9200", "es-3:9201"],)
+        assert kwargs["max_retries"] == 3
+        assert kwargs["dead_timeout"] == 10
+        assert kwargs["sniffer_timeout"] == 60
+        assert kwargs["sniff_on_connection_fail"]
+
+    def test_checks_health_in_the_background(self):
+        self.device.PushQueuedEventsToES()  # pings, the first time
+        self.es.ping.reset_mock()
+        self.device.PushQueuedEventsToES()
+        self.es.ping.assert_not_called()
+
+
+class RolloverLoggerTestCase(DeviceTestCase):
+    """Test case for the logger writing to rollover indices."""
+
+    device = logger.Logger
+    properties = {
+        'ElasticsearchHost': 'test-es-host',
+        'HealthCheckPeriod': 0,
+        'PushPeriod': 0,
+        'RolloverMaxDocs': 1000000
+    }
+
+    mocking = LoggerTestCase.__dict__["mocking"]
+
+    def test_writes_to_alias(self):
+        self.indices.exists_alias.return_value = False
+        self.device.Log(["12345", "INFO", "my/test/device", "hello", "", ""])
+        self.device.PushQueuedEventsToES()
+        self.indices.create.assert_any_call(
+            "tango-logs-000001", body={"aliases": {"tango-logs": {}}})
+        (event,) = sent_events(self.es.bulk)
+        assert event["_index"] == "tango-logs"
+
+
+class SpoolingLoggerTestCase(DeviceTestCase):
+    """Test case for the logger with a disk spool."""
+
+    device = logger.Logger
+    properties = {
+        'ElasticsearchHost': 'test-es-host',
+        'HealthCheckPeriod': 0,  # ping before each push
+        'QueueSize': 3,
+        'PushPeriod': 0,
+        'SpoolDirectory': tempfile.mkdtemp()
+    }
+
+    mocking = LoggerTestCase.__dict__["mocking"]
+
+    def test_spools_and_replays_events_while_es_is_down(self):
+        self.indices.exists.return_value = True
+        self.es.ping.return_value = False
+        event = ["12345", "INFO", "my/test/device",
+                 "testing, testing", "wat", "123"]
+        for _ in range(5):  # more than fits in the queue
+            self.device.Log(event)
+        self.device.PushQueuedEventsToES()
+        self.es.bulk.assert_not_called()
+        assert os.listdir(self.properties["SpoolDirectory"])
+
+        self.es.ping.return_value = True
+        self.device.PushQueuedEventsToES()
+        expected = {
+            "_id": "uuid4",
+            "_type": "log",
+            "_index": "tango-logs-1970.01.01",
+            "_source": dict(zip(EVENT_MEMBERS, event))
+        }
+        assert sent_events(self.es.bulk) == [expected] * 5
+        assert not os.listdir(self.properties["SpoolDirectory"])
+
+
+class DedupLoggerTestCase(DeviceTestCase):
+    """Test case for the logger collapsing repeated log messages."""
+
+    device = logger.Logger
+    properties = {
+        'ElasticsearchHost': 'test-es-host',
+        'HealthCheckPeriod': 0,  # ping before each push
+        'PushPeriod': 0,
+        'DedupWindow': 3600
+    }
+
+    mocking = LoggerTestCase.__dict__["mocking"]
+
+    def test_collapses_repeated_log_messages(self):
+        self.indices.exists.return_value = True
+        fields = []
+        for timestamp in range(12345, 12445):
+            fields.extend([str(timestamp), "ERROR", "my/test/device",
+                           "stuck in a loop", "", ""])
+        assert self.device.LogBatch(fields) == 100
+        self.device.PushQueuedEventsToES()
+        (event,) = sent_events(self.es.bulk)
+        assert event["_source"]["count"] == 1
+
+        self.device.Init()  # sums up what's left
+        summary = last_sent(self.es.bulk)[0]["_source"]
+        assert summary["count"] == 99
+        assert summary["first_seen"] == 12346
+        assert summary["last_seen"] == 12444
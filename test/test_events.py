@@ -0,0 +1,52 @@
+"""Tests for the conversion of incoming events."""
+
+import os
+import sys
+import unittest
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.events import typed_values
+
+
+def typed(value):
+    (entry,) = typed_values([{"attribute": "a/b/c/d", "value": value}])
+    assert entry.pop("attribute") == "a/b/c/d"
+    return entry
+
+
+class TypedValuesTestCase(unittest.TestCase):
+
+    def test_numbers(self):
+        assert typed(1.5) == {"value": "1.5", "type": "float", "number": 1.5}
+        assert typed(3) == {"value": "3", "type": "int", "number": 3}
+
+    def test_booleans_are_not_numbers(self):
+        assert typed(True) == {"value": "True", "type": "bool",
+                               "boolean": True}
+
+    def test_strings(self):
+        assert typed(u"ON") == {"value": u"ON", "type": "unicode"}
+        assert typed(u"\xe5") == {"value": u"\xe5", "type": "unicode"}
+
+    def test_non_finite_numbers_are_only_strings(self):
+        assert typed(float("nan")) == {"value": "nan", "type": "float"}
+        assert typed(float("inf")) == {"value": "inf", "type": "float"}
+
+    def test_arrays_are_summarized(self):
+        entry = typed([3, 1.5, u"x", 4.5, None, float("nan")])
+        assert entry["length"] == 6
+        assert (entry["min"], entry["max"], entry["mean"]) == (1.5, 4.5, 3.0)
+        assert entry["type"] == "list"
+
+    def test_arrays_without_numbers(self):
+        assert typed([]) == {"value": "[]", "type": "list", "length": 0}
+        assert "min" not in typed([u"a", True])
+
+    def test_booleans_in_arrays_are_not_numbers(self):
+        assert typed([True, False]) == {"value": "[True, False]",
+                                        "type": "list", "length": 2}
+        entry = typed([True, 2, 4])
+        assert (entry["min"], entry["max"], entry["mean"]) == (2, 4, 3.0)
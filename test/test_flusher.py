@@ -0,0 +1,54 @@
+"""Tests for the background flusher thread."""
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.flusher import Flusher
+
+
+class FlusherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.flushed = threading.Event()
+        self.flusher = Flusher(self.flushed.set, period=60)
+        self.flusher.start()
+
+    def tearDown(self):
+        self.flusher.stop()
+
+    def test_flushes_when_woken(self):
+        assert not self.flushed.wait(0.1)
+        self.flusher.wake()
+        assert self.flushed.wait(1)
+
+    def test_flushes_after_period(self):
+        self.flusher.stop()
+        self.flusher = Flusher(self.flushed.set, period=0.05)
+        self.flusher.start()
+        assert self.flushed.wait(1)
+
+    def test_stops(self):
+        self.flusher.stop()
+        assert not self.flusher.running
+        assert not self.flushed.is_set()
+
+    def test_survives_errors(self):
+        errors = []
+
+        def broken():
+            errors.append(time.time())
+            raise RuntimeError("oops")
+
+        self.flusher.stop()
+        self.flusher = Flusher(broken, period=0.01, on_error=errors.append)
+        self.flusher.start()
+        time.sleep(0.1)
+        assert len(errors) > 2
+        assert self.flusher.running
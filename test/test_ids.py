@@ -0,0 +1,60 @@
+"""Tests for the ways of picking document IDs."""
+
+import json
+import os
+import sys
+import unittest
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.document import Document
+from loggerds.ids import TimeOrderedIds, auto_id, content_id, id_maker
+
+
+def document(**source):
+    return Document("log", "tango-logs-2016.04.05", None, source)
+
+
+class IdsTestCase(unittest.TestCase):
+
+    def test_auto_ids_are_left_out(self):
+        doc = document(message="hello")
+        doc.id = auto_id(doc)
+        action, _ = doc.encode()
+        assert "_id" not in json.loads(action)["index"]
+
+    def test_time_ordered_ids_sort_in_order(self):
+        clock = iter([1459900800.000, 1459900800.000, 1459900800.001,
+                      1459900801.5]).next
+        ids = TimeOrderedIds(clock=clock)
+        made = [ids() for _ in range(4)]
+        assert made == sorted(made)
+        assert len(set(made)) == 4
+        assert all(len(doc_id) == 24 for doc_id in made)
+
+    def test_time_ordered_ids_differ_between_generators(self):
+        assert TimeOrderedIds()() != TimeOrderedIds()()
+
+    def test_content_ids_depend_only_on_contents(self):
+        first = document(message="hello", level="INFO", device="a/b/c")
+        again = document(device="a/b/c", level="INFO", message="hello")
+        other = document(message="hello!", level="INFO", device="a/b/c")
+        assert content_id(first) == content_id(again)
+        assert content_id(first) != content_id(other)
+        assert len(content_id(first)) == 27
+
+    def test_content_id_keeps_the_encoded_source(self):
+        doc = document(message="hello", level="INFO")
+        doc.id = content_id(doc)
+        action, data = doc.encode()
+        assert json.loads(action)["index"]["_id"] == doc.id
+        assert data == '{"level":"INFO","message":"hello"}'
+        assert doc.to_dict()["_source"] == {"level": "INFO",
+                                            "message": "hello"}
+
+    def test_id_maker_knows_the_strategies(self):
+        assert id_maker("hash") is content_id
+        assert len(id_maker("uuid4")(document())) == 36
+        self.assertRaises(ValueError, id_maker, "sequential")
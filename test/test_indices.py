@@ -0,0 +1,64 @@
+"""Tests for the daily index naming."""
+
+from datetime import datetime
+import os
+import sys
+import unittest
+
+from mock import patch
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds import indices
+from loggerds.indices import DailyIndex, RolloverIndex
+
+
+class DailyIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = DailyIndex("tango", "logs")
+
+    def test_names_index_by_millisecond_timestamp(self):
+        assert self.index.get("1459900799999") == "tango-logs-2016.04.05"
+        assert self.index.get(1459900800000) == "tango-logs-2016.04.06"
+
+    def test_names_index_by_datetime(self):
+        assert (self.index.get(datetime(2016, 4, 5, 23, 59, 59))
+                == "tango-logs-2016.04.05")
+
+    def test_uses_prefix(self):
+        index = DailyIndex("test", "alarms")
+        assert index.get(0) == "test-alarms-1970.01.01"
+
+    def test_falls_back_to_today(self):
+        with patch.object(indices.time, "time", return_value=86400 * 1.5):
+            assert self.index.get("not a timestamp") == "tango-logs-1970.01.02"
+            assert self.index.get(None) == "tango-logs-1970.01.02"
+
+    def test_today_changes_at_midnight(self):
+        with patch.object(indices.time, "time") as now:
+            now.return_value = 86400 * 2 - 0.001
+            assert self.index.today() == "tango-logs-1970.01.02"
+            now.return_value = 86400 * 2
+            assert self.index.today() == "tango-logs-1970.01.03"
+
+    def test_limits_cached_names(self):
+        index = DailyIndex("tango", "logs", max_days=3)
+        for day in range(10):
+            index.get(day * indices.DAY_MS)
+        assert len(index._names) <= 3
+
+
+class RolloverIndexTestCase(unittest.TestCase):
+
+    def test_sends_everything_to_the_alias(self):
+        index = RolloverIndex("tango", "logs")
+        assert index.get("1459900799999") == "tango-logs"
+        assert index.get(None) == "tango-logs"
+
+    def test_names_indices(self):
+        index = RolloverIndex("tango", "alarms")
+        assert index.first() == "tango-alarms-000001"
+        assert index.next("tango-alarms-000009") == "tango-alarms-000010"
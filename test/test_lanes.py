@@ -0,0 +1,35 @@
+"""Tests for the lanes events take to ES."""
+
+import os
+import sys
+import unittest
+
+from mock import MagicMock
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.buffer import EventBuffer
+from loggerds.document import Document
+from loggerds.lanes import Lane
+
+
+class LaneTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.lane = Lane("alarm", EventBuffer(10), MagicMock(), MagicMock(),
+                         batch_size=1)
+
+    def test_wakes_flusher(self):
+        self.lane.wake()  # no flusher; nothing happens
+        self.lane.flusher = MagicMock()
+        self.lane.wake()
+        self.lane.flusher.wake.assert_called_once_with()
+
+    def test_keeps_track_of_delays(self):
+        docs = [Document("alarm", "tango-alarms", None, {}) for _ in range(3)]
+        for delay, doc in enumerate(docs):
+            doc.received = 1000 - delay
+        self.lane.stored(docs, now=1000)
+        assert self.lane.delays.percentiles(0, 50, 100) == [0, 1, 2]
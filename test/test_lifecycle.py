@@ -0,0 +1,185 @@
+"""Tests for rollover, retention and merging of indices."""
+
+import os
+import sys
+import unittest
+
+from elasticsearch import ConnectionTimeout, TransportError
+from mock import MagicMock
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.indices import DAY_MS, DailyIndex, RolloverIndex
+from loggerds.lifecycle import IndexLifecycle, written_until
+
+DAY_1 = 1459814400000  # 2016-04-05 00:00 UTC
+
+
+def settings(indices):
+    return dict((name, {"settings": {"index.creation_date": str(created),
+                                     "index.number_of_shards": "1"}})
+                for name, created in indices.items())
+
+
+def stats(counts):
+    return {"indices": dict(
+        (name, {"primaries": {"segments": {"count": count}}})
+        for name, count in counts.items())}
+
+
+class WrittenUntilTestCase(unittest.TestCase):
+
+    def test_daily_indices_are_written_until_the_day_is_over(self):
+        assert written_until({"tango-logs-2016.04.05": 0}) == {
+            "tango-logs-2016.04.05": DAY_1 + DAY_MS}
+
+    def test_rollover_indices_are_written_until_the_next_one(self):
+        assert written_until({"tango-logs-000002": 200,
+                              "tango-logs-000001": 100,
+                              "tango-logs-000003": 300}) == {
+            "tango-logs-000001": 200, "tango-logs-000002": 300,
+            "tango-logs-000003": None}
+
+    def test_ignores_other_indices(self):
+        assert written_until({"tango-logs-whatever": 0}) == {}
+
+
+class IndexLifecycleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.es = MagicMock()
+        self.indices = self.es.indices
+
+    def test_bootstraps_write_alias(self):
+        lifecycle = IndexLifecycle(self.es, RolloverIndex("tango", "logs"),
+                                   max_docs=1000)
+        self.indices.exists_alias.return_value = False
+        assert lifecycle.bootstrap() == "tango-logs-000001"
+        self.indices.create.assert_called_once_with(
+            "tango-logs-000001", body={"aliases": {"tango-logs": {}}})
+        self.indices.create.reset_mock()
+        self.indices.exists_alias.return_value = True
+        assert lifecycle.bootstrap() is None
+        self.indices.create.assert_not_called()
+
+    def test_rolls_over_when_full(self):
+        lifecycle = IndexLifecycle(self.es, RolloverIndex("tango", "logs"),
+                                   max_docs=1000, max_bytes=10 ** 9)
+        self.indices.get_alias.return_value = {
+            "tango-logs-000041": {"aliases": {"tango-logs": {}}}}
+        primaries = {"docs": {"count": 999},
+                     "store": {"size_in_bytes": 12345}}
+        self.indices.stats.return_value = {
+            "indices": {"tango-logs-000041": {"primaries": primaries}}}
+        assert lifecycle.rollover() is None
+        primaries["docs"]["count"] = 1000
+        assert lifecycle.rollover() == "tango-logs-000042"
+        self.indices.create.assert_called_once_with("tango-logs-000042")
+        self.indices.update_aliases.assert_called_once_with(body={
+            "actions": [
+                {"remove": {"index": "tango-logs-000041",
+                            "alias": "tango-logs"}},
+                {"add": {"index": "tango-logs-000042",
+                         "alias": "tango-logs"}}]})
+
+    def test_leaves_rollover_to_others(self):
+        lifecycle = IndexLifecycle(self.es, RolloverIndex("tango", "logs"),
+                                   max_bytes=100)
+        self.indices.get_alias.return_value = {"tango-logs-000001": {}}
+        self.indices.stats.return_value = {"indices": {"tango-logs-000001": {
+            "primaries": {"store": {"size_in_bytes": 101}}}}}
+        self.indices.create.side_effect = TransportError(
+            400, "index_already_exists_exception")
+        self.indices.exists.return_value = True
+        self.indices.exists_alias.return_value = True
+        assert lifecycle.rollover() is None
+        self.indices.exists_alias.assert_called_once_with(
+            name="tango-logs", index="tango-logs-000002")
+        self.indices.update_aliases.assert_not_called()
+
+    def test_finishes_half_done_rollover(self):
+        lifecycle = IndexLifecycle(self.es, RolloverIndex("tango", "logs"),
+                                   max_bytes=100)
+        self.indices.get_alias.return_value = {"tango-logs-000001": {}}
+        self.indices.stats.return_value = {"indices": {"tango-logs-000001": {
+            "primaries": {"store": {"size_in_bytes": 101}}}}}
+        # created last time, but the alias was never moved
+        self.indices.create.side_effect = TransportError(
+            400, "index_already_exists_exception")
+        self.indices.exists.return_value = True
+        self.indices.exists_alias.return_value = False
+        assert lifecycle.rollover() == "tango-logs-000002"
+        self.indices.update_aliases.assert_called_once_with(body={
+            "actions": [
+                {"remove": {"index": "tango-logs-000001",
+                            "alias": "tango-logs"}},
+                {"add": {"index": "tango-logs-000002",
+                         "alias": "tango-logs"}}]})
+
+    def test_deletes_expired_indices(self):
+        lifecycle = IndexLifecycle(self.es, DailyIndex("tango", "logs"),
+                                   retention_days=2)
+        names = ["tango-logs-2016.04.0%d" % day for day in (5, 6, 7, 8)]
+        self.indices.get_settings.return_value = settings(
+            dict.fromkeys(names, 0))
+        self.indices.stats.return_value = stats(dict.fromkeys(names, 1))
+        now = DAY_1 + 3 * DAY_MS + 1  # 2016-04-08, just after midnight
+        assert lifecycle.clean_up(now) == ([names[0]], [])
+        self.indices.delete.assert_called_once_with(names[0])
+        self.indices.forcemerge.assert_not_called()
+
+    def test_deletes_in_batches(self):
+        lifecycle = IndexLifecycle(self.es, DailyIndex("tango", "logs"),
+                                   retention_days=1)
+        names = ["tango-logs-2016.%02d.%02d" % (month, day)
+                 for month in (1, 2, 3) for day in range(1, 29)]
+        self.indices.get_settings.return_value = settings(
+            dict.fromkeys(names, 0))
+        self.indices.stats.return_value = stats(dict.fromkeys(names, 1))
+        self.indices.delete.side_effect = [None, TransportError(500, "oops"),
+                                           None, None, None]
+        self.assertRaises(TransportError, lifecycle.clean_up, DAY_1)
+        batches = [index.split(",")
+                   for (index,), _ in self.indices.delete.call_args_list]
+        assert sum(batches, []) == names  # a failed batch doesn't stop it
+        assert max(len(batch) for batch in batches) <= 20
+
+    def test_merges_indices_no_longer_written_to(self):
+        lifecycle = IndexLifecycle(self.es, RolloverIndex("tango", "logs"),
+                                   max_docs=1000, force_merge=True)
+        self.indices.get_settings.return_value = settings({
+            "tango-logs-000001": DAY_1, "tango-logs-000002": DAY_1 + 1,
+            "tango-logs-000003": DAY_1 + 2, "tango-logs-000004": DAY_1 + 3})
+        self.indices.stats.return_value = stats({
+            "tango-logs-000001": 1,  # already merged
+            "tango-logs-000002": 5, "tango-logs-000003": 5,
+            "tango-logs-000004": 5})  # still being written to
+        assert lifecycle.clean_up(DAY_1 + DAY_MS) == (
+            [], ["tango-logs-000002", "tango-logs-000003"])
+        self.indices.delete.assert_not_called()
+        assert self.indices.forcemerge.call_count == 2
+
+    def test_does_not_wait_for_merges(self):
+        lifecycle = IndexLifecycle(self.es, DailyIndex("tango", "logs"),
+                                   force_merge=True)
+        names = ["tango-logs-2016.04.05", "tango-logs-2016.04.06"]
+        self.indices.get_settings.return_value = settings(
+            dict.fromkeys(names, 0))
+        self.indices.stats.return_value = stats(dict.fromkeys(names, 5))
+        self.indices.forcemerge.side_effect = ConnectionTimeout(
+            "TIMEOUT", "timed out", None)
+        now = DAY_1 + 3 * DAY_MS
+        assert lifecycle.clean_up(now) == ([], names)
+        assert self.indices.forcemerge.call_count == 2
+        _, kwargs = self.indices.forcemerge.call_args
+        assert kwargs["request_timeout"] <= 60
+        # still merging in ES; no need to ask again for a while
+        assert lifecycle.clean_up(now + 3600 * 1000) == ([], [])
+        assert self.indices.forcemerge.call_count == 2
+
+    def test_does_nothing_unless_asked(self):
+        lifecycle = IndexLifecycle(self.es, DailyIndex("tango", "logs"))
+        assert lifecycle.clean_up() == ([], [])
+        assert not self.indices.method_calls
@@ -0,0 +1,31 @@
+"""Tests for the index templates."""
+
+import os
+import sys
+import unittest
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.mapping import (TEMPLATE_VERSION, index_template,
+                              template_version)
+
+
+class IndexTemplateTestCase(unittest.TestCase):
+
+    def test_logs_are_searched_by_message(self):
+        template = index_template("tango", "logs")
+        assert template["template"] == "tango-logs-*"
+        assert template["settings"]["query"]["default_field"] == "message"
+        assert template["mappings"]["log"]["_all"] == {"enabled": False}
+
+    def test_alarms_are_searched_in_all_fields(self):
+        template = index_template("tango", "alarms")
+        assert template["settings"]["query"]["default_field"] == "_all"
+        assert "_all" not in template["mappings"]["alarm"]
+
+    def test_version(self):
+        template = index_template("tango", "alarms")
+        assert template_version(template) == TEMPLATE_VERSION
+        assert template_version({}) == 0
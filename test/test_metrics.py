@@ -0,0 +1,78 @@
+"""Tests for the measurements exposed as attributes."""
+
+import math
+import os
+import sys
+import threading
+import unittest
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.metrics import RateMeter, RollingPercentiles
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class RateMeterTestCase(unittest.TestCase):
+
+    def test_averages_over_window(self):
+        clock = Clock()
+        meter = RateMeter(window=10, clock=clock)
+        for second in range(20):
+            clock.now = 1000 + second
+            meter.add(5)
+        assert meter.rate() == 5
+        assert meter.total == 100
+        clock.now += 5
+        assert meter.rate() == 2.5  # only half of the window has events
+        clock.now += 5
+        assert meter.rate() == 0
+
+    def test_counts_only_time_since_start(self):
+        clock = Clock()
+        meter = RateMeter(window=60, clock=clock)
+        meter.add(10)
+        clock.now += 1
+        meter.add(10)
+        assert meter.rate() == 10
+
+    def test_is_thread_safe(self):
+        meter = RateMeter()
+        threads = [threading.Thread(target=lambda: [meter.add()
+                                                    for _ in range(10000)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert meter.total == 40000
+
+
+class RollingPercentilesTestCase(unittest.TestCase):
+
+    def test_gives_percentiles_of_latest_values(self):
+        rolling = RollingPercentiles(size=100)
+        for value in range(1000):
+            rolling.add(value)
+        assert len(rolling) == 100
+        assert rolling.percentiles(0, 50, 100) == [900, 950, 999]
+        assert rolling.percentile(99) == 998
+
+    def test_adds_several_values(self):
+        rolling = RollingPercentiles(size=10)
+        rolling.extend(range(5))
+        rolling.extend(range(5, 20))
+        assert len(rolling) == 10
+        assert rolling.percentiles(0, 100) == [10, 19]
+
+    def test_gives_nan_without_values(self):
+        assert math.isnan(RollingPercentiles().percentile(50))
@@ -0,0 +1,116 @@
+"""Tests for profiling of the device."""
+
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import unittest
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.profiling import Profiler, summary
+
+
+def busy(n):
+    return sum(i * i for i in xrange(n))
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def test_does_nothing_when_off(self):
+        profiler = Profiler()
+        with profiler.span("test", profile=True):
+            busy(10)
+        profiler.start()
+        stats, spans = profiler.stop()
+        assert stats is None
+        assert spans == {}
+
+    def test_times_spans(self):
+        profiler = Profiler()
+        profiler.start()
+        for n in range(3):
+            with profiler.span("outer"):
+                with profiler.span("inner"):
+                    busy(100)
+        stats, spans = profiler.stop()
+        assert stats is None  # nothing profiled
+        assert spans["outer"][0] == spans["inner"][0] == 3
+        assert spans["outer"][1] >= spans["inner"][1] > 0
+
+    def test_profiles_nested_spans_once(self):
+        profiler = Profiler()
+        profiler.start()
+        with profiler.span("outer", profile=True):
+            with profiler.span("inner", profile=True):
+                busy(1000)
+            busy(1000)
+        stats, spans = profiler.stop()
+        calls = [func for func in stats.stats if func[2] == "busy"]
+        assert len(calls) == 1
+        assert stats.stats[calls[0]][1] == 2  # number of calls
+
+    def test_collects_all_threads(self):
+        profiler = Profiler()
+        profiler.start()
+
+        def work():
+            with profiler.span("work", profile=True):
+                busy(1000)
+
+        threads = [threading.Thread(target=work) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        work()
+        stats, spans = profiler.stop()
+        assert spans["work"][0] == 4
+        calls = [func for func in stats.stats if func[2] == "busy"]
+        assert stats.stats[calls[0]][1] == 4
+
+    def test_forgets_earlier_sessions(self):
+        profiler = Profiler()
+        profiler.start()
+        with profiler.span("old", profile=True):
+            busy(10)
+        profiler.start()
+        with profiler.span("new", profile=True):
+            busy(10)
+        _, spans = profiler.stop()
+        assert spans.keys() == ["new"]
+
+    def test_new_session_during_a_span(self):
+        profiler = Profiler()
+        profiler.start()
+        with profiler.span("flush", profile=True):
+            profiler.start()  # e.g. from a command, in another thread
+            with profiler.span("bulk", profile=True):
+                pass
+        with profiler.span("flush", profile=True):
+            busy(1000)
+        stats, _ = profiler.stop()
+        # the thread is still profiled in the new session
+        calls = [func for func in stats.stats if func[2] == "busy"]
+        assert len(calls) == 1
+        assert stats.stats[calls[0]][1] == 1
+
+    def test_summary(self):
+        profiler = Profiler()
+        profiler.start()
+        with profiler.span("work", profile=True):
+            busy(1000)
+        stats, spans = profiler.stop()
+        report = summary(stats, spans, 1.0, limit=5)
+        assert "work" in report
+        assert "busy" in report
+        assert "cumulative" in report
+        _, filename = tempfile.mkstemp()
+        try:
+            stats.dump_stats(filename)
+            assert pstats.Stats(filename).total_calls == stats.total_calls
+        finally:
+            os.remove(filename)
@@ -0,0 +1,81 @@
+"""Tests for the memory of recent events."""
+
+import json
+import os
+import sys
+import unittest
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.document import Document
+from loggerds.events import LEVEL_RANKS
+from loggerds.recent import RecentEvents
+
+
+def add(recent, device, timestamp, level="INFO", message="hello"):
+    doc = Document("log", "tango-logs-1970.01.01", None,
+                   {"device": device, "level": level, "message": message},
+                   rank=LEVEL_RANKS[level])
+    doc.encode()
+    recent.add(device, timestamp, doc)
+
+
+class RecentEventsTestCase(unittest.TestCase):
+
+    def test_gets_latest_events_per_device(self):
+        recent = RecentEvents(10)
+        for t in range(5):
+            add(recent, "a/b/c", t)
+            add(recent, "d/e/f", t)
+        found = recent.get("A/B/C", limit=3)
+        assert [t for t, _, _ in found] == [2, 3, 4]
+        assert len(recent.get()) == 10
+
+    def test_filters_on_level_and_time(self):
+        recent = RecentEvents(10)
+        add(recent, "a/b/c", 1, "ERROR")
+        add(recent, "a/b/c", 2, "DEBUG")
+        add(recent, "a/b/c", 3, "WARN")
+        found = recent.get("a/b/c", min_rank=LEVEL_RANKS["WARN"])
+        assert [t for t, _, _ in found] == [1, 3]
+        assert [t for t, _, _ in recent.get(since=2)] == [2, 3]
+
+    def test_forgets_oldest_events(self):
+        recent = RecentEvents(3)
+        add(recent, "a/b/c", 1)
+        add(recent, "d/e/f", 2)
+        add(recent, "a/b/c", 3)
+        add(recent, "a/b/c", 4)
+        assert len(recent) == 3
+        assert [t for t, _, _ in recent.get("a/b/c")] == [3, 4]
+        add(recent, "a/b/c", 5)
+        assert recent.get("d/e/f") == []
+        assert "d/e/f" not in recent._devices
+
+    def test_gets_latest_of_several_levels(self):
+        recent = RecentEvents(10)
+        for t, level in enumerate(["ERROR", "DEBUG", "WARN", "INFO", "ERROR",
+                                   "WARN", "DEBUG"]):
+            add(recent, "a/b/c" if t % 2 else "d/e/f", t, level)
+        found = recent.get(min_rank=LEVEL_RANKS["WARN"], limit=3)
+        assert [t for t, _, _ in found] == [2, 4, 5]
+        found = recent.get("a/b/c", min_rank=LEVEL_RANKS["INFO"])
+        assert [t for t, _, _ in found] == [3, 5]
+
+    def test_forgets_oldest_events_beyond_max_bytes(self):
+        recent = RecentEvents(10, max_bytes=200)
+        for t in range(10):
+            add(recent, "a/b/c", t, message="x" * 50)
+        assert 100 < recent.nbytes <= 200
+        assert [t for t, _, _ in recent.get()] == [8, 9]
+        assert recent.get(limit=0) == []
+
+    def test_gives_json(self):
+        recent = RecentEvents(3)
+        add(recent, "a/b/c", 1, message="first")
+        add(recent, "a/b/c", 2, message="second")
+        found = json.loads(recent.to_json("a/b/c"))
+        assert [e["type"] for e in found] == ["log", "log"]
+        assert [e["event"]["message"] for e in found] == ["first", "second"]
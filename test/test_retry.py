@@ -0,0 +1,43 @@
+"""Tests for the retry helpers."""
+
+import json
+import os
+import sys
+import unittest
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.document import Document
+from loggerds.retry import Backoff, DeadLetters, is_retryable
+
+
+class RetryTestCase(unittest.TestCase):
+
+    def test_classifies_results(self):
+        assert is_retryable({"status": 429})
+        assert is_retryable({"status": 503})
+        assert is_retryable({"status": "N/A"})  # connection problem
+        assert not is_retryable({"status": 400})
+
+    def test_backoff_grows_with_jitter(self):
+        backoff = Backoff(base=1.0, maximum=5.0)
+        delays = [backoff.failed() for _ in range(6)]
+        for n, delay in enumerate(delays):
+            limit = min(5.0, 2 ** n)
+            assert limit / 2 <= delay <= limit
+        assert backoff.waiting
+        backoff.succeeded()
+        assert not backoff.waiting
+        assert backoff.failed() <= 1.0
+
+    def test_dead_letters_are_bounded(self):
+        letters = DeadLetters(size=2)
+        for n in range(3):
+            doc = Document("log", "tango-logs-2016.04.05", None, {"n": n})
+            letters.add(doc, {"status": 400, "error": "bad"})
+        assert len(letters) == 2
+        assert letters.total == 3
+        kept = json.loads(letters.to_json())
+        assert [letter["event"]["_source"]["n"] for letter in kept] == [1, 2]
@@ -0,0 +1,196 @@
+"""Tests for the bulk shipping."""
+
+import gzip
+import json
+import os
+import sys
+import threading
+import unittest
+from StringIO import StringIO
+
+from elasticsearch import TransportError
+from mock import MagicMock
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.document import Document
+from loggerds.metrics import RollingPercentiles
+from loggerds.shipper import BulkShipper, ChunkSizeController
+from loggerds.transport import gzip_compress, gzip_compress_native, is_green
+
+
+def make_doc(n):
+    doc = Document("log", "tango-logs-2016.04.05", "id%d" % n, {"n": n})
+    doc.encode()
+    return doc
+
+
+def bulk_ids(body):
+    "The ids of the documents in a bulk request body"
+    return [json.loads(action)["index"]["_id"]
+            for action in body.splitlines()[::2]]
+
+
+def bulk_ok(body, **kwargs):
+    return {"items": [{"index": {"_id": doc_id, "status": 201}}
+                      for doc_id in bulk_ids(body)]}
+
+
+class ChunkSizeControllerTestCase(unittest.TestCase):
+
+    def test_fixed_size_without_target(self):
+        controller = ChunkSizeController(100)
+        controller.update(100, 10.0, 0)
+        assert controller.size == 100
+
+    def test_shrinks_when_slow(self):
+        controller = ChunkSizeController(100, target_latency=1.0)
+        controller.update(100, 2.0, 0)
+        assert controller.size == 50
+
+    def test_halves_on_rejections(self):
+        controller = ChunkSizeController(100, target_latency=1.0)
+        controller.update(100, 0.1, 5)
+        assert controller.size == 50
+
+    def test_grows_when_full_chunks_are_fast(self):
+        controller = ChunkSizeController(100, target_latency=1.0,
+                                         maximum=120)
+        controller.update(50, 0.1, 0)  # not full, tells us nothing
+        assert controller.size == 100
+        controller.update(100, 0.1, 0)
+        assert controller.size == 120  # capped
+
+
+class BulkShipperTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.es = MagicMock()
+        self.es.bulk.side_effect = bulk_ok
+
+    def chunks_sent(self):
+        calls = self.es.bulk.call_args_list
+        return [bulk_ids(body) for (body,), _ in calls]
+
+    def test_splits_by_count(self):
+        docs = [make_doc(n) for n in range(5)]
+        bulk = BulkShipper(self.es, ChunkSizeController(10, minimum=2,
+                                                        maximum=2),
+                           max_chunk_bytes=10000)
+        assert len(list(bulk.ship(docs))) == 5
+        assert self.chunks_sent() == [["id0", "id1"], ["id2", "id3"],
+                                      ["id4"]]
+
+    def test_splits_by_bytes(self):
+        docs = [make_doc(n) for n in range(3)]
+        bulk = BulkShipper(self.es, ChunkSizeController(10),
+                           max_chunk_bytes=docs[0].nbytes * 2)
+        list(bulk.ship(docs))
+        assert self.chunks_sent() == [["id0", "id1"], ["id2"]]
+
+    def test_results_per_chunk(self):
+        docs = [make_doc(n) for n in range(3)]
+        latencies = RollingPercentiles()
+        bulk = BulkShipper(self.es, ChunkSizeController(2, minimum=2),
+                           max_chunk_bytes=10000, latencies=latencies)
+        chunks = list(bulk.ship_chunks(docs))
+        assert [[doc.id for doc, _, _ in chunk] for chunk in chunks] == [
+            ["id0", "id1"], ["id2"]]
+        assert len(latencies) == 2
+
+    def test_parallel_results_in_order(self):
+        docs = [make_doc(n) for n in range(50)]
+        # the mock's own call count is not thread safe
+        bodies = []
+        lock = threading.Lock()
+
+        def bulk(body, **kwargs):
+            with lock:
+                bodies.append(body)
+            return bulk_ok(body)
+
+        self.es.bulk.side_effect = bulk
+        bulk = BulkShipper(self.es, ChunkSizeController(10, minimum=5,
+                                                        maximum=5),
+                           max_chunk_bytes=10000, workers=4)
+        try:
+            results = list(bulk.ship(docs))
+        finally:
+            bulk.close()
+        assert len(bodies) == 10
+        assert ([item["index"]["_id"] for _, ok, item in results]
+                == [doc.id for doc in docs])
+        assert [doc for doc, _, _ in results] == docs
+
+    def test_reports_failure_for_missing_results(self):
+        docs = [make_doc(n) for n in range(3)]
+        self.es.bulk.side_effect = lambda body, **kwargs: {
+            "items": [{"index": {"_id": "id0", "status": 201}}]}
+        bulk = BulkShipper(self.es, ChunkSizeController(10),
+                           max_chunk_bytes=10000)
+        results = list(bulk.ship(iter(docs)))
+        assert [ok for _, ok, _ in results] == [True, False, False]
+        assert "exception" in results[2][2]["index"]
+
+    def test_reports_failure_for_unexpected_errors(self):
+        docs = [make_doc(n) for n in range(2)]
+        self.es.bulk.side_effect = ValueError("oops")
+        bulk = BulkShipper(self.es, ChunkSizeController(10),
+                           max_chunk_bytes=10000)
+        results = list(bulk.ship(docs))
+        assert [ok for _, ok, _ in results] == [False, False]
+        assert results[0][2]["index"]["error"] == "oops"
+
+    def test_asks_only_for_needed_results(self):
+        bulk = BulkShipper(self.es, ChunkSizeController(10),
+                           max_chunk_bytes=10000)
+        list(bulk.ship([make_doc(0)]))
+        _, kwargs = self.es.bulk.call_args
+        assert kwargs["filter_path"] == "items.*.status,items.*.error"
+
+    def test_sends_encoded_lines(self):
+        doc = make_doc(0)
+        bulk = BulkShipper(self.es, ChunkSizeController(10),
+                           max_chunk_bytes=10000)
+        list(bulk.ship([doc]))
+        (body,), _ = self.es.bulk.call_args
+        assert body == "%s\n%s\n" % doc.encode()
+
+    def test_reports_refused_events(self):
+        self.es.bulk.side_effect = lambda body, **kwargs: {"items": [
+            {"index": {"status": 201}},
+            {"index": {"status": 400, "error": "mapper_parsing_exception"}}]}
+        bulk = BulkShipper(self.es, ChunkSizeController(10),
+                           max_chunk_bytes=10000)
+        results = list(bulk.ship([make_doc(0), make_doc(1)]))
+        assert [ok for _, ok, _ in results] == [True, False]
+        assert results[1][2]["index"]["status"] == 400
+
+    def test_reports_failed_requests(self):
+        # the error must come through as it is, to tell outages apart
+        error = TransportError(429, "es_rejected_execution_exception")
+        self.es.bulk.side_effect = error
+        bulk = BulkShipper(self.es, ChunkSizeController(10),
+                           max_chunk_bytes=10000)
+        results = list(bulk.ship([make_doc(0), make_doc(1)]))
+        for _, ok, item in results:
+            assert not ok
+            assert item["index"]["exception"] is error
+            assert item["index"]["status"] == 429
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def test_gzip(self):
+        body = '{"index":{}}\n{"message":"hello"}\n' * 100
+        compressed = gzip_compress(body)
+        assert len(compressed) < len(body) / 10
+        assert gzip.GzipFile(fileobj=StringIO(compressed)).read() == body
+
+    def test_small_bodies_are_compressed_in_place(self):
+        # no need for gevent then
+        body = '{"index":{}}\n{"message":"hello"}\n'
+        assert gzip_compress_native(body) == gzip_compress(body)
+        assert not is_green()
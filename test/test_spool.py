@@ -0,0 +1,91 @@
+"""Tests for the disk spool."""
+
+from datetime import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Path setup
+path = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, os.path.abspath(path))
+
+from loggerds.document import Document
+from loggerds.spool import Spool, SpoolFull
+
+
+def make_doc(n, **source):
+    source["n"] = n
+    return Document("log", "tango-logs-2016.04.05", "id%d" % n, source)
+
+
+class SpoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_all(self, spool):
+        return [doc.to_dict() for seq in spool.segments()
+                for doc in spool.read(seq)]
+
+    def test_replays_events_in_order(self):
+        spool = Spool(self.directory, segment_size=200)
+        for i in range(10):
+            spool.append([make_doc(i, payload="x" * 20)])
+        docs = []
+        for seq in spool.segments():
+            docs.extend(spool.read(seq))
+            spool.ack(seq)
+        assert [doc.to_dict()["_source"]["n"] for doc in docs] == range(10)
+        assert [doc.id for doc in docs] == ["id%d" % i for i in range(10)]
+        assert spool.nbytes == 0
+        assert os.listdir(self.directory) == []
+
+    def test_keeps_attempts(self):
+        spool = Spool(self.directory)
+        doc = make_doc(0)
+        doc.attempts = 2
+        spool.append([doc, make_doc(1)])
+        (seq,) = spool.segments()
+        again, other = spool.read(seq)
+        assert (again.attempts, other.attempts) == (2, 0)
+        assert again.encode() == make_doc(0).encode()
+
+    def test_survives_restart(self):
+        spool = Spool(self.directory)
+        spool.append([make_doc(1), make_doc(2)])
+        spool.close()
+        spool = Spool(self.directory)
+        spool.append([make_doc(3)])
+        assert ([doc["_source"]["n"] for doc in self.read_all(spool)]
+                == [1, 2, 3])
+
+    def test_encodes_datetimes(self):
+        spool = Spool(self.directory, fsync="always")
+        spool.append([make_doc(1, t=datetime(2016, 4, 5, 12, 0, 0))])
+        (doc,) = self.read_all(spool)
+        assert doc["_source"]["t"] == "2016-04-05T12:00:00"
+
+    def test_skips_partial_writes(self):
+        spool = Spool(self.directory)
+        spool.append([make_doc(1)])
+        (seq,) = spool.segments()
+        with open(spool._path(seq), "ab") as f:
+            # a crash in the middle of a write
+            f.write('{"index":{"_index":"tango-logs-2016.04.05"}}\n{"n": ')
+        assert [doc.id for doc in spool.read(seq)] == ["id1"]
+        assert spool.n_corrupt == 1
+
+    def test_refuses_to_grow_beyond_max(self):
+        spool = Spool(self.directory, max_bytes=120)
+        spool.append([make_doc(1)])
+        with self.assertRaises(SpoolFull):
+            spool.append([make_doc(2, payload="x" * 20)])
+
+    def test_rejects_bad_fsync_policy(self):
+        with self.assertRaises(ValueError):
+            Spool(self.directory, fsync="sometimes")